@@ -0,0 +1,861 @@
+#=================================================================================================#
+# Benchmarks for GANSynth on synthetic data
+#
+# usage:
+# python benchmark.py --benchmarks mode_seeking_loss xla data_parallel gradient_accumulation recompute recompute_check graph_build
+# python benchmark.py --benchmarks networks ops spectral_ops --cpu --output baseline.json
+# python benchmark.py --benchmarks networks ops spectral_ops --cpu --baseline baseline.json --threshold 0.1
+# python benchmark.py --benchmarks lazy_regularization --gradient_penalty_intervals 1 4 16 --num_training_steps 1000
+# python benchmark.py --benchmarks graph_build --output graph_build.json
+# python benchmark.py --benchmarks graph_build --baseline graph_build.json
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import resource
+import argparse
+import json
+import time
+import sys
+import ops
+import spectral_ops
+from ops import jit_scope
+from model import GANSynth
+from model import cpu_device_count
+from network import PGGAN
+from utils import Struct
+
+
+def synthetic_input_fn(batch_size, waveform_length, num_labels):
+    waveforms = tf.random.uniform([batch_size, waveform_length], -1.0, 1.0)
+    labels = tf.one_hot(tf.random.uniform([batch_size], 0, num_labels, dtype=tf.int32), num_labels)
+    return waveforms, labels
+
+
+def growing_level_of_depth(depth, max_depth=6):
+    # the growing level at which the PGGAN is grown exactly up to `depth`
+    return ((1 << depth) - 1) / ((1 << (max_depth + 1)) - 1)
+
+
+def peak_memory():
+    # peak resident set size of this process in bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_device_memory(session):
+    # peak bytes allocated on the GPU
+    return int(session.run(tf.contrib.memory_stats.MaxBytesInUse()))
+
+
+def call_as_dict(function, *args):
+    return dict(function(*args))
+
+
+def run_isolated(function, *args):
+    # runs a benchmark in a fresh process so that peak memory is not shared between benchmarks
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return Struct(pool.apply(call_as_dict, (function, *args)))
+
+
+def data_format(args):
+    # stock CPU builds of TensorFlow support conv2d / avg_pool only in NHWC
+    return "NHWC" if args.cpu else "NCHW"
+
+
+def build_gan_synth(batch_size, growing_level, xla=False, num_replicas=1, replica_devices=None, recompute_depths=(),
+                    data_format="NCHW", **hyper_params):
+
+    pggan = PGGAN(
+        min_resolution=[2, 16],
+        max_resolution=[128, 1024],
+        min_channels=32,
+        max_channels=256,
+        growing_level=tf.constant(growing_level, dtype=tf.float32),
+        recompute_depths=recompute_depths,
+        data_format=data_format
+    )
+
+    return GANSynth(
+        generator=pggan.generator,
+        discriminator=pggan.discriminator,
+        real_input_fn=lambda num_shards, shard_index: synthetic_input_fn(
+            batch_size=batch_size,
+            waveform_length=64000,
+            num_labels=61
+        ),
+        fake_input_fn=lambda batch_size=batch_size: (
+            tf.random.normal([batch_size, 256])
+        ),
+        spectral_params=Struct(
+            waveform_length=64000,
+            sample_rate=16000,
+            spectrogram_shape=[128, 1024],
+            overlap=0.75
+        ),
+        hyper_params=Struct(dict(
+            dict(
+                generator_learning_rate=8e-4,
+                generator_beta1=0.0,
+                generator_beta2=0.99,
+                discriminator_learning_rate=8e-4,
+                discriminator_beta1=0.0,
+                discriminator_beta2=0.99,
+                mode_seeking_loss_weight=0.1,
+                mode_seeking_loss_estimator="gradient",
+                mode_seeking_batch_size=2,
+                mode_seeking_step_size=1e-2,
+                mode_seeking_loss_interval=1,
+                real_gradient_penalty_weight=5.0,
+                fake_gradient_penalty_weight=0.0,
+                gradient_penalty_interval=1,
+                gradient_accumulation_steps=1,
+            ),
+            **hyper_params
+        )),
+        xla=xla,
+        num_replicas=num_replicas,
+        replica_devices=replica_devices
+    )
+
+
+def time_steps(step_fn, num_steps, num_warmup_steps):
+    begin = time.time()
+    for _ in range(num_warmup_steps):
+        step_fn()
+    warmup_time = time.time() - begin
+    step_times = []
+    for _ in range(num_steps):
+        begin = time.time()
+        step_fn()
+        step_times.append(time.time() - begin)
+    return Struct(
+        warmup_time=warmup_time,
+        mean_step_time=float(np.mean(step_times)),
+        median_step_time=float(np.median(step_times)),
+        std_step_time=float(np.std(step_times))
+    )
+
+
+def error_message(error):
+    # the first line of a tensorflow error, recorded in the result in place of the timings
+    return "{}: {}".format(type(error).__name__, error.message.splitlines()[0])
+
+
+def time_fetches(session, fetches, num_steps, num_warmup_steps):
+    return time_steps(lambda: session.run(fetches), num_steps, num_warmup_steps)
+
+
+def train_step(session, gan_synth):
+    # one step of `GANSynth.train` without gradient accumulation, the lazy terms run on their intervals.
+    # returns the discriminator loss without the gradient penalty and the penalty loss (None when not run)
+    if gan_synth.gradient_penalty_train_op is not None:
+        _, discriminator_loss, global_step = session.run([gan_synth.discriminator_train_op, gan_synth.discriminator_loss, gan_synth.global_step])
+        gradient_penalty_loss = None
+        if global_step % gan_synth.gradient_penalty_interval == 0:
+            _, gradient_penalty_loss = session.run([gan_synth.gradient_penalty_train_op, gan_synth.gradient_penalty_loss])
+    else:
+        _, discriminator_loss, gradient_penalty_loss, global_step = session.run([
+            gan_synth.discriminator_train_op, gan_synth.discriminator_loss, gan_synth.gradient_penalty_loss, gan_synth.global_step
+        ])
+        discriminator_loss -= gradient_penalty_loss
+    if gan_synth.mode_seeking_train_op is not None and global_step % gan_synth.mode_seeking_loss_interval == 0:
+        session.run(gan_synth.mode_seeking_train_op)
+    else:
+        session.run(gan_synth.generator_train_op)
+    return float(discriminator_loss), gradient_penalty_loss if gradient_penalty_loss is None else float(gradient_penalty_loss)
+
+
+def mode_seeking_loss(args, config):
+    # generator step time for each mode-seeking loss estimator
+    results = []
+    for estimator, interval in [
+        (None, 1),
+        ("gradient", 1),
+        ("distance_ratio", 1),
+        ("finite_difference", 1),
+        ("gradient", 4),
+    ]:
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            gan_synth = build_gan_synth(
+                batch_size=args.batch_size,
+                growing_level=args.growing_level,
+                mode_seeking_loss_weight=0.1 if estimator else 0.0,
+                mode_seeking_loss_estimator=estimator or "gradient",
+                mode_seeking_loss_interval=interval,
+                data_format=data_format(args)
+            )
+            with tf.Session(config=config) as session:
+                session.run(tf.global_variables_initializer())
+                if gan_synth.mode_seeking_train_op is None:
+                    result = time_fetches(session, gan_synth.generator_train_op, args.num_steps, args.num_warmup_steps)
+                else:
+                    # one mode-seeking step followed by (interval - 1) plain generator steps
+                    results_per_op = [
+                        time_fetches(session, gan_synth.mode_seeking_train_op, args.num_steps, args.num_warmup_steps),
+                        time_fetches(session, gan_synth.generator_train_op, args.num_steps, args.num_warmup_steps)
+                    ]
+                    result = Struct(
+                        warmup_time=sum(result.warmup_time for result in results_per_op),
+                        mean_step_time=(results_per_op[0].mean_step_time + results_per_op[1].mean_step_time * (interval - 1)) / interval,
+                        median_step_time=(results_per_op[0].median_step_time + results_per_op[1].median_step_time * (interval - 1)) / interval,
+                        std_step_time=max(result.std_step_time for result in results_per_op)
+                    )
+            results.append(Struct(
+                benchmark="mode_seeking_loss",
+                estimator=estimator,
+                interval=interval,
+                data_format=data_format(args),
+                **result
+            ))
+    return results
+
+
+def xla_train_step(args, config, depth, xla):
+    # a variant failing to compile or run is reported with its error instead of aborting the other variants
+    result = Struct(
+        benchmark="xla",
+        component="train_step",
+        depth=depth,
+        xla=xla,
+        data_format=data_format(args)
+    )
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(
+            batch_size=args.batch_size,
+            growing_level=growing_level_of_depth(depth),
+            xla=xla,
+            data_format=data_format(args)
+        )
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            try:
+                # the first step includes XLA compilation
+                result.update(time_fetches(session, [gan_synth.discriminator_train_op, gan_synth.generator_train_op], args.num_steps, 1))
+            except tf.errors.OpError as error:
+                result.update(error=error_message(error))
+                return result
+    result.update(
+        compile_time=result.warmup_time - result.median_step_time,
+        peak_memory=peak_memory()
+    )
+    return result
+
+
+def xla_spectral_ops(args, config, xla):
+    spectral_params = Struct(
+        waveform_length=64000,
+        sample_rate=16000,
+        spectrogram_shape=[128, 1024],
+        overlap=0.75
+    )
+    result = Struct(
+        benchmark="xla",
+        component="spectral_ops",
+        xla=xla
+    )
+    with tf.Graph().as_default():
+        waveforms = tf.random.uniform([args.batch_size, 64000], -1.0, 1.0)
+        with jit_scope(xla):
+            magnitude_spectrograms, instantaneous_frequencies = spectral_ops.convert_to_spectrograms(waveforms, **spectral_params)
+            waveforms = spectral_ops.convert_to_waveforms(magnitude_spectrograms, instantaneous_frequencies, **spectral_params)
+        with tf.Session(config=config) as session:
+            try:
+                result.update(time_fetches(session, waveforms, args.num_steps, 1))
+            except tf.errors.OpError as error:
+                result.update(error=error_message(error))
+                return result
+    result.update(
+        compile_time=result.warmup_time - result.median_step_time,
+        peak_memory=peak_memory()
+    )
+    return result
+
+
+def xla(args, config):
+    # step time, compile time and peak memory with and without XLA at several growth stages
+    results = []
+    for depth in args.growing_depths:
+        for compile_ops in [False, True]:
+            results.append(run_isolated(xla_train_step, args, config, depth, compile_ops))
+    for compile_ops in [False, True]:
+        results.append(run_isolated(xla_spectral_ops, args, config, compile_ops))
+    return results
+
+
+def data_parallel_train_step(args, config, num_replicas):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(
+            batch_size=args.batch_size,
+            growing_level=args.growing_level,
+            num_replicas=num_replicas,
+            replica_devices=args.replica_devices,
+            data_format=data_format(args)
+        )
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            result = time_fetches(session, [gan_synth.discriminator_train_op, gan_synth.generator_train_op], args.num_steps, args.num_warmup_steps)
+    return Struct(
+        benchmark="data_parallel",
+        num_replicas=num_replicas,
+        replica_devices=args.replica_devices[:num_replicas],
+        data_format=data_format(args),
+        examples_per_second=args.batch_size * num_replicas / result.median_step_time,
+        **result
+    )
+
+
+def data_parallel(args, config):
+    # scaling efficiency of synchronized in-graph replicas, relative to a single replica.
+    # replicas are placed on --replica_devices (e.g. /gpu:0 /gpu:1 ... or /cpu:0 /cpu:1 ... with --cpu),
+    # without them all the replicas share one device and this measures a larger batch instead
+    results = [
+        run_isolated(data_parallel_train_step, args, config, num_replicas)
+        for num_replicas in args.num_replicas
+    ]
+    for result in results:
+        result.scaling_efficiency = result.examples_per_second / (results[0].examples_per_second * result.num_replicas / results[0].num_replicas)
+    return results
+
+
+def gradient_accumulation_train_step(args, config, batch_size, accumulation_steps):
+    result = Struct(
+        benchmark="gradient_accumulation",
+        batch_size=batch_size,
+        gradient_accumulation_steps=accumulation_steps,
+        effective_batch_size=batch_size * accumulation_steps,
+        data_format=data_format(args)
+    )
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(
+            batch_size=batch_size,
+            growing_level=args.growing_level,
+            gradient_accumulation_steps=accumulation_steps,
+            data_format=data_format(args)
+        )
+
+        def accumulated_step():
+            for _ in range(accumulation_steps):
+                session.run(gan_synth.discriminator_accumulate_op)
+            session.run(gan_synth.discriminator_apply_op)
+            for _ in range(accumulation_steps):
+                session.run(gan_synth.generator_accumulate_op)
+            session.run(gan_synth.generator_apply_op)
+
+        def step():
+            session.run(gan_synth.discriminator_train_op)
+            session.run(gan_synth.generator_train_op)
+
+        with tf.Session(config=config) as session:
+            session.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+            try:
+                result.update(time_steps(accumulated_step if accumulation_steps > 1 else step, args.num_steps, args.num_warmup_steps))
+            except tf.errors.ResourceExhaustedError:
+                result.update(out_of_memory=True)
+                return result
+            if tf.test.is_gpu_available():
+                result.update(peak_device_memory=peak_device_memory(session))
+    result.update(
+        out_of_memory=False,
+        peak_memory=peak_memory(),
+        examples_per_second=result.effective_batch_size / result.median_step_time
+    )
+    return result
+
+
+def gradient_accumulation(args, config):
+    # peak memory and throughput against effective batch size,
+    # accumulating micro-batches of `batch_size` versus running the effective batch at once
+    results = []
+    for accumulation_steps in args.gradient_accumulation_steps:
+        results.append(run_isolated(gradient_accumulation_train_step, args, config, args.batch_size, accumulation_steps))
+        if accumulation_steps > 1:
+            results.append(run_isolated(gradient_accumulation_train_step, args, config, args.batch_size * accumulation_steps, 1))
+    return results
+
+
+def recompute_train_step(args, config, recompute_depths):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(
+            batch_size=args.batch_size,
+            growing_level=args.growing_level,
+            recompute_depths=recompute_depths,
+            data_format=data_format(args)
+        )
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            result = time_fetches(session, [gan_synth.discriminator_train_op, gan_synth.generator_train_op], args.num_steps, args.num_warmup_steps)
+            # --cpu hides the GPU from the session, but not from `is_gpu_available`
+            if not args.cpu and tf.test.is_gpu_available():
+                result.update(peak_device_memory=peak_device_memory(session))
+    return Struct(
+        benchmark="recompute",
+        recompute_depths=list(recompute_depths),
+        data_format=data_format(args),
+        peak_memory=peak_memory(),
+        **result
+    )
+
+
+def recompute(args, config):
+    # memory / step time tradeoff of recomputing the conv blocks at each depth, relative to storing all activations
+    results = [run_isolated(recompute_train_step, args, config, [])]
+    for depth in args.recompute_depths:
+        results.append(run_isolated(recompute_train_step, args, config, [depth]))
+    if len(args.recompute_depths) > 1:
+        results.append(run_isolated(recompute_train_step, args, config, args.recompute_depths))
+    # the activations are held in device memory on a GPU, which the resident set size of the process does not include
+    memory = "peak_device_memory" if "peak_device_memory" in results[0] else "peak_memory"
+    for result in results:
+        result.relative_peak_memory = result[memory] / results[0][memory]
+        result.relative_peak_memory_of = memory
+        result.relative_step_time = result.median_step_time / results[0].median_step_time
+    return results
+
+
+def recompute_check_gradients(args, config):
+    # gradients of the generator loss and of the discriminator loss with the real gradient penalty,
+    # with and without recomputation, while the deepest recomputed block is fading in (the tf.cond growth is active)
+    depth = max(args.recompute_depths)
+    # between growth stages `depth - 1` and `depth`
+    growing_level = (growing_level_of_depth(depth - 1) + growing_level_of_depth(depth)) / 2
+    with tf.Graph().as_default():
+        random = np.random.RandomState(0)
+        latents = tf.constant(random.normal(size=[args.batch_size, 256]), dtype=tf.float32)
+        labels = tf.one_hot(np.arange(args.batch_size) % 61, 61)
+        real_images = tf.constant(random.uniform(-1.0, 1.0, size=[args.batch_size, 2, 128, 1024]), dtype=tf.float32)
+
+        def gradients(recompute_depths):
+            pggan = PGGAN(
+                min_resolution=[2, 16],
+                max_resolution=[128, 1024],
+                min_channels=32,
+                max_channels=256,
+                growing_level=tf.constant(growing_level),
+                recompute_depths=recompute_depths,
+                data_format=data_format(args)
+            )
+            fake_images = pggan.generator(latents, labels)
+            real_features, real_logits = pggan.discriminator(real_images, labels)
+            fake_features, fake_logits = pggan.discriminator(fake_images, labels)
+            generator_loss = tf.reduce_mean(tf.nn.softplus(-fake_logits))
+            real_gradients = tf.gradients(real_logits, [real_images])[0]
+            discriminator_loss = tf.reduce_mean(
+                tf.nn.softplus(-real_logits) + tf.nn.softplus(fake_logits) +
+                tf.reduce_sum(tf.square(real_gradients), axis=[1, 2, 3]) * 5.0
+            )
+            generator_variables = tf.trainable_variables("generator")
+            discriminator_variables = tf.trainable_variables("discriminator")
+            return generator_variables + discriminator_variables, (
+                tf.gradients(generator_loss, generator_variables) +
+                tf.gradients(discriminator_loss, discriminator_variables)
+            )
+
+        # the recomputing networks are built first, so that their shared variables are resource variables
+        variables, recomputed_gradients = gradients(args.recompute_depths)
+        _, stored_gradients = gradients([])
+        pairs = [
+            (variable.op.name, recomputed_gradient, stored_gradient)
+            for variable, recomputed_gradient, stored_gradient in zip(variables, recomputed_gradients, stored_gradients)
+            if recomputed_gradient is not None or stored_gradient is not None
+        ]
+        for name, recomputed_gradient, stored_gradient in pairs:
+            if recomputed_gradient is None or stored_gradient is None:
+                raise AssertionError("{} has a gradient in only one of the networks".format(name))
+
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            recomputed_gradients, stored_gradients = session.run([
+                [recomputed_gradient for name, recomputed_gradient, stored_gradient in pairs],
+                [stored_gradient for name, recomputed_gradient, stored_gradient in pairs]
+            ])
+
+    max_gradient_error = 0.0
+    for (name, _, _), recomputed_gradient, stored_gradient in zip(pairs, recomputed_gradients, stored_gradients):
+        np.testing.assert_allclose(recomputed_gradient, stored_gradient, rtol=1e-3, atol=1e-5, err_msg=name)
+        max_gradient_error = max(max_gradient_error, float(np.max(np.abs(recomputed_gradient - stored_gradient))))
+    return Struct(
+        benchmark="recompute_check",
+        growing_depth=float(np.log2(1 + ((1 << 7) - 1) * growing_level)),
+        recompute_depths=list(args.recompute_depths),
+        num_gradients=len(pairs),
+        max_gradient_error=max_gradient_error
+    )
+
+
+def recompute_check(args, config):
+    # recomputation must not change the gradients, including the second-order ones of the gradient penalty
+    return [run_isolated(recompute_check_gradients, args, config)]
+
+
+def lazy_regularization_train(args, config, gradient_penalty_interval):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(
+            batch_size=args.batch_size,
+            growing_level=args.growing_level,
+            data_format=data_format(args),
+            gradient_penalty_interval=gradient_penalty_interval
+        )
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            for _ in range(args.num_warmup_steps):
+                train_step(session, gan_synth)
+            step_times, discriminator_losses, gradient_penalty_losses = [], [], []
+            for _ in range(args.num_training_steps):
+                begin = time.time()
+                discriminator_loss, gradient_penalty_loss = train_step(session, gan_synth)
+                step_times.append(time.time() - begin)
+                discriminator_losses.append(discriminator_loss)
+                gradient_penalty_losses.append(gradient_penalty_loss)
+    # the mean step time is amortized over the penalty schedule, the median would hide the penalty steps
+    return Struct(
+        benchmark="lazy_regularization",
+        gradient_penalty_interval=gradient_penalty_interval,
+        data_format=data_format(args),
+        mean_step_time=float(np.mean(step_times)),
+        median_step_time=float(np.median(step_times)),
+        std_step_time=float(np.std(step_times)),
+        final_discriminator_loss=float(np.mean(discriminator_losses[-max(1, len(discriminator_losses) // 4):])),
+        discriminator_losses=discriminator_losses,
+        gradient_penalty_losses=gradient_penalty_losses
+    )
+
+
+def lazy_regularization(args, config):
+    # amortized step time and discriminator loss curve (without the penalty term) of the penalty
+    # in every discriminator step (interval 1) versus a separate penalty step every `interval` steps.
+    # the step times are relative to interval 1, the loss curves are on synthetic data from the same seed
+    results = [
+        run_isolated(lazy_regularization_train, args, config, gradient_penalty_interval)
+        for gradient_penalty_interval in args.gradient_penalty_intervals
+    ]
+    for result in results:
+        result.relative_step_time = result.mean_step_time / results[0].mean_step_time
+    return results
+
+
+# =================================================================================================
+# component benchmarks on synthetic data
+# with --cpu the networks and ops are built NHWC (see `data_format`), the layout of each result is recorded
+# so that baselines are only compared within the same layout.
+# components failing otherwise (e.g. out of memory) are reported with their error instead of timings
+
+
+def graph_build_train_step(args, config, depth, gradient_penalty_interval):
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        begin = time.time()
+        gan_synth = build_gan_synth(
+            batch_size=args.batch_size,
+            growing_level=growing_level_of_depth(depth),
+            data_format=data_format(args),
+            gradient_penalty_interval=gradient_penalty_interval
+        )
+        build_time = time.time() - begin
+        num_ops = len(tf.get_default_graph().get_operations())
+        begin = time.time()
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            startup_time = time.time() - begin
+            # the first step runs every train op, a lazy gradient penalty included
+            begin = time.time()
+            train_step(session, gan_synth)
+            first_step_time = time.time() - begin
+            result = time_steps(lambda: train_step(session, gan_synth), args.num_steps, args.num_warmup_steps)
+    return Struct(
+        benchmark="graph_build",
+        depth=depth,
+        gradient_penalty_interval=gradient_penalty_interval,
+        data_format=data_format(args),
+        num_ops=num_ops,
+        build_time=build_time,
+        startup_time=startup_time,
+        first_step_time=first_step_time,
+        sections={name: dict(section) for name, section in gan_synth.graph_build_stats.items()},
+        **result
+    )
+
+
+def graph_build(args, config):
+    # graph size, construction time and time to the first train step of the tf.cond graph at several growth stages,
+    # with the gradient penalty in the discriminator loss (interval 1) or differentiated separately (lazy).
+    # `sections` breaks the ops down by part, e.g. the first-order penalty gradients ("gradient_penalty")
+    # and the second-order ones ("discriminator_gradients" or "gradient_penalty_gradients")
+    return [
+        run_isolated(graph_build_train_step, args, config, depth, gradient_penalty_interval)
+        for depth in args.growing_depths
+        for gradient_penalty_interval in args.gradient_penalty_intervals
+    ]
+
+
+def synthetic_variable(shape):
+    # a constant synthetic input, so that random number generation is not timed
+    return tf.Variable(tf.random.normal(shape), trainable=False)
+
+
+def time_component(args, config, build_fn, backward=True, **fields):
+    # times the forward pass of `build_fn` and the backward pass w.r.t. its inputs and variables
+    results = []
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        inputs, outputs = build_fn()
+        fetches = dict(forward=outputs)
+        if backward:
+            fetches.update(backward=tf.gradients(
+                ys=tf.reduce_sum([tf.reduce_sum(output) for output in tf.contrib.framework.nest.flatten(outputs)]),
+                xs=inputs + tf.trainable_variables()
+            ))
+        with tf.Session(config=config) as session:
+            session.run(tf.global_variables_initializer())
+            for direction, fetch in fetches.items():
+                result = Struct(direction=direction, **fields)
+                try:
+                    result.update(time_fetches(session, fetch, args.num_steps, args.num_warmup_steps))
+                except tf.errors.OpError as error:
+                    result.update(error=error_message(error))
+                results.append(result)
+    return results
+
+
+def networks(args, config):
+    # generator and discriminator at each growth stage, built statically without tf.cond
+    results = []
+    for depth in args.growing_depths:
+        pggan = PGGAN(
+            min_resolution=[2, 16],
+            max_resolution=[128, 1024],
+            min_channels=32,
+            max_channels=256,
+            growing_level=growing_level_of_depth(depth),
+            data_format=data_format(args)
+        )
+
+        def generator():
+            latents = synthetic_variable([args.batch_size, 256])
+            labels = tf.one_hot(np.arange(args.batch_size) % 61, 61)
+            return [latents], pggan.generator(latents, labels)
+
+        def discriminator():
+            images = synthetic_variable([args.batch_size, 2, 128, 1024])
+            labels = tf.one_hot(np.arange(args.batch_size) % 61, 61)
+            return [images], pggan.discriminator(images, labels)
+
+        for name, build_fn in [("generator", generator), ("discriminator", discriminator)]:
+            results += time_component(
+                args, config, build_fn,
+                benchmark="networks",
+                component=name,
+                depth=depth,
+                batch_size=args.batch_size,
+                data_format=data_format(args)
+            )
+    return results
+
+
+def primitives(args, config):
+    # the ops primitives at the feature map shapes of each growth stage
+    results = []
+    for depth in args.growing_depths:
+        resolution = np.array([2, 16]) << depth
+        channels = min(256, 32 << (6 - depth))
+        layout = data_format(args)
+
+        def layout_shape(channels, resolution):
+            return [args.batch_size, channels, *resolution] if layout == "NCHW" else [args.batch_size, *resolution, channels]
+
+        shape = layout_shape(channels, resolution.tolist())
+
+        def conv2d_transpose():
+            inputs = synthetic_variable(layout_shape(min(256, channels * 2), (resolution // 2).tolist()))
+            return [inputs], ops.conv2d_transpose(
+                inputs=inputs,
+                filters=channels,
+                kernel_size=[3, 3],
+                strides=[2, 2],
+                data_format=layout
+            )
+
+        def upscale2d():
+            inputs = synthetic_variable(shape)
+            return [inputs], ops.upscale2d(inputs, data_format=layout)
+
+        def downscale2d():
+            inputs = synthetic_variable(shape)
+            return [inputs], ops.downscale2d(inputs, data_format=layout)
+
+        def pixel_norm():
+            inputs = synthetic_variable(shape)
+            return [inputs], ops.pixel_norm(inputs, data_format=layout)
+
+        def batch_stddev():
+            inputs = synthetic_variable(shape)
+            return [inputs], ops.batch_stddev(inputs, data_format=layout)
+
+        for name, build_fn in [
+            ("conv2d_transpose", conv2d_transpose),
+            ("upscale2d", upscale2d),
+            ("downscale2d", downscale2d),
+            ("pixel_norm", pixel_norm),
+            ("batch_stddev", batch_stddev),
+        ]:
+            if name == "conv2d_transpose" and depth == 0:
+                continue
+            results += time_component(
+                args, config, build_fn,
+                benchmark="ops",
+                component=name,
+                depth=depth,
+                shape=shape,
+                data_format=layout
+            )
+    return results
+
+
+def spectral_transforms(args, config):
+    # the spectral conversions across batch sizes (forward only, as in training)
+    spectral_params = Struct(
+        waveform_length=64000,
+        sample_rate=16000,
+        spectrogram_shape=[128, 1024],
+        overlap=0.75
+    )
+    results = []
+    for batch_size in args.batch_sizes:
+
+        def spectrograms():
+            waveforms = synthetic_variable([batch_size, 64000])
+            return [waveforms], spectral_ops.convert_to_spectrograms(waveforms, **spectral_params)
+
+        def waveforms():
+            magnitude_spectrograms = synthetic_variable([batch_size, 128, 1024])
+            instantaneous_frequencies = synthetic_variable([batch_size, 128, 1024])
+            return [magnitude_spectrograms, instantaneous_frequencies], spectral_ops.convert_to_waveforms(magnitude_spectrograms, instantaneous_frequencies, **spectral_params)
+
+        for name, build_fn in [("convert_to_spectrograms", spectrograms), ("convert_to_waveforms", waveforms)]:
+            results += time_component(
+                args, config, build_fn,
+                backward=False,
+                benchmark="spectral_ops",
+                component=name,
+                batch_size=batch_size
+            )
+    return results
+
+
+# =================================================================================================
+# baselines
+
+# fields that are measured rather than identify a result
+MEASUREMENTS = {
+    "warmup_time", "mean_step_time", "median_step_time", "std_step_time", "compile_time",
+    "peak_memory", "peak_device_memory", "examples_per_second", "scaling_efficiency",
+    "relative_peak_memory", "relative_step_time", "out_of_memory", "error",
+    "num_ops", "build_time", "startup_time", "first_step_time", "sections",
+    "num_gradients", "max_gradient_error",
+    "final_discriminator_loss", "discriminator_losses", "gradient_penalty_losses",
+}
+
+
+def result_key(result):
+    return json.dumps({name: value for name, value in result.items() if name not in MEASUREMENTS}, sort_keys=True)
+
+
+def compare(results, baseline_results, threshold):
+    # relative median step times against the baseline, flagging slowdowns beyond `threshold`,
+    # along with the relative graph size, build time and time to the first step of graph_build
+    baseline_results = {result_key(result): result for result in baseline_results}
+    comparisons = []
+    for result in results:
+        baseline_result = baseline_results.get(result_key(result))
+        if not baseline_result or "median_step_time" not in result or "median_step_time" not in baseline_result:
+            continue
+        relative_step_time = result["median_step_time"] / baseline_result["median_step_time"]
+        comparison = Struct(
+            {name: value for name, value in result.items() if name not in MEASUREMENTS},
+            baseline_median_step_time=baseline_result["median_step_time"],
+            median_step_time=result["median_step_time"],
+            relative_step_time=relative_step_time,
+            regression=relative_step_time > 1 + threshold
+        )
+        for name in ["num_ops", "build_time", "first_step_time"]:
+            if name in result and name in baseline_result:
+                comparison.update({
+                    "baseline_" + name: baseline_result[name],
+                    name: result[name],
+                    "relative_" + name: result[name] / baseline_result[name]
+                })
+        comparisons.append(comparison)
+    return comparisons
+
+
+BENCHMARKS = dict(
+    mode_seeking_loss=mode_seeking_loss,
+    xla=xla,
+    data_parallel=data_parallel,
+    gradient_accumulation=gradient_accumulation,
+    recompute=recompute,
+    recompute_check=recompute_check,
+    graph_build=graph_build,
+    lazy_regularization=lazy_regularization,
+    networks=networks,
+    ops=primitives,
+    spectral_ops=spectral_transforms,
+)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--growing_level", type=float, default=1.0)
+    parser.add_argument("--growing_depths", type=int, nargs="+", default=[0, 2, 4, 6])
+    parser.add_argument("--num_replicas", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--replica_devices", type=str, nargs="*", default=[])
+    parser.add_argument("--gradient_accumulation_steps", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--recompute_depths", type=int, nargs="+", default=[4, 5, 6])
+    parser.add_argument("--gradient_penalty_intervals", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--num_warmup_steps", type=int, default=2)
+    parser.add_argument("--num_training_steps", type=int, default=100)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--gpu", type=str, default="")
+    parser.add_argument('--cpu', action="store_true")
+    args = parser.parse_args()
+
+    config = tf.ConfigProto(
+        device_count=dict(dict(GPU=0) if args.cpu else {}, CPU=cpu_device_count(args.replica_devices)),
+        gpu_options=tf.GPUOptions(
+            visible_device_list=args.gpu,
+            allow_growth=True
+        )
+    )
+
+    results = []
+    for name in args.benchmarks:
+        for result in BENCHMARKS[name](args, config):
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            comparisons = compare(results, json.load(file), args.threshold)
+        for comparison in comparisons:
+            print(json.dumps(comparison))
+        regressions = [comparison for comparison in comparisons if comparison.regression]
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(json.dumps(regression)))
+        sys.exit(1 if regressions else 0)
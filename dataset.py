@@ -9,7 +9,11 @@ from utils import Struct
 from tensorflow.contrib.framework.python.ops import audio_ops
 
 
-def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources):
+def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources, num_shards=1, shard_index=0, indices=False):
+    # with `indices` the elements are (waveform, label, index of the example in the unsharded data)
+
+    if shuffle and indices:
+        raise ValueError("Example indices are only defined for unshuffled data")
 
     index_table = tf.contrib.lookup.index_table_from_tensor(sorted(pitches), dtype=tf.int32)
 
@@ -24,7 +28,17 @@ def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources
             )
         ))
 
-        waveform = tf.read_file(features.path)
+        label = index_table.lookup(features.pitch)
+        label = tf.one_hot(label, len(pitches))
+
+        pitch = tf.cast(features.pitch, tf.int32)
+        source = tf.cast(features.source, tf.int32)
+
+        return features.path, label, pitch, source
+
+    def read_waveform(path):
+
+        waveform = tf.read_file(path)
         # decode a 16-bit PCM WAV file
         waveform, _ = audio_ops.decode_wav(
             contents=waveform,
@@ -33,15 +47,12 @@ def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources
         )
         waveform = tf.squeeze(waveform)
 
-        label = index_table.lookup(features.pitch)
-        label = tf.one_hot(label, len(pitches))
-
-        pitch = tf.cast(features.pitch, tf.int32)
-        source = tf.cast(features.source, tf.int32)
-
-        return waveform, label, pitch, source
+        return waveform
 
     dataset = tf.data.TFRecordDataset(filenames=filenames)
+    if not indices:
+        # each data-parallel replica reads its own shard
+        dataset = dataset.shard(num_shards=num_shards, index=shard_index)
     if shuffle:
         dataset = dataset.shuffle(
             buffer_size=sum([
@@ -56,8 +67,9 @@ def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources
         num_parallel_calls=os.cpu_count()
     )
     # filter just acoustic instruments and just pitches 24-84 (as in the paper)
+    # before the waveforms are read
     dataset = dataset.filter(
-        predicate=lambda waveform, label, pitch, source: tf.logical_and(
+        predicate=lambda path, label, pitch, source: tf.logical_and(
             x=tf.reduce_any(tf.equal(sources, source)),
             y=tf.logical_and(
                 x=tf.greater_equal(pitch, min(pitches)),
@@ -65,10 +77,22 @@ def nsynth_input_fn(filenames, batch_size, num_epochs, shuffle, pitches, sources
             )
         )
     )
-    dataset = dataset.map(
-        map_func=lambda waveform, label, pitch, source: (waveform, label),
-        num_parallel_calls=os.cpu_count()
-    )
+    if indices:
+        # the examples are numbered as in the unsharded data and sharded by whole batches,
+        # so that the shards together see exactly the batches of a single unsharded pipeline
+        dataset = dataset.apply(tf.data.experimental.enumerate_dataset())
+        dataset = dataset.filter(
+            predicate=lambda index, example: tf.equal(index // batch_size % num_shards, shard_index)
+        )
+        dataset = dataset.map(
+            map_func=lambda index, example: (read_waveform(example[0]), example[1], index),
+            num_parallel_calls=os.cpu_count()
+        )
+    else:
+        dataset = dataset.map(
+            map_func=lambda path, label, pitch, source: (read_waveform(path), label),
+            num_parallel_calls=os.cpu_count()
+        )
     dataset = dataset.batch(
         batch_size=batch_size,
         drop_remainder=True
@@ -0,0 +1,391 @@
+import tensorflow as tf
+import numpy as np
+import collections
+import threading
+import queue
+import struct
+import wave
+import zlib
+import json
+import time
+import io
+import os
+import re
+from tensorflow.core.framework import step_stats_pb2
+from tensorflow.python.client import timeline
+
+
+class ProfilerHook(tf.train.SessionRunHook):
+    # captures a full trace of every session run of a global step every `save_steps` steps
+    # and writes a chrome trace and a per-phase time and memory breakdown as json.
+    # the phases come from the traced op times, so the python time of hooks is not charged to them,
+    # but the ops fetched by other hooks in the same runs (summaries, logged tensors) are traced and charged like any other op.
+    # the hook should be listed first: its own wall time then spans the before_run of the other hooks and the session run,
+    # and the difference to the traced time of each run is reported as hook and framework overhead
+
+    # phases are matched against node names in order
+    PHASES = [
+        ("iterator_wait", r"IteratorGetNext"),
+        ("gradient_penalty", r"gradient_penalty/"),
+        ("mode_seeking_loss", r"mode_seeking_loss/"),
+        ("optimizer", r"(^|/)Adam(_\d+)?/"),
+        ("spectral_ops", r"convert_to_(spectrograms|waveforms)/"),
+        ("generator_backward", r"gradients(_\d+)?/(.*/)?generator(_\d+)?/"),
+        ("discriminator_backward", r"gradients(_\d+)?/(.*/)?discriminator(_\d+)?/"),
+        ("generator", r"(^|/)generator(_\d+)?/"),
+        ("discriminator", r"(^|/)discriminator(_\d+)?/"),
+    ]
+
+    BLOCK = r"(conv_block|color_block)_\d+x\d+"
+
+    def __init__(self, save_steps, output_dir):
+        self.timer = tf.train.SecondOrStepTimer(every_steps=save_steps)
+        self.output_dir = output_dir
+
+    def begin(self):
+        self.global_step = tf.train.get_global_step()
+        self.step_stats = []
+        self.run_times = []
+
+    def after_create_session(self, session, coord):
+        self.step = session.run(self.global_step)
+        tf.gfile.MakeDirs(self.output_dir)
+
+    def before_run(self, run_context):
+        self.tracing = self.timer.should_trigger_for_step(self.step)
+        self.run_begin = time.time()
+        return tf.train.SessionRunArgs(
+            fetches=self.global_step,
+            options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if self.tracing else None
+        )
+
+    def after_run(self, run_context, run_values):
+        if self.tracing:
+            self.step_stats.append(run_values.run_metadata.step_stats)
+            self.run_times.append(time.time() - self.run_begin)
+        # a step may consist of several session runs (discriminator, gradient penalty, generator)
+        if run_values.results != self.step:
+            if self.step_stats:
+                self.save(self.step, self.step_stats, self.run_times)
+                self.timer.update_last_triggered_step(self.step)
+                self.step_stats = []
+                self.run_times = []
+            self.step = run_values.results
+
+    def end(self, session):
+        if self.step_stats:
+            self.save(self.step, self.step_stats, self.run_times)
+
+    def phase(self, node_name):
+        for phase, pattern in self.PHASES:
+            if re.search(pattern, node_name):
+                block = re.search(self.BLOCK, node_name)
+                return "{}/{}".format(phase, block.group(0)) if block and phase.startswith(("generator", "discriminator")) else phase
+        return "other"
+
+    def save(self, step, step_stats_list, run_times):
+
+        step_stats = step_stats_pb2.StepStats()
+        for run_step_stats in step_stats_list:
+            step_stats.dev_stats.extend(run_step_stats.dev_stats)
+
+        phases = collections.defaultdict(lambda: collections.Counter(
+            num_ops=0,
+            op_time_micros=0,
+            allocated_bytes=0,
+            peak_bytes=0
+        ))
+        begin, end = np.inf, -np.inf
+        for device_step_stats in step_stats.dev_stats:
+            for node_stats in device_step_stats.node_stats:
+                # ops run on several streams/threads, so op times of a phase may overlap
+                phase = phases[self.phase(node_stats.node_name)]
+                phase["num_ops"] += 1
+                phase["op_time_micros"] += node_stats.op_end_rel_micros - node_stats.op_start_rel_micros
+                phase["allocated_bytes"] += sum(
+                    output.tensor_description.allocation_description.allocated_bytes
+                    for output in node_stats.output
+                )
+                phase["peak_bytes"] = max([phase["peak_bytes"]] + [memory.peak_bytes for memory in node_stats.memory])
+                begin = min(begin, node_stats.all_start_micros)
+                end = max(end, node_stats.all_start_micros + node_stats.all_end_rel_micros)
+
+        # traced time of each session run, without the gaps between the runs of a step
+        traced_run_time_micros = 0
+        for run_step_stats in step_stats_list:
+            node_stats_list = [node_stats for device_step_stats in run_step_stats.dev_stats for node_stats in device_step_stats.node_stats]
+            if node_stats_list:
+                traced_run_time_micros += (
+                    max(node_stats.all_start_micros + node_stats.all_end_rel_micros for node_stats in node_stats_list) -
+                    min(node_stats.all_start_micros for node_stats in node_stats_list)
+                )
+        hooked_run_time_micros = int(sum(run_times) * 1e6)
+
+        profile = dict(
+            global_step=int(step),
+            num_session_runs=len(step_stats_list),
+            wall_time_micros=int(end - begin) if phases else 0,
+            traced_run_time_micros=int(traced_run_time_micros),
+            hooked_run_time_micros=hooked_run_time_micros,
+            hook_overhead_micros=int(hooked_run_time_micros - traced_run_time_micros),
+            phases={name: dict(phase) for name, phase in sorted(phases.items())}
+        )
+
+        with tf.gfile.GFile(os.path.join(self.output_dir, "profile_{}.json".format(step)), "w") as file:
+            file.write(json.dumps(profile, indent=4))
+        with tf.gfile.GFile(os.path.join(self.output_dir, "timeline_{}.json".format(step)), "w") as file:
+            file.write(timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True))
+
+        tf.logging.info("profile at step {}: {}".format(step, ", ".join(
+            "{}: {:.1f}ms".format(name, phase["op_time_micros"] / 1000)
+            for name, phase in sorted(phases.items(), key=lambda item: -item[1]["op_time_micros"])
+        )))
+
+
+class AsyncCheckpointSaverHook(tf.train.SessionRunHook):
+    # saves checkpoints every `save_steps` steps without blocking the training loop:
+    # the variables are copied into in-graph snapshots in host memory,
+    # which are written, published and pruned by the saver on a background thread
+
+    def __init__(self, checkpoint_dir, save_steps, max_to_keep, keep_checkpoint_every_n_hours, checkpoint_basename="model.ckpt"):
+        self.checkpoint_dir = checkpoint_dir
+        self.save_path = os.path.join(checkpoint_dir, checkpoint_basename)
+        self.timer = tf.train.SecondOrStepTimer(every_steps=save_steps)
+        self.max_to_keep = max_to_keep
+        self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
+
+    def begin(self):
+        self.global_step = tf.train.get_global_step()
+        variables = tf.global_variables()
+        # pinned to host memory, so that the snapshots neither double the footprint of the model on the GPU
+        # nor have to be copied from the device when they are written on the background thread
+        with tf.name_scope("checkpoint_snapshot"), tf.device("/cpu:0"):
+            # not added to any collection, so neither initialized nor saved by the scaffold
+            snapshots = [
+                tf.Variable(
+                    initial_value=tf.zeros(variable.shape, variable.dtype.base_dtype),
+                    trainable=False,
+                    collections=[]
+                ) for variable in variables
+            ]
+            self.snapshot_op = tf.group(*[
+                snapshot.assign(variable)
+                for snapshot, variable in zip(snapshots, variables)
+            ])
+        # the snapshots are saved under the names of the variables,
+        # the iterator state is serialized on the background thread as well,
+        # which may put it a few batches ahead of the variables
+        var_list = {variable.op.name: snapshot for variable, snapshot in zip(variables, snapshots)}
+        var_list.update({saveable.name: saveable for saveable in tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)})
+        # a sharded saver writes into a temporary directory and merges the shards on completion,
+        # the checkpoint state file is atomically updated afterwards
+        self.saver = tf.train.Saver(
+            var_list=var_list,
+            sharded=True,
+            max_to_keep=self.max_to_keep,
+            keep_checkpoint_every_n_hours=self.keep_checkpoint_every_n_hours
+        )
+        self.thread = None
+        self.stall_time = 0.0
+        self.write_time = 0.0
+
+    def after_create_session(self, session, coord):
+        # resume pruning of the checkpoints written before a restart
+        checkpoint_state = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if checkpoint_state:
+            self.saver.recover_last_checkpoints(checkpoint_state.all_model_checkpoint_paths)
+        tf.train.write_graph(
+            graph_or_graph_def=tf.get_default_graph().as_graph_def(add_shapes=True),
+            logdir=self.checkpoint_dir,
+            name="graph.pbtxt"
+        )
+        global_step = session.run(self.global_step)
+        self.save(session, global_step)
+        self.timer.update_last_triggered_step(global_step)
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs(self.global_step)
+
+    def after_run(self, run_context, run_values):
+        stale_global_step = run_values.results
+        if self.timer.should_trigger_for_step(stale_global_step + 1):
+            global_step = run_context.session.run(self.global_step)
+            if self.timer.should_trigger_for_step(global_step):
+                self.timer.update_last_triggered_step(global_step)
+                self.save(run_context.session, global_step)
+
+    def end(self, session):
+        global_step = session.run(self.global_step)
+        if global_step != self.timer.last_triggered_step():
+            self.save(session, global_step)
+        self.thread.join()
+        tf.logging.info("async checkpoints: {:.2f}s of training stalls, {:.2f}s of writes off the training loop".format(
+            self.stall_time, self.write_time
+        ))
+
+    def save(self, session, global_step):
+        begin = time.time()
+        # the snapshots are still being written
+        if self.thread is not None:
+            self.thread.join()
+        session.run(self.snapshot_op)
+        stall_time = time.time() - begin
+        self.stall_time += stall_time
+
+        def write():
+            begin = time.time()
+            self.saver.save(
+                sess=session,
+                save_path=self.save_path,
+                global_step=global_step,
+                write_meta_graph=False
+            )
+            write_time = time.time() - begin
+            self.write_time += write_time
+            tf.logging.info("saved checkpoint for step {} in {:.2f}s, training stalled for {:.3f}s".format(
+                global_step, write_time, stall_time
+            ))
+
+        self.thread = threading.Thread(target=write)
+        self.thread.start()
+
+
+class StartupHook(tf.train.SessionRunHook):
+    # logs the session startup time (initialization or restore) and the time to the end of the first step,
+    # which includes the one-time graph optimization and kernel setup of the first session runs
+
+    def begin(self):
+        self.begin_time = time.time()
+        self.first_step = True
+
+    def after_create_session(self, session, coord):
+        self.create_time = time.time()
+        tf.logging.info("session created in {:.2f}s".format(self.create_time - self.begin_time))
+
+    def after_run(self, run_context, run_values):
+        if self.first_step:
+            self.first_step = False
+            tf.logging.info("first step finished in {:.2f}s ({:.2f}s after the session was created)".format(
+                time.time() - self.begin_time, time.time() - self.create_time
+            ))
+
+
+def encode_wav(waveform, sample_rate):
+    # 16-bit PCM as written by tf.summary.audio
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes((np.clip(waveform, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def encode_png(image):
+    # 8-bit grayscale image normalized as by tf.summary.image
+    if np.all(image >= 0):
+        image = image * (255.0 / max(np.max(image), 1e-12))
+    else:
+        image = image * (127.0 / max(np.max(np.abs(image)), 1e-12)) + 128.0
+    image = np.clip(np.round(image), 0, 255).astype(np.uint8)
+    height, width = image.shape
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(b"".join(b"\x00" + row.tobytes() for row in image))),
+        chunk(b"IEND", b"")
+    ])
+
+
+class SummaryHook(tf.train.SessionRunHook):
+    # a single summary pipeline:
+    # cheap scalars every `save_scalar_steps` steps and heavy media every `save_media_steps` steps
+    # are fetched as raw tensors along with a training step,
+    # then encoded to wav/png and written to the event file on a background thread
+
+    def __init__(self, output_dir, save_scalar_steps, save_media_steps, scalars, audios, images, sample_rate,
+                 max_outputs=4, max_queue_size=4, global_step=None):
+        self.output_dir = output_dir
+        self.global_step = global_step
+        self.scalar_timer = tf.train.SecondOrStepTimer(every_steps=save_scalar_steps)
+        self.media_timer = tf.train.SecondOrStepTimer(every_steps=save_media_steps)
+        self.scalars = scalars
+        self.audios = {name: tensor[:max_outputs] for name, tensor in audios.items()}
+        self.images = {name: tensor[:max_outputs] for name, tensor in images.items()}
+        self.sample_rate = sample_rate
+        self.max_queue_size = max_queue_size
+
+    def begin(self):
+        if self.global_step is None:
+            self.global_step = tf.train.get_global_step()
+        self.next_step = None
+        self.writer = tf.summary.FileWriterCache.get(self.output_dir)
+        self.queue = queue.Queue(maxsize=self.max_queue_size)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def before_run(self, run_context):
+        fetches = dict(global_step=self.global_step)
+        self.request_scalars = self.next_step is None or self.scalar_timer.should_trigger_for_step(self.next_step)
+        self.request_media = self.next_step is None or self.media_timer.should_trigger_for_step(self.next_step)
+        if self.request_scalars:
+            fetches.update(scalars=self.scalars)
+        if self.request_media:
+            fetches.update(audios=self.audios, images=self.images)
+        return tf.train.SessionRunArgs(fetches)
+
+    def after_run(self, run_context, run_values):
+        global_step = run_values.results["global_step"]
+        if self.request_scalars:
+            self.scalar_timer.update_last_triggered_step(global_step)
+        if self.request_media:
+            self.media_timer.update_last_triggered_step(global_step)
+        if self.request_scalars or self.request_media:
+            try:
+                self.queue.put_nowait((global_step, run_values.results))
+            except queue.Full:
+                tf.logging.warning("summary writer is falling behind, dropped summaries for step {}".format(global_step))
+        self.next_step = global_step + 1
+
+    def end(self, session):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.flush()
+
+    def write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            global_step, results = item
+            summary = tf.Summary()
+            for name, value in results.get("scalars", {}).items():
+                summary.value.add(tag=name, simple_value=float(value))
+            for name, waveforms in results.get("audios", {}).items():
+                for index, waveform in enumerate(waveforms):
+                    summary.value.add(
+                        tag="{}/audio/{}".format(name, index),
+                        audio=tf.Summary.Audio(
+                            sample_rate=self.sample_rate,
+                            num_channels=1,
+                            length_frames=len(waveform),
+                            encoded_audio_string=encode_wav(waveform, self.sample_rate),
+                            content_type="audio/wav"
+                        )
+                    )
+            for name, images in results.get("images", {}).items():
+                for index, image in enumerate(images):
+                    summary.value.add(
+                        tag="{}/image/{}".format(name, index),
+                        image=tf.Summary.Image(
+                            height=image.shape[0],
+                            width=image.shape[1],
+                            colorspace=1,
+                            encoded_image_string=encode_png(image)
+                        )
+                    )
+            self.writer.add_summary(summary, global_step)
@@ -0,0 +1,256 @@
+#=================================================================================================#
+# Folded and quantized CPU inference build of the GANSynth generator
+#
+# the generator is built for a fixed growth stage (no tf.cond) with NHWC convolutions,
+# which are the only ones stock CPU kernels support (the images stay NCHW),
+# its variables and the equalized learning rate scaling are folded into constants,
+# and large weights are stored in int8 or float16.
+# convert_to_waveforms is attached in float at load time.
+#
+# usage:
+# python inference.py --model_dir gan_synth_model --filename generator.pb --quantization int8 --check
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import time
+import os
+import spectral_ops
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.client import device_lib
+from tensorflow.tools.graph_transforms import TransformGraph
+from network import PGGAN
+from utils import Struct
+
+
+def freeze_generator(pggan, model_dir, batch_size, latent_size, num_labels, quantization=None):
+
+    with tf.Graph().as_default():
+
+        latents = tf.placeholder(tf.float32, [batch_size, latent_size], name="latents")
+        labels = tf.placeholder(tf.float32, [batch_size, num_labels], name="labels")
+        tf.identity(pggan.generator(latents, labels), name="images")
+
+        saver = tf.train.Saver(var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="generator"))
+
+        with tf.Session() as session:
+            saver.restore(session, tf.train.latest_checkpoint(model_dir))
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess=session,
+                input_graph_def=session.graph_def,
+                output_node_names=["images"]
+            )
+
+    # fold the runtime weight scaling (`weight * stddev`) and all other constant subgraphs
+    transforms = ["strip_unused_nodes", "fold_constants(ignore_errors=true)"]
+    if quantization == "int8":
+        transforms += ["quantize_weights(minimum_size=1024)"]
+    transforms += ["sort_by_execution_order"]
+    graph_def = TransformGraph(graph_def, ["latents", "labels"], ["images"], transforms)
+
+    if quantization == "float16":
+        graph_def = cast_weights(graph_def, tf.float16)
+
+    return graph_def
+
+
+def cast_weights(graph_def, dtype, minimum_size=1024):
+    # stores large float constants in `dtype` and casts them back to float at runtime
+    output_graph_def = tf.GraphDef()
+    output_graph_def.versions.CopyFrom(graph_def.versions)
+    output_graph_def.library.CopyFrom(graph_def.library)
+
+    for node in graph_def.node:
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr["value"].tensor)
+            if value.size >= minimum_size:
+                constant = output_graph_def.node.add()
+                constant.op = "Const"
+                constant.name = "{}_{}".format(node.name, dtype.name)
+                constant.device = node.device
+                constant.attr["dtype"].type = dtype.as_datatype_enum
+                constant.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value.astype(dtype.as_numpy_dtype)))
+                cast = output_graph_def.node.add()
+                cast.op = "Cast"
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(constant.name)
+                cast.attr["SrcT"].type = dtype.as_datatype_enum
+                cast.attr["DstT"].type = tf.float32.as_datatype_enum
+                continue
+        output_graph_def.node.add().CopyFrom(node)
+
+    return output_graph_def
+
+
+def save_graph_def(graph_def, filename):
+    tf.io.write_graph(graph_def, os.path.dirname(filename) or ".", os.path.basename(filename), as_text=False)
+
+
+def load_graph_def(filename):
+    graph_def = tf.GraphDef()
+    with tf.io.gfile.GFile(filename, "rb") as file:
+        graph_def.ParseFromString(file.read())
+    return graph_def
+
+
+def check_data_format(graph_def):
+    # NCHW convolutions and pooling have no kernels on CPU, which only fails at the first run otherwise
+    nchw_nodes = [
+        node.name for node in graph_def.node
+        if "data_format" in node.attr and node.attr["data_format"].s == b"NCHW"
+    ]
+    if nchw_nodes and not any(device.device_type == "GPU" for device in device_lib.list_local_devices()):
+        raise ValueError("{} NCHW nodes (e.g. {}) cannot run without a GPU, freeze the generator with --data_format NHWC".format(
+            len(nchw_nodes), nchw_nodes[0]
+        ))
+
+
+class Synthesizer(object):
+
+    def __init__(self, graph_def, spectral_params, num_threads=None):
+
+        check_data_format(graph_def)
+
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+
+            tf.import_graph_def(graph_def, name="")
+
+            self.latents = self.graph.get_tensor_by_name("latents:0")
+            self.labels = self.graph.get_tensor_by_name("labels:0")
+            self.images = self.graph.get_tensor_by_name("images:0")
+
+            magnitude_spectrograms, instantaneous_frequencies = tf.unstack(self.images, axis=1)
+            self.waveforms = spectral_ops.convert_to_waveforms(magnitude_spectrograms, instantaneous_frequencies, **spectral_params)
+
+        self.batch_size, self.latent_size = self.latents.shape.as_list()
+        self.num_labels = self.labels.shape[1].value
+
+        # constant folding at session creation would expand the quantized weights back to float
+        self.session = tf.Session(
+            graph=self.graph,
+            config=tf.ConfigProto(
+                intra_op_parallelism_threads=num_threads or 0,
+                inter_op_parallelism_threads=num_threads or 0,
+                graph_options=tf.GraphOptions(
+                    optimizer_options=tf.OptimizerOptions(
+                        opt_level=tf.OptimizerOptions.L0
+                    ),
+                    rewrite_options=rewriter_config_pb2.RewriterConfig(
+                        constant_folding=rewriter_config_pb2.RewriterConfig.OFF
+                    )
+                )
+            )
+        )
+
+    def run(self, fetches, latents, labels):
+        # runs fixed-size batches, padding the last one
+        latents = np.asanyarray(latents, dtype=np.float32)
+        labels = np.eye(self.num_labels, dtype=np.float32)[np.asanyarray(labels)]
+        outputs = []
+        for begin in range(0, len(latents), self.batch_size):
+            end = min(begin + self.batch_size, len(latents))
+            padding = [[0, self.batch_size - (end - begin)], [0, 0]]
+            output = self.session.run(fetches, feed_dict={
+                self.latents: np.pad(latents[begin:end], padding, mode="constant"),
+                self.labels: np.pad(labels[begin:end], padding, mode="constant")
+            })
+            outputs.append(output[:end - begin])
+        return np.concatenate(outputs)
+
+    def synthesize(self, latents, labels):
+        return self.run(self.waveforms, latents, labels)
+
+    def spectrograms(self, latents, labels):
+        return self.run(self.images, latents, labels)
+
+    def close(self):
+        self.session.close()
+
+
+def spectral_distance(synthesizer, reference_synthesizer, latents, labels):
+    # mean absolute difference of log-mel magnitude spectrograms and instantaneous frequencies
+    images = synthesizer.spectrograms(latents, labels)
+    reference_images = reference_synthesizer.spectrograms(latents, labels)
+    magnitude_distance, frequency_distance = np.mean(np.abs(images - reference_images), axis=(0, 2, 3))
+    return Struct(
+        magnitude_distance=float(magnitude_distance),
+        frequency_distance=float(frequency_distance)
+    )
+
+
+def notes_per_second(synthesizer, latents, labels, num_warmup_notes):
+    synthesizer.synthesize(latents[:num_warmup_notes], labels[:num_warmup_notes])
+    begin = time.time()
+    synthesizer.synthesize(latents, labels)
+    return len(latents) / (time.time() - begin)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, default="gan_synth_model")
+    parser.add_argument("--filename", type=str, default="generator.pb")
+    parser.add_argument("--quantization", type=str, default="int8", choices=["int8", "float16", "none"])
+    parser.add_argument("--data_format", type=str, default="NHWC", choices=["NHWC", "NCHW"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_threads", type=int, default=1)
+    parser.add_argument("--num_notes", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument('--check', action="store_true")
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    pitches = range(24, 85)
+
+    spectral_params = Struct(
+        waveform_length=64000,
+        sample_rate=16000,
+        spectrogram_shape=[128, 1024],
+        overlap=0.75
+    )
+
+    def freeze(quantization):
+        return freeze_generator(
+            pggan=PGGAN(
+                min_resolution=[2, 16],
+                max_resolution=[128, 1024],
+                min_channels=32,
+                max_channels=256,
+                growing_level=1.0,
+                data_format=args.data_format
+            ),
+            model_dir=args.model_dir,
+            batch_size=args.batch_size,
+            latent_size=256,
+            num_labels=len(pitches),
+            quantization=quantization
+        )
+
+    graph_def = freeze(None if args.quantization == "none" else args.quantization)
+    save_graph_def(graph_def, args.filename)
+    tf.logging.info("{}: {} bytes".format(args.filename, graph_def.ByteSize()))
+
+    if args.check:
+
+        # fixed seeds for comparing against the float model
+        random = np.random.RandomState(args.seed)
+        latents = random.normal(size=[args.num_notes, 256])
+        labels = random.randint(0, len(pitches), size=[args.num_notes])
+
+        reference_graph_def = freeze(None)
+        tf.logging.info("float model: {} bytes".format(reference_graph_def.ByteSize()))
+
+        synthesizer = Synthesizer(graph_def, spectral_params, args.num_threads)
+        reference_synthesizer = Synthesizer(reference_graph_def, spectral_params, args.num_threads)
+
+        tf.logging.info("spectral_distance: {}".format(spectral_distance(synthesizer, reference_synthesizer, latents, labels)))
+        tf.logging.info("notes_per_second_per_core: {}".format(notes_per_second(synthesizer, latents, labels, args.batch_size) / args.num_threads))
+        tf.logging.info("reference_notes_per_second_per_core: {}".format(notes_per_second(reference_synthesizer, latents, labels, args.batch_size) / args.num_threads))
+
+        synthesizer.close()
+        reference_synthesizer.close()
@@ -0,0 +1,230 @@
+#=================================================================================================#
+# Multi-process input service for GANSynth training
+#
+# local worker processes (input_workers.py, without tensorflow) decode the NSynth WAV files
+# (and optionally compute the spectrograms with spectral_ops_numpy) directly into the slots of a shared-memory ring buffer,
+# the training graph consumes the ready slots through tf.data.Dataset.from_generator.
+# batches are never pickled, only slot indices go through the queues.
+# each batch is copied out of shared memory before its slot is reused
+# and once more by Dataset.from_generator into its tensors.
+#
+# the trainer's time waiting for ready batches (input-bound) and the workers' time waiting
+# for free slots (trainer-bound) are logged periodically along with the health of each worker
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import threading
+import queue
+import time
+from input_workers import read_examples
+from input_workers import slot_arrays
+from input_workers import worker
+from input_workers import NUM_BATCHES, DECODE_TIME, WAIT_TIME, HEARTBEAT, CURRENT_SLOT
+from model import convert_real_inputs
+from utils import Struct
+
+
+class InputService(object):
+
+    def __init__(self, filenames, batch_size, num_epochs, shuffle, pitches, sources, waveform_length,
+                 num_workers=4, num_slots=8, spectral_params=None, log_interval=60.0, seed=0):
+
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.shuffle = shuffle
+        self.num_labels = len(pitches)
+        self.waveform_length = waveform_length
+        self.num_workers = num_workers
+        # spectrograms are computed by the workers only if `spectral_params` is given
+        self.spectral_params = spectral_params and dict(spectral_params)
+        self.spectrogram_shape = spectral_params and list(spectral_params["spectrogram_shape"])
+        self.log_interval = log_interval
+        self.random = np.random.RandomState(seed)
+
+        self.examples = read_examples(filenames, pitches, sources)
+        if len(self.examples) < batch_size:
+            raise ValueError("{} examples are fewer than a batch of {}".format(len(self.examples), batch_size))
+
+        context = multiprocessing.get_context("spawn")
+        self.slots = []
+        for _ in range(num_slots):
+            slot = dict(
+                waveforms=context.RawArray("f", batch_size * waveform_length),
+                labels=context.RawArray("i", batch_size)
+            )
+            if self.spectrogram_shape:
+                slot.update(
+                    magnitude_spectrograms=context.RawArray("f", batch_size * int(np.prod(self.spectrogram_shape))),
+                    instantaneous_frequencies=context.RawArray("f", batch_size * int(np.prod(self.spectrogram_shape)))
+                )
+            self.slots.append(slot)
+        self.arrays = [slot_arrays(slot, batch_size, waveform_length, self.spectrogram_shape) for slot in self.slots]
+
+        self.tasks = context.Queue(maxsize=num_slots * 2)
+        self.free_slots = context.Queue()
+        self.full_slots = context.Queue()
+        for index in range(num_slots):
+            self.free_slots.put(index)
+
+        self.context = context
+        self.stats = [context.RawArray("d", 5) for _ in range(num_workers)]
+        self.workers = [None] * num_workers
+        self.num_finished_workers = 0
+        self.wait_time = 0.0
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self):
+        for index in range(self.num_workers):
+            self.start_worker(index)
+        threading.Thread(target=self.feed, daemon=True).start()
+        threading.Thread(target=self.monitor, daemon=True).start()
+
+    def start_worker(self, index):
+        self.stats[index][HEARTBEAT] = time.time()
+        self.stats[index][CURRENT_SLOT] = -1
+        self.workers[index] = self.context.Process(
+            target=worker,
+            args=(
+                self.tasks, self.free_slots, self.full_slots, self.slots, self.stats[index],
+                self.batch_size, self.waveform_length, self.spectral_params
+            ),
+            daemon=True
+        )
+        self.workers[index].start()
+
+    def close(self):
+        self.closed.set()
+        for process in self.workers:
+            if process is not None:
+                process.terminate()
+                process.join()
+
+    def feed(self):
+        # batches of examples for the workers, with the remainder of each epoch dropped
+        epoch = 0
+        while self.num_epochs is None or epoch < self.num_epochs:
+            indices = self.random.permutation(len(self.examples)) if self.shuffle else np.arange(len(self.examples))
+            for begin in range(0, len(indices) - self.batch_size + 1, self.batch_size):
+                task = [self.examples[index] for index in indices[begin:begin + self.batch_size]]
+                while not self.closed.is_set():
+                    try:
+                        self.tasks.put(task, timeout=1.0)
+                        break
+                    except queue.Full:
+                        pass
+                if self.closed.is_set():
+                    return
+            epoch += 1
+        for _ in range(self.num_workers):
+            self.tasks.put(None)
+
+    def monitor(self):
+        last_time = time.time()
+        last_wait_time = 0.0
+        last_stats = [list(stats) for stats in self.stats]
+        while not self.closed.wait(self.log_interval):
+            current_time = time.time()
+            # worker health, crashed workers are restarted and the slot they held is released
+            for index, process in enumerate(self.workers):
+                if not process.is_alive():
+                    if process.exitcode != 0:
+                        tf.logging.error("input worker {} died with exit code {}, restarting".format(index, process.exitcode))
+                        slot = int(self.stats[index][CURRENT_SLOT])
+                        if slot >= 0:
+                            self.free_slots.put(slot)
+                        self.start_worker(index)
+                elif current_time - self.stats[index][HEARTBEAT] > self.log_interval:
+                    tf.logging.warning("input worker {} has not responded for {:.0f}s".format(index, current_time - self.stats[index][HEARTBEAT]))
+            # backpressure
+            stats = [list(stats) for stats in self.stats]
+            with self.lock:
+                wait_time = self.wait_time
+            num_batches = sum(stats[NUM_BATCHES] - last[NUM_BATCHES] for stats, last in zip(stats, last_stats))
+            decode_time = sum(stats[DECODE_TIME] - last[DECODE_TIME] for stats, last in zip(stats, last_stats))
+            worker_wait_time = sum(stats[WAIT_TIME] - last[WAIT_TIME] for stats, last in zip(stats, last_stats))
+            elapsed_time = current_time - last_time
+            tf.logging.info(
+                "input service: {:.1f} batches/s, {} of {} slots ready, {:.1f}s decode per batch, "
+                "trainer waiting {:.0%} of the time (input-bound), workers waiting {:.0%} of the time (trainer-bound)".format(
+                    num_batches / elapsed_time,
+                    self.full_slots.qsize(),
+                    len(self.slots),
+                    decode_time / max(num_batches, 1),
+                    (wait_time - last_wait_time) / elapsed_time,
+                    worker_wait_time / (elapsed_time * self.num_workers)
+                )
+            )
+            last_time, last_wait_time, last_stats = current_time, wait_time, stats
+
+    def batches(self):
+        # ready batches copied out of the ring buffer, each slot is released as soon as it is copied.
+        # the copy cannot be left to from_generator, whose tensors may share the memory of aligned arrays
+        while True:
+            begin = time.time()
+            slot = self.full_slots.get()
+            # the replicas consume on their own threads
+            with self.lock:
+                self.wait_time += time.time() - begin
+            if slot is None:
+                with self.lock:
+                    self.num_finished_workers += 1
+                    finished = self.num_finished_workers >= self.num_workers
+                if finished:
+                    # wakes up the other consumers (replicas)
+                    self.full_slots.put(None)
+                    return
+                continue
+            batch = tuple(np.copy(array) for array in self.arrays[slot])
+            self.free_slots.put(slot)
+            yield batch
+
+    def input_fn(self, num_shards=1, shard_index=0):
+        # all replicas consume from the same ring buffer, so the batches need no sharding
+        output_types = (tf.float32, tf.int32)
+        output_shapes = ([self.batch_size, self.waveform_length], [self.batch_size])
+        if self.spectrogram_shape:
+            output_types += (tf.float32, tf.float32)
+            output_shapes += ([self.batch_size, *self.spectrogram_shape], [self.batch_size, *self.spectrogram_shape])
+        dataset = tf.data.Dataset.from_generator(
+            generator=self.batches,
+            output_types=output_types,
+            output_shapes=output_shapes
+        )
+        dataset = dataset.map(lambda waveforms, labels, *spectrograms: (
+            waveforms, tf.one_hot(labels, self.num_labels), *spectrograms
+        ))
+        dataset = dataset.prefetch(buffer_size=1)
+
+        iterator = dataset.make_initializable_iterator()
+
+        tf.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS, iterator.initializer)
+
+        return iterator.get_next()
+
+    def real_inputs(self, spectral_params, xla=False, num_replicas=1):
+        # real inputs of each replica for GANSynth (see `convert_real_inputs`)
+        if not self.spectrogram_shape:
+            return [
+                convert_real_inputs(lambda num_shards, shard_index: self.input_fn(), spectral_params, xla)
+                for _ in range(num_replicas)
+            ]
+        real_inputs = []
+        for _ in range(num_replicas):
+            waveforms, labels, magnitude_spectrograms, instantaneous_frequencies = self.input_fn()
+            real_inputs.append(Struct(
+                waveforms=waveforms,
+                labels=labels,
+                magnitude_spectrograms=magnitude_spectrograms,
+                instantaneous_frequencies=instantaneous_frequencies
+            ))
+        return real_inputs
@@ -0,0 +1,189 @@
+#=================================================================================================#
+# Worker side of the multi-process input service (see input_service.py)
+#
+# imports only numpy and spectral_ops_numpy, so that the spawned workers do not load tensorflow
+# for their own code. the tfrecords of make_tfrecord.py are read with a minimal parser of the
+# record framing and of the tf.train.Example wire format (bytes, float and int64 lists).
+#=================================================================================================#
+
+import numpy as np
+import logging
+import struct
+import queue
+import wave
+import time
+import spectral_ops_numpy
+
+
+def read_records(filename):
+    # records of an uncompressed tfrecord file, each framed as
+    # uint64 length, uint32 masked crc32c of the length, data, uint32 masked crc32c of the data.
+    # the checksums are not verified
+    with open(filename, "rb") as file:
+        while True:
+            header = file.read(12)
+            if not header:
+                return
+            if len(header) < 12:
+                raise ValueError("Truncated record header in {}".format(filename))
+            length, = struct.unpack("<Q", header[:8])
+            record = file.read(length)
+            if len(record) < length or len(file.read(4)) < 4:
+                raise ValueError("Truncated record in {}".format(filename))
+            yield record
+
+
+def read_varint(buffer, position):
+    value, shift = 0, 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def read_fields(buffer):
+    # (field number, wire type, value) of a serialized protocol buffer message
+    position = 0
+    while position < len(buffer):
+        key, position = read_varint(buffer, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(buffer, position)
+        elif wire_type == 1:
+            value, position = buffer[position:position + 8], position + 8
+        elif wire_type == 2:
+            length, position = read_varint(buffer, position)
+            value, position = buffer[position:position + length], position + length
+        elif wire_type == 5:
+            value, position = buffer[position:position + 4], position + 4
+        else:
+            raise ValueError("Unsupported wire type {}".format(wire_type))
+        yield number, wire_type, value
+
+
+def parse_feature(feature):
+    # values of a tf.train.Feature (bytes_list = 1, float_list = 2, int64_list = 3),
+    # repeated numbers either packed or not
+    values = []
+    for kind, _, value_list in read_fields(feature):
+        for _, wire_type, value in read_fields(value_list):
+            if kind == 1:
+                values.append(bytes(value))
+            elif kind == 2:
+                values += np.frombuffer(value, dtype="<f4").tolist()
+            elif kind == 3 and wire_type == 2:
+                position = 0
+                while position < len(value):
+                    number, position = read_varint(value, position)
+                    values.append(number - (number >> 63 << 64))
+            elif kind == 3:
+                values.append(value - (value >> 63 << 64))
+    return values
+
+
+def parse_example(record):
+    # {name: values} of a serialized tf.train.Example, Example.features = 1, Features.feature = 1 (map<string, Feature>)
+    features = {}
+    for number, _, example_features in read_fields(record):
+        if number != 1:
+            continue
+        for number, _, entry in read_fields(example_features):
+            if number != 1:
+                continue
+            entry = {number: value for number, _, value in read_fields(entry)}
+            features[bytes(entry.get(1, b"")).decode()] = parse_feature(entry.get(2, b""))
+    return features
+
+
+def read_examples(filenames, pitches, sources):
+    # (path, label index) of the acoustic instruments within the pitch range
+    pitches = sorted(pitches)
+    examples = []
+    for filename in filenames:
+        for record in read_records(filename):
+            features = parse_example(record)
+            pitch = features["pitch"][0]
+            source = features["source"][0]
+            if source in sources and pitch in pitches:
+                examples.append((features["path"][0].decode(), pitches.index(pitch)))
+    return examples
+
+
+def read_wav(filename, waveform_length):
+    # 16-bit PCM, zero-padded or truncated to `waveform_length` samples as `decode_wav`
+    with wave.open(filename, "rb") as file:
+        waveform = np.frombuffer(file.readframes(waveform_length), dtype="<i2")
+        waveform = waveform.reshape([-1, file.getnchannels()])[:, 0]
+    waveform = waveform.astype(np.float32) / 32768
+    return np.pad(waveform, [0, waveform_length - len(waveform)], mode="constant")
+
+
+def slot_arrays(slot, batch_size, waveform_length, spectrogram_shape=None):
+    # numpy views of the shared memory of a slot
+    arrays = [
+        np.frombuffer(slot["waveforms"], dtype=np.float32).reshape([batch_size, waveform_length]),
+        np.frombuffer(slot["labels"], dtype=np.int32).reshape([batch_size])
+    ]
+    if spectrogram_shape:
+        arrays += [
+            np.frombuffer(slot["magnitude_spectrograms"], dtype=np.float32).reshape([batch_size, *spectrogram_shape]),
+            np.frombuffer(slot["instantaneous_frequencies"], dtype=np.float32).reshape([batch_size, *spectrogram_shape])
+        ]
+    return arrays
+
+
+# indices into the shared statistics of each worker,
+# CURRENT_SLOT is the slot the worker is filling (-1 if none) so that the slot of a dead worker can be released
+NUM_BATCHES, DECODE_TIME, WAIT_TIME, HEARTBEAT, CURRENT_SLOT = range(5)
+
+
+def worker(tasks, free_slots, full_slots, slots, stats, batch_size, waveform_length, spectral_params):
+    # runs in a spawned process, `spectral_params` is a plain dict (or None)
+    arrays = [
+        slot_arrays(slot, batch_size, waveform_length, spectral_params and spectral_params["spectrogram_shape"])
+        for slot in slots
+    ]
+
+    def get(queue_):
+        # blocks while keeping the heartbeat alive
+        while True:
+            stats[HEARTBEAT] = time.time()
+            try:
+                return queue_.get(timeout=1.0)
+            except queue.Empty:
+                pass
+
+    def put(queue_, slot):
+        # released before it is handed over, a crash in between loses the slot rather than duplicating it
+        stats[CURRENT_SLOT] = -1
+        queue_.put(slot)
+
+    while True:
+        task = get(tasks)
+        if task is None:
+            full_slots.put(None)
+            return
+        begin = time.time()
+        slot = get(free_slots)
+        stats[CURRENT_SLOT] = slot
+        stats[WAIT_TIME] += time.time() - begin
+        begin = time.time()
+        waveforms, labels, *spectrograms = arrays[slot]
+        try:
+            for index, (path, label) in enumerate(task):
+                waveforms[index] = read_wav(path, waveform_length)
+                labels[index] = label
+            if spectral_params:
+                magnitude_spectrograms, instantaneous_frequencies = spectral_ops_numpy.convert_to_spectrograms(waveforms, **spectral_params)
+                spectrograms[0][:] = magnitude_spectrograms
+                spectrograms[1][:] = instantaneous_frequencies
+        except Exception as exception:
+            logging.warning("input worker skipped a batch: {}".format(exception))
+            put(free_slots, slot)
+            continue
+        stats[DECODE_TIME] += time.time() - begin
+        stats[NUM_BATCHES] += 1
+        put(full_slots, slot)
@@ -0,0 +1,155 @@
+#=================================================================================================#
+# Batched latent interpolation and timbre-morph sweeps with GANSynth
+#
+# the grid of (pitch, interpolated latent) points is generated as one stream of fixed-size batches,
+# the pitch embeddings are computed once per pitch and fed to the generator in place of the labels,
+# and every note is written as soon as its batch is synthesized
+#
+# usage:
+# python interpolation.py --model_dir gan_synth_model --output_dir interpolation --pitches 48 60 72
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import itertools
+import argparse
+import wave
+import os
+import spectral_ops
+from network import PGGAN
+from utils import Struct
+
+
+def lerp(a, b, t):
+    return a + (b - a) * t
+
+
+def slerp(a, b, t):
+    # spherical interpolation, falls back to linear interpolation for (anti)parallel latents
+    omega = np.arccos(np.clip(np.dot(a / np.linalg.norm(a), b / np.linalg.norm(b)), -1.0, 1.0))
+    if np.isclose(np.sin(omega), 0.0):
+        return lerp(a, b, t)
+    return (np.sin((1 - t) * omega) * a + np.sin(t * omega) * b) / np.sin(omega)
+
+
+def interpolate(anchors, num_steps, method="spherical"):
+    # `num_steps` points per segment between consecutive anchors, including the last anchor
+    function = dict(linear=lerp, spherical=slerp)[method]
+    latents = [
+        function(a, b, t)
+        for a, b in zip(anchors[:-1], anchors[1:])
+        for t in np.linspace(0.0, 1.0, num_steps, endpoint=False)
+    ]
+    return np.stack(latents + [anchors[-1]])
+
+
+def batches(latents, pitches, batch_size):
+    # streams the (pitch, latent) grid pitch by pitch as fixed-size batches, padding the last one
+    points = ((pitch_index, latent_index) for pitch_index in range(len(pitches)) for latent_index in range(len(latents)))
+    while True:
+        batch = list(itertools.islice(points, batch_size))
+        if not batch:
+            return
+        yield batch + [batch[-1]] * (batch_size - len(batch)), len(batch)
+
+
+def write_wav(filename, waveform, sample_rate):
+    with wave.open(filename, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+        file.writeframes((np.clip(waveform, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+
+
+def sweep(pggan, model_dir, output_dir, anchors, pitches, all_pitches, num_steps, method, batch_size,
+          spectral_params, config=None):
+
+    latents = interpolate(np.asanyarray(anchors, dtype=np.float32), num_steps, method)
+    latent_size = latents.shape[1]
+
+    with tf.Graph().as_default():
+
+        # pitch embeddings, computed once per pitch
+        pitch_labels = tf.one_hot([all_pitches.index(pitch) for pitch in pitches], len(all_pitches))
+        pitch_embeddings = pggan.embed_labels(pitch_labels, latent_size)
+
+        latent_placeholder = tf.placeholder(tf.float32, [batch_size, latent_size])
+        embedding_placeholder = tf.placeholder(tf.float32, [batch_size, latent_size])
+        images = pggan.generator(latent_placeholder, embedding_placeholder, embedded_labels=True)
+        magnitude_spectrograms, instantaneous_frequencies = tf.unstack(images, axis=1)
+        waveforms = spectral_ops.convert_to_waveforms(magnitude_spectrograms, instantaneous_frequencies, **spectral_params)
+
+        saver = tf.train.Saver(var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="generator"))
+
+        with tf.Session(config=config) as session:
+
+            saver.restore(session, tf.train.latest_checkpoint(model_dir))
+            pitch_embeddings = session.run(pitch_embeddings)
+
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+
+            num_notes = 0
+            for batch, size in batches(latents, pitches, batch_size):
+                pitch_indices, latent_indices = map(list, zip(*batch))
+                outputs = session.run(waveforms, feed_dict={
+                    latent_placeholder: latents[latent_indices],
+                    embedding_placeholder: pitch_embeddings[pitch_indices]
+                })
+                for (pitch_index, latent_index), waveform in zip(batch[:size], outputs):
+                    write_wav(
+                        filename=os.path.join(output_dir, "pitch_{}_step_{}.wav".format(pitches[pitch_index], latent_index)),
+                        waveform=waveform,
+                        sample_rate=spectral_params.sample_rate
+                    )
+                num_notes += size
+                tf.logging.info("{}/{} notes written".format(num_notes, len(pitches) * len(latents)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, default="gan_synth_model")
+    parser.add_argument("--output_dir", type=str, default="interpolation")
+    parser.add_argument("--pitches", type=int, nargs="+", default=[36, 48, 60, 72])
+    parser.add_argument("--num_anchors", type=int, default=4)
+    parser.add_argument("--num_steps", type=int, default=8)
+    parser.add_argument("--method", type=str, default="spherical", choices=["linear", "spherical"])
+    parser.add_argument("--data_format", type=str, default="NHWC", choices=["NHWC", "NCHW"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gpu", type=str, default="0")
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    sweep(
+        pggan=PGGAN(
+            min_resolution=[2, 16],
+            max_resolution=[128, 1024],
+            min_channels=32,
+            max_channels=256,
+            growing_level=1.0,
+            data_format=args.data_format
+        ),
+        model_dir=args.model_dir,
+        output_dir=args.output_dir,
+        anchors=np.random.RandomState(args.seed).normal(size=[args.num_anchors, 256]),
+        pitches=args.pitches,
+        all_pitches=list(range(24, 85)),
+        num_steps=args.num_steps,
+        method=args.method,
+        batch_size=args.batch_size,
+        spectral_params=Struct(
+            waveform_length=64000,
+            sample_rate=16000,
+            spectrogram_shape=[128, 1024],
+            overlap=0.75
+        ),
+        config=tf.ConfigProto(
+            gpu_options=tf.GPUOptions(
+                visible_device_list=args.gpu,
+                allow_growth=True
+            )
+        )
+    )
@@ -13,10 +13,21 @@
 
 import tensorflow as tf
 import numpy as np
+import multiprocessing
+import contextlib
 import functools
 import argparse
+import json
+import os
+from tensorflow.python.client import device_lib
 from dataset import nsynth_input_fn
 from model import GANSynth
+from model import convert_real_inputs
+from model import train_sweep
+from model import merge_evaluation_statistics
+from model import evaluation_metrics
+from model import cpu_device_count
+from input_service import InputService
 from network import PGGAN
 from utils import Struct
 
@@ -26,17 +37,82 @@ parser.add_argument('--filenames', type=str, nargs="+", default=["nsynth_train.t
 parser.add_argument("--batch_size", type=int, default=8)
 parser.add_argument("--num_epochs", type=int, default=None)
 parser.add_argument("--total_steps", type=int, default=1000000)
+parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
+parser.add_argument("--gradient_penalty_interval", type=int, default=1)
+parser.add_argument("--mode_seeking_loss_estimator", type=str, default="gradient", choices=["gradient", "distance_ratio", "finite_difference"])
+parser.add_argument("--mode_seeking_batch_size", type=int, default=2)
+parser.add_argument("--mode_seeking_loss_interval", type=int, default=1)
+parser.add_argument('--xla', action="store_true")
+parser.add_argument("--num_replicas", type=int, default=1)
+parser.add_argument("--replica_devices", type=str, nargs="*", default=[])
+parser.add_argument("--recompute_depths", type=int, nargs="*", default=[])
+parser.add_argument("--data_format", type=str, default=None, choices=["NCHW", "NHWC"])
+parser.add_argument("--profile_steps", type=int, default=None)
+parser.add_argument('--async_checkpoint', action="store_true")
+parser.add_argument("--num_evaluation_processes", type=int, default=1)
+parser.add_argument('--check_evaluation', action="store_true")
+parser.add_argument("--cluster_centers", type=str, default=None)
+parser.add_argument("--input_workers", type=int, default=0)
+parser.add_argument('--input_spectrograms', action="store_true")
+parser.add_argument("--sweep", type=str, default=None)
+parser.add_argument("--sweep_devices", type=str, nargs="*", default=[])
 parser.add_argument('--train', action="store_true")
 parser.add_argument('--evaluate', action="store_true")
 parser.add_argument('--generate', action="store_true")
 parser.add_argument("--gpu", type=str, default="0")
-args = parser.parse_args()
 
-tf.logging.set_verbosity(tf.logging.INFO)
 
-with tf.Graph().as_default():
+def real_input_fn(args, num_processes=1, process_index=0):
+    # each process reads its own shard, split further between its replicas
+    return lambda num_shards, shard_index: nsynth_input_fn(
+        filenames=args.filenames,
+        batch_size=args.batch_size,
+        num_epochs=args.num_epochs if args.train or args.sweep else 1,
+        shuffle=True if args.train or args.sweep else False,
+        pitches=range(24, 85),
+        sources=[0],
+        num_shards=num_shards * num_processes,
+        shard_index=shard_index * num_processes + process_index,
+        indices=False if args.train or args.sweep else True
+    )
+
+
+def fake_input_fn(args):
+    # the latents of an evaluation are derived from the indices of the real examples,
+    # so that they do not depend on how the examples are split between processes and replicas
+    def input_fn(batch_size=args.batch_size, indices=None):
+        if indices is None:
+            return tf.random.normal([batch_size, 256])
+        return tf.map_fn(
+            fn=lambda index: tf.random.stateless_normal([256], seed=tf.stack([index, 0])),
+            elems=indices,
+            dtype=tf.float32
+        )
+    return input_fn
+
+
+spectral_params = Struct(
+    waveform_length=64000,
+    sample_rate=16000,
+    spectrogram_shape=[128, 1024],
+    overlap=0.75
+)
 
-    tf.set_random_seed(0)
+
+def build_gan_synth(args, num_processes=1, process_index=0, real_inputs=None, **hyper_params):
+
+    # the configurations of a sweep are built in their own variable scopes with their own global steps
+    scope = tf.get_variable_scope().name
+    if scope:
+        global_step = tf.get_variable(
+            name="global_step",
+            shape=[],
+            dtype=tf.int64,
+            initializer=tf.zeros_initializer(),
+            trainable=False
+        )
+    else:
+        global_step = tf.train.create_global_step()
 
     pggan = PGGAN(
         min_resolution=[2, 16],
@@ -44,70 +120,224 @@ with tf.Graph().as_default():
         min_channels=32,
         max_channels=256,
         growing_level=tf.cast(tf.divide(
-            x=tf.train.create_global_step(),
+            x=global_step,
             y=args.total_steps
-        ), tf.float32)
+        ), tf.float32),
+        recompute_depths=args.recompute_depths,
+        data_format=data_format(args)
     )
 
-    gan_synth = GANSynth(
+    default_hyper_params = Struct(
+        generator_learning_rate=8e-4,
+        generator_beta1=0.0,
+        generator_beta2=0.99,
+        discriminator_learning_rate=8e-4,
+        discriminator_beta1=0.0,
+        discriminator_beta2=0.99,
+        mode_seeking_loss_weight=0.1,
+        mode_seeking_loss_estimator=args.mode_seeking_loss_estimator,
+        mode_seeking_batch_size=args.mode_seeking_batch_size,
+        mode_seeking_step_size=1e-2,
+        mode_seeking_loss_interval=args.mode_seeking_loss_interval,
+        real_gradient_penalty_weight=5.0,
+        fake_gradient_penalty_weight=0.0,
+        gradient_penalty_interval=args.gradient_penalty_interval,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+    )
+    unknown_hyper_params = set(hyper_params) - set(default_hyper_params)
+    if unknown_hyper_params:
+        raise ValueError("Unknown hyper parameters {}".format(sorted(unknown_hyper_params)))
+
+    return GANSynth(
         generator=pggan.generator,
         discriminator=pggan.discriminator,
-        real_input_fn=functools.partial(
-            nsynth_input_fn,
-            filenames=args.filenames,
-            batch_size=args.batch_size,
-            num_epochs=args.num_epochs if args.train else 1,
-            shuffle=True if args.train else False,
-            pitches=range(24, 85),
-            sources=[0]
-        ),
-        fake_input_fn=lambda: (
-            tf.random.normal([args.batch_size, 256])
-        ),
-        spectral_params=Struct(
-            waveform_length=64000,
-            sample_rate=16000,
-            spectrogram_shape=[128, 1024],
-            overlap=0.75
-        ),
-        hyper_params=Struct(
-            generator_learning_rate=8e-4,
-            generator_beta1=0.0,
-            generator_beta2=0.99,
-            discriminator_learning_rate=8e-4,
-            discriminator_beta1=0.0,
-            discriminator_beta2=0.99,
-            mode_seeking_loss_weight=0.1,
-            real_gradient_penalty_weight=5.0,
-            fake_gradient_penalty_weight=0.0,
-        )
+        real_input_fn=real_input_fn(args, num_processes, process_index),
+        fake_input_fn=fake_input_fn(args),
+        spectral_params=spectral_params,
+        hyper_params=Struct(default_hyper_params, **hyper_params),
+        xla=args.xla,
+        num_replicas=args.num_replicas,
+        replica_devices=args.replica_devices,
+        global_step=global_step,
+        real_inputs=real_inputs
     )
 
-    config = tf.ConfigProto(
+
+def input_service(args):
+    # decode worker processes feeding the training data through shared memory, disabled with 0 workers
+    if not args.input_workers:
+        return contextlib.suppress()
+    if args.evaluate:
+        raise ValueError("The input service only feeds training data, evaluate in a separate run")
+    return InputService(
+        filenames=args.filenames,
+        batch_size=args.batch_size,
+        num_epochs=args.num_epochs,
+        shuffle=True,
+        pitches=range(24, 85),
+        sources=[0],
+        waveform_length=spectral_params.waveform_length,
+        num_workers=args.input_workers,
+        spectral_params=spectral_params if args.input_spectrograms else None
+    )
+
+
+def session_config(args, num_processes=1):
+    # processes sharing the machine split its cores instead of each using them all (0 lets tensorflow choose),
+    # replicas or sweep configurations placed on /cpu:<index> get that many CPU devices
+    num_threads = max(1, multiprocessing.cpu_count() // num_processes) if num_processes > 1 else 0
+    return tf.ConfigProto(
+        intra_op_parallelism_threads=num_threads,
+        inter_op_parallelism_threads=num_threads,
+        device_count=dict(CPU=cpu_device_count(args.replica_devices + args.sweep_devices)),
         gpu_options=tf.GPUOptions(
             visible_device_list=args.gpu,
             allow_growth=True
         )
     )
 
-    if args.train:
-        gan_synth.train(
-            model_dir=args.model_dir,
-            config=config,
-            total_steps=args.total_steps,
-            save_checkpoint_steps=1000,
-            save_summary_steps=100,
-            log_tensor_steps=100
-        )
 
-    if args.evaluate:
-        gan_synth.evaluate(
-            model_dir=args.model_dir,
-            config=config
-        )
+def data_format(args):
+    # layout of the networks, NHWC by default without a GPU as stock CPU builds have no NCHW conv2d / avg_pool kernels
+    if args.data_format:
+        return args.data_format
+    devices = device_lib.list_local_devices(session_config(args))
+    return "NCHW" if any(device.device_type == "GPU" for device in devices) else "NHWC"
+
 
-    if args.generate:
-        gan_synth.generate(
+def load_cluster_centers(args):
+    # k-means centers of real features saved with np.save, used as bins by num_different_bins
+    if not args.cluster_centers:
+        return None
+    if not os.path.exists(args.cluster_centers):
+        tf.logging.warning("{} not found, skipping num_different_bins".format(args.cluster_centers))
+        return None
+    return np.load(args.cluster_centers)
+
+
+def evaluate_shard(args, process_index, num_processes):
+    # runs in a spawned evaluation process and returns plain picklable statistics.
+    # the shards split the batches of a single process and the fake latents follow the examples,
+    # so the merged statistics equal those of a single process
+    tf.logging.set_verbosity(tf.logging.INFO)
+    with tf.Graph().as_default():
+        tf.set_random_seed(0)
+        gan_synth = build_gan_synth(args, num_processes, process_index)
+        return gan_synth.evaluate_statistics(
             model_dir=args.model_dir,
-            config=config
+            config=session_config(args, num_processes),
+            cluster_centers=load_cluster_centers(args)
         )
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    parallel_evaluation = args.evaluate and args.num_evaluation_processes > 1
+
+    if args.train or args.generate or (args.evaluate and not parallel_evaluation):
+
+        with tf.Graph().as_default(), input_service(args) as service:
+
+            tf.set_random_seed(0)
+
+            gan_synth = build_gan_synth(args, real_inputs=service and service.real_inputs(spectral_params, args.xla, args.num_replicas))
+
+            config = session_config(args)
+
+            if args.train:
+                gan_synth.train(
+                    model_dir=args.model_dir,
+                    config=config,
+                    total_steps=args.total_steps,
+                    save_checkpoint_steps=1000,
+                    save_summary_steps=100,
+                    save_media_steps=1000,
+                    log_tensor_steps=100,
+                    profile_steps=args.profile_steps,
+                    async_checkpoint=args.async_checkpoint
+                )
+
+            if args.evaluate and not parallel_evaluation:
+                gan_synth.evaluate(
+                    model_dir=args.model_dir,
+                    config=config,
+                    cluster_centers=load_cluster_centers(args)
+                )
+
+            if args.generate:
+                gan_synth.generate(
+                    model_dir=args.model_dir,
+                    config=config
+                )
+
+    if args.sweep:
+
+        # a json list of hyper parameter overrides, one configuration each,
+        # trained side by side on one input pipeline and saved to model_dir/config_<i>
+        with open(args.sweep) as file:
+            sweep = json.load(file)
+
+        with tf.Graph().as_default(), input_service(args) as service:
+
+            tf.set_random_seed(0)
+
+            real_inputs = service.real_inputs(spectral_params, args.xla, args.num_replicas) if service else [
+                convert_real_inputs(real_input_fn(args), spectral_params, args.xla, num_shards=args.num_replicas, shard_index=replica)
+                for replica in range(args.num_replicas)
+            ]
+
+            gan_synths = []
+            for index, hyper_params in enumerate(sweep):
+                # configurations can be spread over local devices
+                with tf.variable_scope("config_{}".format(index)):
+                    with tf.device(args.sweep_devices[index % len(args.sweep_devices)]) if args.sweep_devices else contextlib.suppress():
+                        gan_synths.append(build_gan_synth(args, real_inputs=real_inputs, **hyper_params))
+
+            train_sweep(
+                gan_synths=gan_synths,
+                model_dirs=[os.path.join(args.model_dir, gan_synth.name) for gan_synth in gan_synths],
+                config=session_config(args),
+                total_steps=args.total_steps,
+                save_checkpoint_steps=1000,
+                save_summary_steps=100,
+                save_media_steps=1000,
+                log_tensor_steps=100,
+                profile_steps=args.profile_steps,
+                async_checkpoint=args.async_checkpoint
+            )
+
+    if parallel_evaluation:
+        # each process evaluates its own shard, the partial statistics are merged exactly
+        with multiprocessing.get_context("spawn").Pool(args.num_evaluation_processes) as pool:
+            statistics = pool.starmap(evaluate_shard, [
+                (args, process_index, args.num_evaluation_processes)
+                for process_index in range(args.num_evaluation_processes)
+            ])
+            if args.check_evaluation:
+                single_process_statistics = pool.apply(evaluate_shard, (args, 0, 1))
+        # shards with fewer examples than a batch have no statistics
+        for process_index, shard_statistics in enumerate(statistics):
+            if shard_statistics["real_statistics"] is None:
+                tf.logging.warning("evaluation shard {} has no complete batch, skipping it".format(process_index))
+        statistics = [shard_statistics for shard_statistics in statistics if shard_statistics["real_statistics"] is not None]
+        if not statistics:
+            raise ValueError("No evaluation shard has a complete batch of {} examples".format(args.batch_size))
+        statistics = functools.reduce(merge_evaluation_statistics, statistics)
+        if args.check_evaluation:
+            # the merged statistics of the shards against those of a single process
+            for name in ["real_statistics", "fake_statistics"]:
+                if statistics[name]["count"] != single_process_statistics[name]["count"]:
+                    raise ValueError("{} of {} examples merged, {} in a single process".format(
+                        name, statistics[name]["count"], single_process_statistics[name]["count"]
+                    ))
+                for key in ["mean", "scatter"]:
+                    np.testing.assert_allclose(statistics[name][key], single_process_statistics[name][key], rtol=1e-4, atol=1e-6)
+            for name in ["real_bin_counts", "fake_bin_counts"]:
+                if name in statistics:
+                    np.testing.assert_array_equal(statistics[name], single_process_statistics[name])
+            tf.logging.info("merged evaluation statistics match a single process")
+        evaluation_metrics(statistics)
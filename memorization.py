@@ -0,0 +1,223 @@
+#=================================================================================================#
+# Nearest-neighbour memorization check over discriminator features
+#
+# the discriminator features of the training set are extracted once
+# and stored in an IVF-PQ approximate nearest-neighbour index
+# [Product quantization for nearest neighbor search]
+# (https://hal.inria.fr/inria-00514462v2/document)
+# which is persisted with np.savez and can be extended shard by shard.
+# generated notes are queried in batches along with held-out real notes as a reference.
+#
+# usage:
+# python memorization.py --filenames nsynth_train.tfrecord --index index.npz --build
+# python memorization.py --filenames nsynth_valid.tfrecord --index index.npz --build
+# python memorization.py --filenames nsynth_test.tfrecord --index index.npz --query
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import itertools
+import json
+import metrics
+from sklearn import cluster
+from main import parser
+from main import build_gan_synth
+from main import session_config
+
+
+def squared_distances(x, y):
+    return np.maximum(np.sum(x ** 2, axis=1)[:, np.newaxis] - 2 * np.dot(x, y.T) + np.sum(y ** 2, axis=1)[np.newaxis, :], 0)
+
+
+class IVFPQIndex(object):
+
+    def __init__(self, coarse_centroids, codebooks, codes=None, ids=None, lists=None, shards=None):
+        # coarse_centroids: [num_lists, dimension]
+        # codebooks: [num_subspaces, num_codes, dimension / num_subspaces]
+        self.coarse_centroids = coarse_centroids
+        self.codebooks = codebooks
+        self.codes = np.zeros([0, len(codebooks)], dtype=np.uint8) if codes is None else codes
+        self.ids = np.zeros([0], dtype=np.int64) if ids is None else ids
+        self.lists = np.zeros([0], dtype=np.int32) if lists is None else lists
+        # (name, first id, count) of each added shard, to map ids back to the examples
+        self.shards = [] if shards is None else shards
+        self.sort()
+
+    @classmethod
+    def train(cls, features, num_lists=256, num_subspaces=32, num_codes=256, seed=0):
+        features = np.asanyarray(features, dtype=np.float32)
+        if features.shape[1] % num_subspaces:
+            raise ValueError("Feature dimension {} is not divisible by {} subspaces".format(features.shape[1], num_subspaces))
+        if len(features) < max(num_lists, num_codes):
+            raise ValueError("{} training features are fewer than {} clusters".format(len(features), max(num_lists, num_codes)))
+        coarse_centroids = cluster.MiniBatchKMeans(n_clusters=num_lists, random_state=seed).fit(features).cluster_centers_
+        residuals = features - coarse_centroids[np.argmin(squared_distances(features, coarse_centroids), axis=1)]
+        codebooks = np.stack([
+            cluster.KMeans(n_clusters=num_codes, n_init=1, random_state=seed).fit(subvectors).cluster_centers_
+            for subvectors in np.split(residuals, num_subspaces, axis=1)
+        ])
+        return cls(coarse_centroids.astype(np.float32), codebooks.astype(np.float32))
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    def sort(self):
+        # groups the codes by inverted list
+        order = np.argsort(self.lists, kind="stable")
+        self.codes = self.codes[order]
+        self.ids = self.ids[order]
+        self.lists = self.lists[order]
+        self.offsets = np.searchsorted(self.lists, np.arange(len(self.coarse_centroids) + 1))
+
+    def encode(self, residuals):
+        return np.stack([
+            np.argmin(squared_distances(subvectors, codebook), axis=1)
+            for subvectors, codebook in zip(np.split(residuals, len(self.codebooks), axis=1), self.codebooks)
+        ], axis=1).astype(np.uint8)
+
+    def add(self, features, ids):
+        features = np.asanyarray(features, dtype=np.float32)
+        lists = np.argmin(squared_distances(features, self.coarse_centroids), axis=1).astype(np.int32)
+        self.codes = np.concatenate([self.codes, self.encode(features - self.coarse_centroids[lists])])
+        self.ids = np.concatenate([self.ids, np.asanyarray(ids, dtype=np.int64)])
+        self.lists = np.concatenate([self.lists, lists])
+
+    def add_shard(self, name, feature_batches):
+        # adds the features of a new data shard with consecutive ids, quantized with the trained codebooks
+        first_id = self.size
+        for features in feature_batches:
+            self.add(features, np.arange(self.size, self.size + len(features)))
+        self.shards.append(dict(name=name, first_id=first_id, count=self.size - first_id))
+        self.sort()
+        tf.logging.info("added {} features of {} to the index".format(self.size - first_id, name))
+
+    def search(self, queries, num_neighbours=1, num_probes=8):
+        # approximate euclidean distances and ids of the nearest neighbours of a batch of queries
+        queries = np.asanyarray(queries, dtype=np.float32)
+        probes = np.argsort(squared_distances(queries, self.coarse_centroids), axis=1)[:, :num_probes]
+        distances = np.full([len(queries), num_neighbours], np.inf, dtype=np.float32)
+        ids = np.full([len(queries), num_neighbours], -1, dtype=np.int64)
+        subspaces = np.arange(len(self.codebooks))
+        # each inverted list is scanned once for all the queries probing it
+        for list_index in np.unique(probes):
+            begin, end = self.offsets[list_index], self.offsets[list_index + 1]
+            if begin == end:
+                continue
+            query_indices = np.nonzero(np.any(probes == list_index, axis=1))[0]
+            residuals = queries[query_indices] - self.coarse_centroids[list_index]
+            residuals = residuals.reshape([len(query_indices), len(self.codebooks), 1, -1])
+            # asymmetric distance tables [queries, subspaces, codes]
+            tables = np.sum(np.square(residuals - self.codebooks[np.newaxis]), axis=-1)
+            list_distances = np.sum(tables[:, subspaces, self.codes[begin:end]], axis=-1)
+            candidate_distances = np.concatenate([distances[query_indices], list_distances], axis=1)
+            candidate_ids = np.concatenate([ids[query_indices], np.tile(self.ids[begin:end], [len(query_indices), 1])], axis=1)
+            order = np.argsort(candidate_distances, axis=1)[:, :num_neighbours]
+            distances[query_indices] = np.take_along_axis(candidate_distances, order, axis=1)
+            ids[query_indices] = np.take_along_axis(candidate_ids, order, axis=1)
+        return np.sqrt(distances), ids
+
+    def save(self, filename):
+        np.savez(
+            filename,
+            coarse_centroids=self.coarse_centroids,
+            codebooks=self.codebooks,
+            codes=self.codes,
+            ids=self.ids,
+            lists=self.lists,
+            shards=json.dumps(self.shards)
+        )
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(
+                coarse_centroids=data["coarse_centroids"],
+                codebooks=data["codebooks"],
+                codes=data["codes"],
+                ids=data["ids"],
+                lists=data["lists"],
+                shards=json.loads(str(data["shards"]))
+            )
+
+
+def extract_features(model_dir, config, fetches, num_batches=None):
+    # batches of discriminator features until the input is exhausted or after `num_batches` batches
+
+    with tf.train.SingularMonitoredSession(
+        scaffold=tf.train.Scaffold(
+            init_op=tf.global_variables_initializer(),
+            local_init_op=tf.group(
+                tf.local_variables_initializer(),
+                tf.tables_initializer()
+            )
+        ),
+        checkpoint_dir=model_dir,
+        config=config
+    ) as session:
+
+        for _ in itertools.count() if num_batches is None else range(num_batches):
+            try:
+                yield session.run(fetches)
+            except tf.errors.OutOfRangeError:
+                break
+
+
+if __name__ == "__main__":
+
+    parser.add_argument("--index", type=str, default="memorization_index.npz")
+    parser.add_argument('--build', action="store_true")
+    parser.add_argument('--query', action="store_true")
+    parser.add_argument("--num_training_batches", type=int, default=128)
+    parser.add_argument("--num_lists", type=int, default=256)
+    parser.add_argument("--num_subspaces", type=int, default=32)
+    parser.add_argument("--num_query_batches", type=int, default=None)
+    parser.add_argument("--num_neighbours", type=int, default=1)
+    parser.add_argument("--num_probes", type=int, default=8)
+    parser.add_argument("--quantile", type=float, default=0.01)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    # the input is read once in order (ids follow the record order of the filtered, batched input)
+    args.train = False
+
+    with tf.Graph().as_default():
+
+        gan_synth = build_gan_synth(args)
+        config = session_config(args)
+
+        if args.build:
+            feature_batches = extract_features(args.model_dir, config, gan_synth.real_features)
+            if tf.gfile.Exists(args.index):
+                index = IVFPQIndex.load(args.index)
+            else:
+                # the quantizers are trained on the first batches of the first shard
+                training_batches = list(itertools.islice(feature_batches, args.num_training_batches))
+                index = IVFPQIndex.train(
+                    features=np.concatenate(training_batches),
+                    num_lists=args.num_lists,
+                    num_subspaces=args.num_subspaces
+                )
+                feature_batches = itertools.chain(training_batches, feature_batches)
+            index.add_shard(",".join(args.filenames), feature_batches)
+            index.save(args.index)
+
+        if args.query:
+            # generated notes and held-out real notes (the given filenames) against the index
+            index = IVFPQIndex.load(args.index)
+            fake_distances, fake_ids, real_distances = [], [], []
+            for real_features, fake_features in extract_features(args.model_dir, config, [gan_synth.real_features, gan_synth.fake_features], args.num_query_batches):
+                distances, ids = index.search(fake_features, args.num_neighbours, args.num_probes)
+                fake_distances.append(distances[:, 0])
+                fake_ids.append(ids[:, 0])
+                distances, ids = index.search(real_features, args.num_neighbours, args.num_probes)
+                real_distances.append(distances[:, 0])
+            statistics = metrics.memorization_statistics(
+                fake_distances=np.concatenate(fake_distances),
+                fake_ids=np.concatenate(fake_ids),
+                real_distances=np.concatenate(real_distances),
+                quantile=args.quantile
+            )
+            for name, value in statistics.items():
+                tf.logging.info("{}: {}".format(name, value))
@@ -18,11 +18,7 @@ def inception_score(logits):
     return np.exp(np.mean(kl_divergence(p, q)))
 
 
-def frechet_inception_distance(real_features, fake_features):
-    real_mean = np.mean(real_features, axis=0)
-    fake_mean = np.mean(fake_features, axis=0)
-    real_cov = np.cov(real_features, rowvar=False)
-    fake_cov = np.cov(fake_features, rowvar=False)
+def frechet_distance(real_mean, real_cov, fake_mean, fake_cov):
     mean_cov = sp.linalg.sqrtm(np.dot(real_cov, fake_cov))
     if np.iscomplexobj(mean_cov):
         if not np.allclose(np.diagonal(mean_cov).imag, 0, atol=1e-3):
@@ -31,6 +27,50 @@ def frechet_inception_distance(real_features, fake_features):
     return np.sum((real_mean - fake_mean) ** 2) + np.trace(real_cov + fake_cov - 2 * mean_cov)
 
 
+def frechet_inception_distance(real_features, fake_features):
+    real_mean = np.mean(real_features, axis=0)
+    fake_mean = np.mean(fake_features, axis=0)
+    real_cov = np.cov(real_features, rowvar=False)
+    fake_cov = np.cov(fake_features, rowvar=False)
+    return frechet_distance(real_mean, real_cov, fake_mean, fake_cov)
+
+
+def feature_statistics(features):
+    # mergeable sufficient statistics: count, mean and centered scatter matrix
+    features = np.asanyarray(features, dtype=np.float64)
+    mean = np.mean(features, axis=0)
+    centered_features = features - mean
+    return dict(
+        count=len(features),
+        mean=mean,
+        scatter=np.dot(centered_features.T, centered_features)
+    )
+
+
+def merge_feature_statistics(statistics, other_statistics):
+    # pairwise update from
+    # [Updating Formulae and a Pairwise Algorithm for Computing Sample Variances]
+    # (http://i.stanford.edu/pub/cstr/reports/cs/tr/79/773/CS-TR-79-773.pdf)
+    if statistics is None:
+        return other_statistics
+    if other_statistics is None:
+        return statistics
+    count = statistics["count"] + other_statistics["count"]
+    delta = other_statistics["mean"] - statistics["mean"]
+    return dict(
+        count=count,
+        mean=statistics["mean"] + delta * other_statistics["count"] / count,
+        scatter=statistics["scatter"] + other_statistics["scatter"] +
+        np.outer(delta, delta) * statistics["count"] * other_statistics["count"] / count
+    )
+
+
+def frechet_inception_distance_from_statistics(real_statistics, fake_statistics):
+    real_cov = real_statistics["scatter"] / (real_statistics["count"] - 1)
+    fake_cov = fake_statistics["scatter"] / (fake_statistics["count"] - 1)
+    return frechet_distance(real_statistics["mean"], real_cov, fake_statistics["mean"], fake_cov)
+
+
 def binomial_proportion_test(p, m, q, n, significance_level):
     p = (p * m + q * n) / (m + n)
     se = np.sqrt(p * (1 - p) * (1 / m + 1 / n))
@@ -39,25 +79,47 @@ def binomial_proportion_test(p, m, q, n, significance_level):
     return p_values < significance_level
 
 
-def num_different_bins(real_features, fake_features, num_bins=100, significance_level=0.05):
+def bin_counts(features, cluster_centers):
+    # mergeable histogram of the nearest cluster centers
+    distances = (
+        np.sum(features ** 2, axis=1, keepdims=True) -
+        2 * np.dot(features, cluster_centers.T) +
+        np.sum(cluster_centers ** 2, axis=1)
+    )
+    return np.bincount(np.argmin(distances, axis=1), minlength=len(cluster_centers))
 
-    clusters = cluster.KMeans(n_clusters=num_bins).fit(real_features)
-    real_labels, real_counts = np.unique(clusters.labels_, return_counts=True)
-    real_proportions = real_counts / np.sum(real_counts)
 
-    labels = np.array([
-        np.argmin(np.sum((fake_feature - clusters.cluster_centers_) ** 2, axis=1))
-        for fake_feature in fake_features
-    ])
-    fake_labels, fake_counts = np.unique(labels, return_counts=True)
-    fake_proportions = np.zeros_like(real_proportions)
-    fake_proportions[fake_labels] = fake_counts / np.sum(fake_counts)
+def num_different_bins_from_counts(real_counts, fake_counts, significance_level=0.05):
 
     different_bins = binomial_proportion_test(
-        p=real_proportions,
-        m=len(real_features),
-        q=fake_proportions,
-        n=len(fake_features),
+        p=real_counts / np.sum(real_counts),
+        m=np.sum(real_counts),
+        q=fake_counts / np.sum(fake_counts),
+        n=np.sum(fake_counts),
         significance_level=significance_level
     )
     return np.count_nonzero(different_bins)
+
+
+def num_different_bins(real_features, fake_features, num_bins=100, significance_level=0.05):
+
+    clusters = cluster.KMeans(n_clusters=num_bins).fit(real_features)
+    real_counts = np.bincount(clusters.labels_, minlength=num_bins)
+    fake_counts = bin_counts(fake_features, clusters.cluster_centers_)
+
+    return num_different_bins_from_counts(real_counts, fake_counts, significance_level)
+
+
+def memorization_statistics(fake_distances, fake_ids, real_distances, quantile=0.01):
+    # nearest training neighbour distances of generated notes compared with those of held-out real notes,
+    # fakes closer than the `quantile` of the held-out distances are counted as near-copies
+    threshold = np.quantile(real_distances, quantile)
+    neighbours, counts = np.unique(fake_ids, return_counts=True)
+    return dict(
+        median_fake_distance=float(np.median(fake_distances)),
+        median_real_distance=float(np.median(real_distances)),
+        distance_ratio=float(np.median(fake_distances) / np.median(real_distances)),
+        memorized_fraction=float(np.mean(fake_distances < threshold)),
+        num_unique_neighbours=len(neighbours),
+        max_neighbour_count=int(np.max(counts))
+    )
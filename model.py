@@ -1,97 +1,469 @@
 import tensorflow as tf
 import numpy as np
+import collections
+import contextlib
+import time
+import re
+import os
 import metrics
 import spectral_ops
+import hooks
+from ops import jit_scope
+from utils import Struct
+
+
+def average(tensors):
+    return tensors[0] if len(tensors) == 1 else tf.add_n(tensors) / len(tensors)
+
+
+def average_gradients(replica_gradients):
+    # averages the gradients of each variable over the replicas
+    gradients = []
+    for variable_gradients in zip(*replica_gradients):
+        if any(gradient is None for gradient in variable_gradients):
+            gradients.append(None)
+        elif len(variable_gradients) == 1:
+            gradients.append(variable_gradients[0])
+        else:
+            gradients.append(average([tf.convert_to_tensor(gradient) for gradient in variable_gradients]))
+    return gradients
+
+
+def add_gradients(grads_and_vars, other_grads_and_vars):
+    # sums of the gradients of the same variables, a missing gradient counts as zero
+    return [
+        (other_gradient if gradient is None else gradient if other_gradient is None else
+         tf.convert_to_tensor(gradient) + tf.convert_to_tensor(other_gradient), variable)
+        for (gradient, variable), (other_gradient, _) in zip(grads_and_vars, other_grads_and_vars)
+    ]
+
+
+def gradient_buffers(grads_and_vars):
+    # zero-initialized buffers for the variables with gradients,
+    # local variables so that they are neither trained nor checkpointed
+    with tf.name_scope("gradient_buffers"):
+        return {
+            variable: tf.Variable(
+                initial_value=tf.zeros(variable.shape, variable.dtype.base_dtype),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES]
+            )
+            for gradient, variable in grads_and_vars if gradient is not None
+        }
+
+
+def accumulate_gradients(grads_and_vars, buffers, accumulation_steps):
+    # adds the gradients of a micro-batch, so that the buffers hold the mean over `accumulation_steps` micro-batches
+    return tf.group(*[
+        buffers[variable].assign_add(tf.convert_to_tensor(gradient) / accumulation_steps)
+        for gradient, variable in grads_and_vars if gradient is not None
+    ])
+
+
+def apply_accumulated_gradients(optimizer, buffers, global_step=None):
+    # applies the accumulated gradients and resets the buffers
+    train_op = optimizer.apply_gradients(
+        grads_and_vars=[(buffer.read_value(), variable) for variable, buffer in buffers.items()],
+        global_step=global_step
+    )
+    with tf.control_dependencies([train_op]):
+        return tf.group(*[buffer.assign(tf.zeros_like(buffer)) for buffer in buffers.values()])
+
+
+def cpu_device_count(devices):
+    # number of CPU devices a session needs for the devices /cpu:<index> among `devices`,
+    # tensorflow creates a single CPU device unless ConfigProto.device_count asks for more
+    indices = [int(match.group(1)) for match in (re.search(r"cpu:(\d+)$", device.lower()) for device in devices) if match]
+    return max(indices) + 1 if indices else 1
+
+
+@contextlib.contextmanager
+def graph_build_stats(stats, name):
+    # accumulates the construction time and the number of ops added to the default graph under `name`,
+    # nested sections are counted in each enclosing section too
+    graph = tf.get_default_graph()
+    num_ops = len(graph.get_operations())
+    begin = time.time()
+    yield
+    section = stats.setdefault(name, Struct(num_ops=0, build_time=0.0))
+    section.num_ops += len(graph.get_operations()) - num_ops
+    section.build_time += time.time() - begin
+
+
+def log_graph_build_stats(stats):
+    for name, section in stats.items():
+        tf.logging.info("graph build: {} added {} ops in {:.2f}s".format(name, section.num_ops, section.build_time))
+    tf.logging.info("graph build: {} ops in total".format(len(tf.get_default_graph().get_operations())))
+
+
+def convert_real_inputs(real_input_fn, spectral_params, xla=False, num_shards=1, shard_index=0):
+    # real waveforms, labels and spectrograms of a replica,
+    # may be built once and shared by all the configurations of a sweep
+    # `indices` of the examples (or None) seed the fake latents of an evaluation
+    real_waveforms, labels, *indices = real_input_fn(num_shards=num_shards, shard_index=shard_index)
+    with jit_scope(xla), tf.name_scope("convert_to_spectrograms"):
+        real_magnitude_spectrograms, real_instantaneous_frequencies = spectral_ops.convert_to_spectrograms(real_waveforms, **spectral_params)
+    return Struct(
+        waveforms=real_waveforms,
+        labels=labels,
+        magnitude_spectrograms=real_magnitude_spectrograms,
+        instantaneous_frequencies=real_instantaneous_frequencies,
+        indices=indices[0] if indices else None
+    )
 
 
 class GANSynth(object):
 
-    def __init__(self, generator, discriminator, real_input_fn, fake_input_fn, spectral_params, hyper_params):
+    def __init__(self, generator, discriminator, real_input_fn, fake_input_fn, spectral_params, hyper_params,
+                 xla=False, num_replicas=1, global_step=None, real_inputs=None, replica_devices=None):
+        # `fake_input_fn` takes an optional batch size for the small extra batches of the mode-seeking loss estimators
+        # and the indices of the real examples if the real input has any (see `convert_real_inputs`)
+        # the configurations of a sweep are built in their own variable scopes with their own global steps,
+        # on shared real inputs (see `convert_real_inputs`)
+        scope = tf.get_variable_scope().name
+        if global_step is None:
+            global_step = tf.train.get_or_create_global_step()
+        # construction time and op count of each part of the graph
+        build_stats = collections.OrderedDict()
         # =========================================================================================
-        real_waveforms, labels = real_input_fn()
-        real_magnitude_spectrograms, real_instantaneous_frequencies = spectral_ops.convert_to_spectrograms(real_waveforms, **spectral_params)
-        real_images = tf.stack([real_magnitude_spectrograms, real_instantaneous_frequencies], axis=1)
+        # optional XLA JIT compilation of the networks and spectral conversions
+        # gradients of the compiled ops are compiled as separate clusters
+        def jit_compiled(function, name):
+            def wrapper(*args, **kwargs):
+                with graph_build_stats(build_stats, name), jit_scope(xla):
+                    return function(*args, **kwargs)
+            return wrapper
+
+        generator = jit_compiled(generator, "generator")
+        discriminator = jit_compiled(discriminator, "discriminator")
         # =========================================================================================
-        fake_latents = fake_input_fn()
-        fake_images = generator(fake_latents, labels)
-        fake_magnitude_spectrograms, fake_instantaneous_frequencies = tf.unstack(fake_images, axis=1)
-        fake_waveforms = spectral_ops.convert_to_waveforms(fake_magnitude_spectrograms, fake_instantaneous_frequencies, **spectral_params)
+        # lazy regularization from
+        # [Analyzing and Improving the Image Quality of StyleGAN]
+        # (https://arxiv.org/pdf/1912.04958.pdf)
+        # gradient penalties are optimized only every `gradient_penalty_interval` steps
+        # by a separate train op, with their weights scaled by the interval
+        lazy_regularization = bool(
+            hyper_params.real_gradient_penalty_weight or
+            hyper_params.fake_gradient_penalty_weight
+        ) and hyper_params.gradient_penalty_interval > 1
+        # the mode-seeking loss is optimized only every `mode_seeking_loss_interval` steps
+        # by an alternative generator train op, with its weight scaled by the interval
+        lazy_mode_seeking = bool(
+            hyper_params.mode_seeking_loss_weight
+        ) and hyper_params.mode_seeking_loss_interval > 1
         # =========================================================================================
-        real_features, real_logits = discriminator(real_images, labels)
-        fake_features, fake_logits = discriminator(fake_images, labels)
+        # synchronized data-parallel training with in-graph replicas,
+        # each replica reads its own shard of the real data.
+        # replicas are placed round-robin on `replica_devices` (CPU devices need `cpu_device_count` in the session config),
+        # without them they share the default device,
+        # which amounts to training on an N times larger batch rather than scaling out
+        def replica_fn(replica):
+            # =====================================================================================
+            if real_inputs:
+                real_input = real_inputs[replica]
+            else:
+                with graph_build_stats(build_stats, "real_inputs"):
+                    real_input = convert_real_inputs(real_input_fn, spectral_params, xla, num_shards=num_replicas, shard_index=replica)
+            real_waveforms = real_input.waveforms
+            labels = real_input.labels
+            real_magnitude_spectrograms = real_input.magnitude_spectrograms
+            real_instantaneous_frequencies = real_input.instantaneous_frequencies
+            real_images = tf.stack([real_magnitude_spectrograms, real_instantaneous_frequencies], axis=1)
+            # =====================================================================================
+            if real_input.get("indices") is None:
+                fake_latents = fake_input_fn()
+            else:
+                fake_latents = fake_input_fn(indices=real_input.indices)
+            fake_images = generator(fake_latents, labels)
+            fake_magnitude_spectrograms, fake_instantaneous_frequencies = tf.unstack(fake_images, axis=1)
+            with jit_scope(xla), tf.name_scope("convert_to_waveforms"):
+                fake_waveforms = spectral_ops.convert_to_waveforms(fake_magnitude_spectrograms, fake_instantaneous_frequencies, **spectral_params)
+            # =====================================================================================
+            real_features, real_logits = discriminator(real_images, labels)
+            fake_features, fake_logits = discriminator(fake_images, labels)
+            # =====================================================================================
+            # Non-Saturating Loss + Mode-Seeking Loss + Zero-Centered Gradient Penalty
+            # [Generative Adversarial Networks]
+            # (https://arxiv.org/abs/1406.2661)
+            # [Mode Seeking Generative Adversarial Networks for Diverse Image Synthesis]
+            # (https://arxiv.org/pdf/1903.05628.pdf)
+            # [Which Training Methods for GANs do actually Converge?]
+            # (https://arxiv.org/pdf/1801.04406.pdf)
+            # -------------------------------------------------------------------------------------
+            # non-saturating loss
+            generator_losses = tf.nn.softplus(-fake_logits)
+            # mode-seeking loss
+            if hyper_params.mode_seeking_loss_weight:
+                with graph_build_stats(build_stats, "mode_seeking_loss"), tf.name_scope("mode_seeking_loss"):
+                    mode_seeking_batch_size = hyper_params.mode_seeking_batch_size
+                    if hyper_params.mode_seeking_loss_estimator == "gradient":
+                        # gradient-based mode-seeking loss
+                        latent_gradients = tf.gradients(fake_images, [fake_latents])[0]
+                        mode_seeking_losses = 1 / (tf.reduce_sum(tf.square(latent_gradients), axis=[1]) + 1e-6)
+                    elif hyper_params.mode_seeking_loss_estimator == "distance_ratio":
+                        # paired-latent distance ratio as in the original paper,
+                        # needs only an extra forward pass of a small batch
+                        paired_fake_latents = fake_input_fn(mode_seeking_batch_size)
+                        paired_fake_images = generator(paired_fake_latents, labels[:mode_seeking_batch_size])
+                        image_distances = tf.reduce_mean(tf.abs(paired_fake_images - fake_images[:mode_seeking_batch_size]), axis=[1, 2, 3])
+                        latent_distances = tf.reduce_mean(tf.abs(paired_fake_latents - fake_latents[:mode_seeking_batch_size]), axis=[1])
+                        mode_seeking_losses = 1 / (image_distances / latent_distances + 1e-5)
+                    elif hyper_params.mode_seeking_loss_estimator == "finite_difference":
+                        # random-projection jacobian estimate by forward difference,
+                        # needs only an extra forward pass of a small batch
+                        directions = tf.nn.l2_normalize(tf.random.normal([mode_seeking_batch_size, fake_latents.shape[1]]), axis=1)
+                        perturbed_fake_images = generator(
+                            fake_latents[:mode_seeking_batch_size] + directions * hyper_params.mode_seeking_step_size,
+                            labels[:mode_seeking_batch_size]
+                        )
+                        jacobian_vector_products = (perturbed_fake_images - fake_images[:mode_seeking_batch_size]) / hyper_params.mode_seeking_step_size
+                        mode_seeking_losses = 1 / (tf.reduce_sum(tf.square(jacobian_vector_products), axis=[1, 2, 3]) + 1e-6)
+                    else:
+                        raise ValueError("Unknown mode-seeking loss estimator {}".format(hyper_params.mode_seeking_loss_estimator))
+                    mode_seeking_loss = tf.reduce_mean(mode_seeking_losses) * hyper_params.mode_seeking_loss_weight
+            else:
+                mode_seeking_loss = tf.constant(0.0)
+            # -------------------------------------------------------------------------------------
+            # non-saturating loss
+            discriminator_losses = tf.nn.softplus(-real_logits)
+            discriminator_losses += tf.nn.softplus(fake_logits)
+            # -------------------------------------------------------------------------------------
+            gradient_penalty_losses = []
+            # zero-centerd gradient penalty on data distribution
+            if hyper_params.real_gradient_penalty_weight:
+                with graph_build_stats(build_stats, "gradient_penalty"), tf.name_scope("real_gradient_penalty"):
+                    real_gradients = tf.gradients(real_logits, [real_images])[0]
+                    real_gradient_penalties = tf.reduce_sum(tf.square(real_gradients), axis=[1, 2, 3])
+                gradient_penalty_losses.append(real_gradient_penalties * hyper_params.real_gradient_penalty_weight)
+            # zero-centerd gradient penalty on generator distribution
+            if hyper_params.fake_gradient_penalty_weight:
+                with graph_build_stats(build_stats, "gradient_penalty"), tf.name_scope("fake_gradient_penalty"):
+                    fake_gradients = tf.gradients(fake_logits, [fake_images])[0]
+                    fake_gradient_penalties = tf.reduce_sum(tf.square(fake_gradients), axis=[1, 2, 3])
+                gradient_penalty_losses.append(fake_gradient_penalties * hyper_params.fake_gradient_penalty_weight)
+            if gradient_penalty_losses and not lazy_regularization:
+                discriminator_losses += tf.add_n(gradient_penalty_losses)
+            # -------------------------------------------------------------------------------------
+            # losss reduction
+            generator_loss = tf.reduce_mean(generator_losses)
+            if not lazy_mode_seeking:
+                generator_loss += mode_seeking_loss
+            discriminator_loss = tf.reduce_mean(discriminator_losses)
+            gradient_penalty_loss = tf.reduce_mean(tf.add_n(gradient_penalty_losses)) if gradient_penalty_losses else tf.constant(0.0)
+            # -------------------------------------------------------------------------------------
+            return Struct(
+                labels=labels,
+                fake_latents=fake_latents,
+                real_waveforms=real_waveforms,
+                fake_waveforms=fake_waveforms,
+                real_magnitude_spectrograms=real_magnitude_spectrograms,
+                fake_magnitude_spectrograms=fake_magnitude_spectrograms,
+                real_instantaneous_frequencies=real_instantaneous_frequencies,
+                fake_instantaneous_frequencies=fake_instantaneous_frequencies,
+                real_features=real_features,
+                fake_features=fake_features,
+                generator_loss=generator_loss,
+                mode_seeking_loss=mode_seeking_loss,
+                discriminator_loss=discriminator_loss,
+                gradient_penalty_loss=gradient_penalty_loss
+            )
+
+        replicas = []
+        for replica in range(num_replicas):
+            with tf.name_scope("replica_{}".format(replica)) if num_replicas > 1 else contextlib.suppress():
+                with tf.device(replica_devices[replica % len(replica_devices)]) if replica_devices else contextlib.suppress():
+                    replicas.append(replica_fn(replica))
         # =========================================================================================
-        # Non-Saturating Loss + Mode-Seeking Loss + Zero-Centered Gradient Penalty
-        # [Generative Adversarial Networks]
-        # (https://arxiv.org/abs/1406.2661)
-        # [Mode Seeking Generative Adversarial Networks for Diverse Image Synthesis]
-        # (https://arxiv.org/pdf/1903.05628.pdf)
-        # [Which Training Methods for GANs do actually Converge?]
-        # (https://arxiv.org/pdf/1801.04406.pdf)
-        # -----------------------------------------------------------------------------------------
-        # non-saturating loss
-        generator_losses = tf.nn.softplus(-fake_logits)
-        # gradient-based mode-seeking loss
-        if hyper_params.mode_seeking_loss_weight:
-            latent_gradients = tf.gradients(fake_images, [fake_latents])[0]
-            mode_seeking_losses = 1 / (tf.reduce_sum(tf.square(latent_gradients), axis=[1]) + 1e-6)
-            generator_losses += mode_seeking_losses * hyper_params.mode_seeking_loss_weight
-        # -----------------------------------------------------------------------------------------
-        # non-saturating loss
-        discriminator_losses = tf.nn.softplus(-real_logits)
-        discriminator_losses += tf.nn.softplus(fake_logits)
-        # zero-centerd gradient penalty on data distribution
-        if hyper_params.real_gradient_penalty_weight:
-            real_gradients = tf.gradients(real_logits, [real_images])[0]
-            real_gradient_penalties = tf.reduce_sum(tf.square(real_gradients), axis=[1, 2, 3])
-            discriminator_losses += real_gradient_penalties * hyper_params.real_gradient_penalty_weight
-        # zero-centerd gradient penalty on generator distribution
-        if hyper_params.fake_gradient_penalty_weight:
-            fake_gradients = tf.gradients(fake_logits, [fake_images])[0]
-            fake_gradient_penalties = tf.reduce_sum(tf.square(fake_gradients), axis=[1, 2, 3])
-            discriminator_losses += fake_gradient_penalties * hyper_params.fake_gradient_penalty_weight
-        # -----------------------------------------------------------------------------------------
-        # losss reduction
-        generator_loss = tf.reduce_mean(generator_losses)
-        discriminator_loss = tf.reduce_mean(discriminator_losses)
+        # a fixed batch of latents and pitches reused by every media summary
+        with tf.name_scope("fixed_fake"):
+            num_labels = replicas[0].labels.shape[1].value
+            fixed_fake_latents = tf.constant(
+                value=np.random.RandomState(0).normal(size=[4, replicas[0].fake_latents.shape[1].value]),
+                dtype=tf.float32
+            )
+            fixed_labels = tf.one_hot(np.linspace(0, num_labels - 1, 4).astype(np.int32), num_labels)
+            fixed_fake_images = generator(fixed_fake_latents, fixed_labels)
+            fixed_fake_magnitude_spectrograms, fixed_fake_instantaneous_frequencies = tf.unstack(fixed_fake_images, axis=1)
+            with jit_scope(xla), tf.name_scope("convert_to_waveforms"):
+                fixed_fake_waveforms = spectral_ops.convert_to_waveforms(fixed_fake_magnitude_spectrograms, fixed_fake_instantaneous_frequencies, **spectral_params)
         # =========================================================================================
         generator_optimizer = tf.train.AdamOptimizer(
             learning_rate=hyper_params.generator_learning_rate,
             beta1=hyper_params.generator_beta1,
             beta2=hyper_params.generator_beta2
         )
+        # with lazy regularization the discriminator optimizer also takes the penalty steps, so its learning rate
+        # and betas are adjusted by interval / (interval + 1) as in StyleGAN2, keeping the step size per iteration
+        lazy_ratio = hyper_params.gradient_penalty_interval / (hyper_params.gradient_penalty_interval + 1) if lazy_regularization else 1
         discriminator_optimizer = tf.train.AdamOptimizer(
-            learning_rate=hyper_params.discriminator_learning_rate,
-            beta1=hyper_params.discriminator_beta1,
-            beta2=hyper_params.discriminator_beta2
+            learning_rate=hyper_params.discriminator_learning_rate * lazy_ratio,
+            beta1=hyper_params.discriminator_beta1 ** lazy_ratio,
+            beta2=hyper_params.discriminator_beta2 ** lazy_ratio
         )
         # -----------------------------------------------------------------------------------------
-        generator_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope="generator")
-        discriminator_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope="discriminator")
+        generator_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=scope + "/generator" if scope else "generator")
+        discriminator_variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=scope + "/discriminator" if scope else "discriminator")
         # -----------------------------------------------------------------------------------------
-        generator_train_op = generator_optimizer.minimize(
-            loss=generator_loss,
-            var_list=generator_variables,
-            global_step=tf.train.get_or_create_global_step()
-        )
-        discriminator_train_op = discriminator_optimizer.minimize(
-            loss=discriminator_loss,
-            var_list=discriminator_variables
-        )
+        # gradients are averaged over the replicas before a single update,
+        # each set of gradients is a section of its own within the optimizer section
+        def gradients_fn(loss_fn, variables, name):
+            with graph_build_stats(build_stats, name):
+                return list(zip(average_gradients([
+                    tf.gradients(loss_fn(replica), variables)
+                    for replica in replicas
+                ]), variables))
+        # -----------------------------------------------------------------------------------------
+        # losses of the train ops, lazily optimized terms are weighted by their interval
+        def generator_loss_fn(replica):
+            return replica.generator_loss
+
+        def mode_seeking_loss_fn(replica):
+            return replica.generator_loss + replica.mode_seeking_loss * hyper_params.mode_seeking_loss_interval
+
+        def discriminator_loss_fn(replica):
+            return replica.discriminator_loss
+
+        def gradient_penalty_loss_fn(replica):
+            return replica.gradient_penalty_loss * hyper_params.gradient_penalty_interval
+        # -----------------------------------------------------------------------------------------
+        gradient_accumulation_steps = hyper_params.gradient_accumulation_steps
+        generator_train_op = None
+        mode_seeking_train_op = None
+        discriminator_train_op = None
+        gradient_penalty_train_op = None
+        generator_accumulate_op = None
+        mode_seeking_accumulate_op = None
+        discriminator_accumulate_op = None
+        gradient_penalty_accumulate_op = None
+        generator_apply_op = None
+        discriminator_apply_op = None
+        # gradients and optimizer updates
+        with graph_build_stats(build_stats, "optimizer"):
+            if gradient_accumulation_steps > 1:
+                # -------------------------------------------------------------------------------------
+                # gradient accumulation
+                # the gradients of `gradient_accumulation_steps` micro-batches are averaged in buffers and applied at once,
+                # the global step (and so the growing level) advances once per effective step.
+                # a lazy gradient penalty is accumulated along with the discriminator loss into the same buffers
+                generator_gradients = gradients_fn(generator_loss_fn, generator_variables, "generator_gradients")
+                discriminator_gradients = gradients_fn(discriminator_loss_fn, discriminator_variables, "discriminator_gradients")
+                generator_buffers = gradient_buffers(generator_gradients)
+                discriminator_buffers = gradient_buffers(discriminator_gradients)
+                generator_accumulate_op = accumulate_gradients(
+                    grads_and_vars=generator_gradients,
+                    buffers=generator_buffers,
+                    accumulation_steps=gradient_accumulation_steps
+                )
+                mode_seeking_accumulate_op = accumulate_gradients(
+                    grads_and_vars=gradients_fn(mode_seeking_loss_fn, generator_variables, "mode_seeking_gradients"),
+                    buffers=generator_buffers,
+                    accumulation_steps=gradient_accumulation_steps
+                ) if lazy_mode_seeking else None
+                discriminator_accumulate_op = accumulate_gradients(
+                    grads_and_vars=discriminator_gradients,
+                    buffers=discriminator_buffers,
+                    accumulation_steps=gradient_accumulation_steps
+                )
+                # the discriminator gradients are reused, only the second-order penalty gradients are built on top
+                gradient_penalty_accumulate_op = accumulate_gradients(
+                    grads_and_vars=add_gradients(
+                        grads_and_vars=discriminator_gradients,
+                        other_grads_and_vars=gradients_fn(gradient_penalty_loss_fn, discriminator_variables, "gradient_penalty_gradients")
+                    ),
+                    buffers=discriminator_buffers,
+                    accumulation_steps=gradient_accumulation_steps
+                ) if lazy_regularization else None
+                generator_apply_op = apply_accumulated_gradients(
+                    optimizer=generator_optimizer,
+                    buffers=generator_buffers,
+                    global_step=global_step
+                )
+                discriminator_apply_op = apply_accumulated_gradients(
+                    optimizer=discriminator_optimizer,
+                    buffers=discriminator_buffers
+                )
+            else:
+                # -------------------------------------------------------------------------------------
+                generator_train_op = generator_optimizer.apply_gradients(
+                    grads_and_vars=gradients_fn(generator_loss_fn, generator_variables, "generator_gradients"),
+                    global_step=global_step
+                )
+                mode_seeking_train_op = generator_optimizer.apply_gradients(
+                    grads_and_vars=gradients_fn(mode_seeking_loss_fn, generator_variables, "mode_seeking_gradients"),
+                    global_step=global_step
+                ) if lazy_mode_seeking else None
+                discriminator_train_op = discriminator_optimizer.apply_gradients(
+                    grads_and_vars=gradients_fn(discriminator_loss_fn, discriminator_variables, "discriminator_gradients")
+                )
+                # the penalty train op shares the discriminator's adam slots
+                gradient_penalty_train_op = discriminator_optimizer.apply_gradients(
+                    grads_and_vars=gradients_fn(gradient_penalty_loss_fn, discriminator_variables, "gradient_penalty_gradients")
+                ) if lazy_regularization else None
         # =========================================================================================
-        self.real_waveforms = real_waveforms
-        self.fake_waveforms = fake_waveforms
-        self.real_magnitude_spectrograms = real_magnitude_spectrograms
-        self.fake_magnitude_spectrograms = fake_magnitude_spectrograms
-        self.real_instantaneous_frequencies = real_instantaneous_frequencies
-        self.fake_instantaneous_frequencies = fake_instantaneous_frequencies
-        self.real_features = real_features
-        self.fake_features = fake_features
-        self.generator_loss = generator_loss
-        self.discriminator_loss = discriminator_loss
+        # summaries use the first replica, losses are averaged over the replicas
+        # and features are concatenated so that evaluation sees the shards of all the replicas
+        self.real_waveforms = replicas[0].real_waveforms
+        self.fake_waveforms = replicas[0].fake_waveforms
+        self.real_magnitude_spectrograms = replicas[0].real_magnitude_spectrograms
+        self.fake_magnitude_spectrograms = replicas[0].fake_magnitude_spectrograms
+        self.real_instantaneous_frequencies = replicas[0].real_instantaneous_frequencies
+        self.fake_instantaneous_frequencies = replicas[0].fake_instantaneous_frequencies
+        self.fixed_fake_waveforms = fixed_fake_waveforms
+        self.fixed_fake_magnitude_spectrograms = fixed_fake_magnitude_spectrograms
+        self.fixed_fake_instantaneous_frequencies = fixed_fake_instantaneous_frequencies
+        self.real_features = tf.concat([replica.real_features for replica in replicas], axis=0)
+        self.fake_features = tf.concat([replica.fake_features for replica in replicas], axis=0)
+        self.generator_loss = average([replica.generator_loss for replica in replicas])
+        self.mode_seeking_loss = average([replica.mode_seeking_loss for replica in replicas])
+        self.discriminator_loss = average([replica.discriminator_loss for replica in replicas])
+        self.gradient_penalty_loss = average([replica.gradient_penalty_loss for replica in replicas])
         self.generator_train_op = generator_train_op
+        self.mode_seeking_train_op = mode_seeking_train_op
+        self.mode_seeking_loss_interval = hyper_params.mode_seeking_loss_interval
         self.discriminator_train_op = discriminator_train_op
+        self.gradient_penalty_train_op = gradient_penalty_train_op
+        self.gradient_penalty_interval = hyper_params.gradient_penalty_interval
+        self.generator_accumulate_op = generator_accumulate_op
+        self.mode_seeking_accumulate_op = mode_seeking_accumulate_op
+        self.discriminator_accumulate_op = discriminator_accumulate_op
+        self.gradient_penalty_accumulate_op = gradient_penalty_accumulate_op
+        self.generator_apply_op = generator_apply_op
+        self.discriminator_apply_op = discriminator_apply_op
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.global_step = global_step
+        self.name = scope
+        self.graph_build_stats = build_stats
+        log_graph_build_stats(build_stats)
+        self.sample_rate = spectral_params.sample_rate
+
+    def summary_hook(self, output_dir, save_scalar_steps, save_media_steps):
+        return hooks.SummaryHook(
+            output_dir=output_dir,
+            save_scalar_steps=save_scalar_steps,
+            save_media_steps=save_media_steps,
+            scalars=dict(
+                generator_loss=self.generator_loss,
+                discriminator_loss=self.discriminator_loss,
+                mode_seeking_loss=self.mode_seeking_loss,
+                gradient_penalty_loss=self.gradient_penalty_loss
+            ),
+            audios=dict(
+                real_waveforms=self.real_waveforms,
+                fake_waveforms=self.fixed_fake_waveforms
+            ),
+            images=dict(
+                real_magnitude_spectrograms=self.real_magnitude_spectrograms,
+                fake_magnitude_spectrograms=self.fixed_fake_magnitude_spectrograms,
+                real_instantaneous_frequencies=self.real_instantaneous_frequencies,
+                fake_instantaneous_frequencies=self.fixed_fake_instantaneous_frequencies
+            ),
+            sample_rate=self.sample_rate,
+            max_outputs=4,
+            global_step=self.global_step
+        )
 
-    def train(self, model_dir, config, total_steps, save_checkpoint_steps, save_summary_steps, log_tensor_steps):
+    def train(self, model_dir, config, total_steps, save_checkpoint_steps, save_summary_steps, log_tensor_steps,
+              save_media_steps=None, profile_steps=None, async_checkpoint=False):
 
         with tf.train.SingularMonitoredSession(
             scaffold=tf.train.Scaffold(
@@ -103,8 +475,20 @@ class GANSynth(object):
             ),
             checkpoint_dir=model_dir,
             config=config,
-            hooks=[
-                tf.train.CheckpointSaverHook(
+            hooks=([
+                # not added at all when disabled,
+                # listed first so that its overhead measurement spans the other hooks
+                hooks.ProfilerHook(
+                    save_steps=profile_steps,
+                    output_dir=os.path.join(model_dir, "profile")
+                )
+            ] if profile_steps else []) + [
+                hooks.AsyncCheckpointSaverHook(
+                    checkpoint_dir=model_dir,
+                    save_steps=save_checkpoint_steps,
+                    max_to_keep=10,
+                    keep_checkpoint_every_n_hours=12,
+                ) if async_checkpoint else tf.train.CheckpointSaverHook(
                     checkpoint_dir=model_dir,
                     save_steps=save_checkpoint_steps,
                     saver=tf.train.Saver(
@@ -112,49 +496,10 @@ class GANSynth(object):
                         keep_checkpoint_every_n_hours=12,
                     ),
                 ),
-                tf.train.SummarySaverHook(
-                    output_dir=model_dir,
-                    save_steps=save_summary_steps,
-                    summary_op=tf.summary.merge([
-                        tf.summary.audio(
-                            name=name,
-                            tensor=tensor,
-                            sample_rate=16000,
-                            max_outputs=4
-                        ) for name, tensor in dict(
-                            real_waveforms=self.real_waveforms,
-                            fake_waveforms=self.fake_waveforms
-                        ).items()
-                    ]),
-                ),
-                tf.train.SummarySaverHook(
-                    output_dir=model_dir,
-                    save_steps=save_summary_steps,
-                    summary_op=tf.summary.merge([
-                        tf.summary.image(
-                            name=name,
-                            tensor=tensor,
-                            max_outputs=4
-                        ) for name, tensor in dict(
-                            real_magnitude_spectrograms=self.real_magnitude_spectrograms[..., tf.newaxis],
-                            fake_magnitude_spectrograms=self.fake_magnitude_spectrograms[..., tf.newaxis],
-                            real_instantaneous_frequencies=self.real_instantaneous_frequencies[..., tf.newaxis],
-                            fake_instantaneous_frequencies=self.fake_instantaneous_frequencies[..., tf.newaxis]
-                        ).items()
-                    ]),
-                ),
-                tf.train.SummarySaverHook(
+                self.summary_hook(
                     output_dir=model_dir,
-                    save_steps=save_summary_steps,
-                    summary_op=tf.summary.merge([
-                        tf.summary.scalar(
-                            name=name,
-                            tensor=tensor
-                        ) for name, tensor in dict(
-                            generator_loss=self.generator_loss,
-                            discriminator_loss=self.discriminator_loss
-                        ).items()
-                    ]),
+                    save_scalar_steps=save_summary_steps,
+                    save_media_steps=save_media_steps or save_summary_steps
                 ),
                 tf.train.LoggingTensorHook(
                     tensors=dict(
@@ -166,15 +511,49 @@ class GANSynth(object):
                 ),
                 tf.train.StopAtStepHook(
                     last_step=total_steps
-                )
+                ),
+                hooks.StartupHook()
             ]
         ) as session:
 
-            while not session.should_stop():
-                session.run(self.discriminator_train_op)
-                session.run(self.generator_train_op)
+            if self.gradient_accumulation_steps > 1:
+                # the global step advances only when the generator gradients are applied.
+                # the hooks see a single run per step, the last generator micro-batch,
+                # so that their fetches (losses, summaries) are evaluated on a micro-batch that is trained on
+                # instead of pulling an extra batch from the input pipeline in the apply runs.
+                # the other runs bypass the hooks, so the stop step is checked here as well
+                raw_session = session.raw_session()
+                global_step = raw_session.run(self.global_step)
+                while not session.should_stop() and global_step < total_steps:
+                    if self.gradient_penalty_accumulate_op is not None and global_step % self.gradient_penalty_interval == 0:
+                        discriminator_accumulate_op = self.gradient_penalty_accumulate_op
+                    else:
+                        discriminator_accumulate_op = self.discriminator_accumulate_op
+                    for _ in range(self.gradient_accumulation_steps):
+                        raw_session.run(discriminator_accumulate_op)
+                    raw_session.run(self.discriminator_apply_op)
+                    if self.mode_seeking_accumulate_op is not None and global_step % self.mode_seeking_loss_interval == 0:
+                        generator_accumulate_op = self.mode_seeking_accumulate_op
+                    else:
+                        generator_accumulate_op = self.generator_accumulate_op
+                    for _ in range(self.gradient_accumulation_steps - 1):
+                        raw_session.run(generator_accumulate_op)
+                    session.run(generator_accumulate_op)
+                    raw_session.run(self.generator_apply_op)
+                    global_step += 1
+            else:
+                while not session.should_stop():
+                    _, global_step = session.run([self.discriminator_train_op, self.global_step])
+                    if self.gradient_penalty_train_op is not None:
+                        if global_step % self.gradient_penalty_interval == 0:
+                            session.run(self.gradient_penalty_train_op)
+                    if self.mode_seeking_train_op is not None and global_step % self.mode_seeking_loss_interval == 0:
+                        session.run(self.mode_seeking_train_op)
+                    else:
+                        session.run(self.generator_train_op)
 
-    def evaluate(self, model_dir, config):
+    def evaluate_statistics(self, model_dir, config, cluster_centers=None):
+        # mergeable statistics of the discriminator features over the evaluation data (or a shard of it)
 
         with tf.train.SingularMonitoredSession(
             scaffold=tf.train.Scaffold(
@@ -188,12 +567,165 @@ class GANSynth(object):
             config=config
         ) as session:
 
-            def generator():
-                while True:
-                    try:
-                        yield session.run([self.real_features, self.fake_features])
-                    except tf.errors.OutOfRangeError:
-                        break
+            statistics = dict(real_statistics=None, fake_statistics=None)
+            if cluster_centers is not None:
+                statistics.update(real_bin_counts=0, fake_bin_counts=0)
+
+            while True:
+                try:
+                    real_features, fake_features = session.run([self.real_features, self.fake_features])
+                except tf.errors.OutOfRangeError:
+                    break
+                statistics = merge_evaluation_statistics(statistics, evaluation_statistics(real_features, fake_features, cluster_centers))
+
+            return statistics
+
+    def evaluate(self, model_dir, config, cluster_centers=None):
+        return evaluation_metrics(self.evaluate_statistics(model_dir, config, cluster_centers))
+
+
+def train_sweep(gan_synths, model_dirs, config, total_steps, save_checkpoint_steps, save_summary_steps, log_tensor_steps,
+                save_media_steps=None, profile_steps=None, async_checkpoint=False):
+    # trains the configurations of a sweep side by side on their shared real inputs,
+    # the train ops of all configurations run in the same session run
+    # so that the input pipeline and the real spectrograms are evaluated once per batch
 
-            frechet_inception_distance = metrics.frechet_inception_distance(*map(np.concatenate, zip(*generator())))
-            tf.logging.info("frechet_inception_distance: {}".format(frechet_inception_distance))
+    if any(gan_synth.gradient_accumulation_steps > 1 for gan_synth in gan_synths):
+        raise ValueError("Gradient accumulation is not supported in sweeps")
+    if profile_steps:
+        raise ValueError("Profiling is not supported in sweeps")
+    if async_checkpoint:
+        raise ValueError("Asynchronous checkpoints are not supported in sweeps")
+
+    # each configuration is checkpointed to its own model_dir under the names of an unscoped model,
+    # so that it can be evaluated by main.py and exported by inference.py as a single model.
+    # the shared (unscoped) input pipeline is saved with every configuration as in a single model checkpoint,
+    # configurations resumed from different steps restore it from the last model_dir
+    saveables = {saveable.name: saveable for saveable in tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)}
+    savers = [
+        tf.train.Saver(
+            var_list=dict({
+                variable.op.name[len(gan_synth.name) + 1:]: variable
+                for variable in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=gan_synth.name + "/")
+            }, **saveables),
+            max_to_keep=10,
+            keep_checkpoint_every_n_hours=12
+        )
+        for gan_synth in gan_synths
+    ]
+
+    def restore(scaffold, session):
+        for saver, model_dir in zip(savers, model_dirs):
+            checkpoint = tf.train.latest_checkpoint(model_dir)
+            if checkpoint:
+                saver.restore(session, checkpoint)
+
+    def save(session, index, global_step):
+        savers[index].save(session, os.path.join(model_dirs[index], "model.ckpt"), global_step=global_step)
+
+    with tf.train.SingularMonitoredSession(
+        scaffold=tf.train.Scaffold(
+            init_op=tf.global_variables_initializer(),
+            local_init_op=tf.group(
+                tf.local_variables_initializer(),
+                tf.tables_initializer()
+            ),
+            init_fn=restore
+        ),
+        config=config,
+        hooks=[
+            gan_synth.summary_hook(
+                output_dir=model_dir,
+                save_scalar_steps=save_summary_steps,
+                save_media_steps=save_media_steps or save_summary_steps
+            )
+            for gan_synth, model_dir in zip(gan_synths, model_dirs)
+        ] + [
+            tf.train.LoggingTensorHook(
+                tensors={
+                    "{}/{}".format(gan_synth.name, name): tensor
+                    for gan_synth in gan_synths
+                    for name, tensor in [
+                        ("global_step", gan_synth.global_step),
+                        ("generator_loss", gan_synth.generator_loss),
+                        ("discriminator_loss", gan_synth.discriminator_loss)
+                    ]
+                },
+                every_n_iter=log_tensor_steps,
+            ),
+            hooks.StartupHook()
+        ]
+    ) as session:
+
+        global_steps = session.raw_session().run([gan_synth.global_step for gan_synth in gan_synths])
+
+        while not session.should_stop():
+            # configurations resumed at different steps stop at `total_steps` one by one
+            active = [index for index, global_step in enumerate(global_steps) if global_step < total_steps]
+            if not active:
+                break
+            session.run([gan_synths[index].discriminator_train_op for index in active])
+            gradient_penalty_train_ops = [
+                gan_synths[index].gradient_penalty_train_op for index in active
+                if gan_synths[index].gradient_penalty_train_op is not None and global_steps[index] % gan_synths[index].gradient_penalty_interval == 0
+            ]
+            if gradient_penalty_train_ops:
+                session.run(gradient_penalty_train_ops)
+            session.run([
+                gan_synths[index].mode_seeking_train_op
+                if gan_synths[index].mode_seeking_train_op is not None and global_steps[index] % gan_synths[index].mode_seeking_loss_interval == 0
+                else gan_synths[index].generator_train_op
+                for index in active
+            ])
+            for index in active:
+                global_steps[index] += 1
+                if global_steps[index] % save_checkpoint_steps == 0 or global_steps[index] == total_steps:
+                    save(session.raw_session(), index, global_steps[index])
+
+
+def evaluation_statistics(real_features, fake_features, cluster_centers=None):
+    statistics = dict(
+        real_statistics=metrics.feature_statistics(real_features),
+        fake_statistics=metrics.feature_statistics(fake_features)
+    )
+    if cluster_centers is not None:
+        statistics.update(
+            real_bin_counts=metrics.bin_counts(real_features, cluster_centers),
+            fake_bin_counts=metrics.bin_counts(fake_features, cluster_centers)
+        )
+    return statistics
+
+
+def merge_evaluation_statistics(statistics, other_statistics):
+    # exact merge of the statistics of disjoint shards
+    merged_statistics = dict(
+        real_statistics=metrics.merge_feature_statistics(statistics["real_statistics"], other_statistics["real_statistics"]),
+        fake_statistics=metrics.merge_feature_statistics(statistics["fake_statistics"], other_statistics["fake_statistics"])
+    )
+    if "real_bin_counts" in statistics:
+        merged_statistics.update(
+            real_bin_counts=statistics["real_bin_counts"] + other_statistics["real_bin_counts"],
+            fake_bin_counts=statistics["fake_bin_counts"] + other_statistics["fake_bin_counts"]
+        )
+    return merged_statistics
+
+
+def evaluation_metrics(statistics):
+    if statistics["real_statistics"] is None or statistics["fake_statistics"] is None:
+        raise ValueError("No complete evaluation batch, the evaluation data is smaller than a batch")
+    results = dict(
+        frechet_inception_distance=metrics.frechet_inception_distance_from_statistics(
+            real_statistics=statistics["real_statistics"],
+            fake_statistics=statistics["fake_statistics"]
+        )
+    )
+    if "real_bin_counts" in statistics:
+        results.update(
+            num_different_bins=metrics.num_different_bins_from_counts(
+                real_counts=statistics["real_bin_counts"],
+                fake_counts=statistics["fake_bin_counts"]
+            )
+        )
+    for name, value in results.items():
+        tf.logging.info("{}: {}".format(name, value))
+    return results
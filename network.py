@@ -11,9 +11,28 @@ def lerp(a, b, t):
     return t * a + (1 - t) * b
 
 
+def cond(pred, true_fn, false_fn):
+    # resolved at graph construction time when the predicate is a python value
+    if isinstance(pred, (bool, np.bool_)):
+        return true_fn() if pred else false_fn()
+    return tf.cond(pred=pred, true_fn=true_fn, false_fn=false_fn)
+
+
+def recompute_grad(function):
+    # stores only the inputs and outputs of `function` and recomputes its activations during backprop,
+    # the second-order gradients of the penalties differentiate through the recomputation.
+    # custom gradients require resource variables, which are checkpointed the same as reference variables.
+    # the variable scope is re-entered without a new name scope
+    def wrapper(*inputs):
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True, auxiliary_name_scope=False):
+            return tf.contrib.layers.recompute_grad(function)(*inputs)
+    return wrapper
+
+
 class PGGAN(object):
 
-    def __init__(self, min_resolution, max_resolution, min_channels, max_channels, growing_level):
+    def __init__(self, min_resolution, max_resolution, min_channels, max_channels, growing_level,
+                 recompute_depths=(), data_format="NCHW"):
 
         self.min_resolution = np.asanyarray(min_resolution)
         self.max_resolution = np.asanyarray(max_resolution)
@@ -26,9 +45,41 @@ class PGGAN(object):
         self.min_depth = log2(self.min_resolution // self.min_resolution)
         self.max_depth = log2(self.max_resolution // self.min_resolution)
 
-        self.growing_depth = log(1 + ((1 << (self.max_depth + 1)) - 1) * self.growing_level, 2.0)
+        # a python growing level builds a static graph for a fixed growth stage without tf.cond
+        if isinstance(self.growing_level, (tf.Tensor, tf.Variable)):
+            self.growing_depth = log(1 + ((1 << (self.max_depth + 1)) - 1) * self.growing_level, 2.0)
+        else:
+            self.growing_depth = float(np.log2(1 + ((1 << (self.max_depth + 1)) - 1) * self.growing_level))
+
+        # activation recomputation (gradient checkpointing) for the conv blocks at these depths
+        self.recompute_depths = set(recompute_depths)
+
+        # internal layout of the feature maps, images are NCHW either way and the variables are the same,
+        # so that a model trained NCHW on GPU can be run NHWC on CPU
+        if data_format not in ("NCHW", "NHWC"):
+            raise ValueError("Unknown data format {}".format(data_format))
+        self.data_format = data_format
+
+    def recomputable(self, conv_block):
+        def wrapper(inputs, depth):
+            if depth in self.recompute_depths:
+                return recompute_grad(lambda inputs: conv_block(inputs, depth))(inputs)
+            return conv_block(inputs, depth)
+        return wrapper
+
+    def embed_labels(self, labels, units, name="generator", reuse=tf.AUTO_REUSE):
+        with tf.variable_scope(name, reuse=reuse):
+            return embedding(
+                inputs=labels,
+                units=units,
+                variance_scale=1,
+                scale_weight=True
+            )
 
-    def generator(self, latents, labels, name="generator", reuse=tf.AUTO_REUSE):
+    def generator(self, latents, labels, name="generator", reuse=tf.AUTO_REUSE, embedded_labels=False,
+                  intermediate_images=False):
+        # `labels` may be precomputed label embeddings (see `embed_labels`) to be reused across latents.
+        # with `intermediate_images` the images of every depth are returned instead (see `progressive_images`)
 
         def resolution(depth):
             return self.min_resolution << depth
@@ -36,6 +87,7 @@ class PGGAN(object):
         def channels(depth):
             return min(self.max_channels, self.min_channels << (self.max_depth - depth))
 
+        @self.recomputable
         def conv_block(inputs, depth, reuse=tf.AUTO_REUSE):
             with tf.variable_scope("conv_block_{}x{}".format(*resolution(depth)), reuse=reuse):
                 if depth == self.min_depth:
@@ -52,8 +104,9 @@ class PGGAN(object):
                             tensor=inputs,
                             shape=[-1, channels(depth), *resolution(depth)]
                         )
+                        inputs = from_nchw(inputs, self.data_format)
                         inputs = tf.nn.leaky_relu(inputs)
-                        inputs = pixel_norm(inputs)
+                        inputs = pixel_norm(inputs, data_format=self.data_format)
                     with tf.variable_scope("conv"):
                         inputs = conv2d(
                             inputs=inputs,
@@ -61,10 +114,11 @@ class PGGAN(object):
                             kernel_size=[3, 3],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
-                        inputs = pixel_norm(inputs)
+                        inputs = pixel_norm(inputs, data_format=self.data_format)
                     return inputs
                 else:
                     with tf.variable_scope("upscale_conv"):
@@ -75,10 +129,11 @@ class PGGAN(object):
                             strides=[2, 2],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
-                        inputs = pixel_norm(inputs)
+                        inputs = pixel_norm(inputs, data_format=self.data_format)
                     with tf.variable_scope("conv"):
                         inputs = conv2d(
                             inputs=inputs,
@@ -86,10 +141,11 @@ class PGGAN(object):
                             kernel_size=[3, 3],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
-                        inputs = pixel_norm(inputs)
+                        inputs = pixel_norm(inputs, data_format=self.data_format)
                     return inputs
 
         def color_block(inputs, depth, reuse=tf.AUTO_REUSE):
@@ -101,47 +157,56 @@ class PGGAN(object):
                         kernel_size=[1, 1],
                         use_bias=True,
                         variance_scale=1,
-                        scale_weight=True
+                        scale_weight=True,
+                        data_format=self.data_format
                     )
                     inputs = tf.nn.tanh(inputs)
                 return inputs
 
         def grow(feature_maps, depth):
 
+            # the conv block of this depth feeds both branches of the cond,
+            # so it is built once outside of it instead of once per branch
+            block_feature_maps = conv_block(feature_maps, depth)
+
             def high_resolution_images():
-                return grow(conv_block(feature_maps, depth), depth + 1)
+                return grow(block_feature_maps, depth + 1)
 
             def middle_resolution_images():
                 return upscale2d(
-                    inputs=color_block(conv_block(feature_maps, depth), depth),
-                    factors=resolution(self.max_depth) // resolution(depth)
+                    inputs=color_block(block_feature_maps, depth),
+                    factors=resolution(self.max_depth) // resolution(depth),
+                    data_format=self.data_format
                 )
 
             def low_resolution_images():
                 return upscale2d(
                     inputs=color_block(feature_maps, depth - 1),
-                    factors=resolution(self.max_depth) // resolution(depth - 1)
+                    factors=resolution(self.max_depth) // resolution(depth - 1),
+                    data_format=self.data_format
                 )
 
             if depth == self.min_depth:
-                images = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                images = cond(
+                    pred=self.growing_depth > depth,
                     true_fn=high_resolution_images,
                     false_fn=middle_resolution_images
                 )
             elif depth == self.max_depth:
-                images = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
-                    true_fn=middle_resolution_images,
+                # shared by both branches
+                middle_images = middle_resolution_images()
+                images = cond(
+                    pred=self.growing_depth > depth,
+                    true_fn=lambda: middle_images,
                     false_fn=lambda: lerp(
                         a=low_resolution_images(),
-                        b=middle_resolution_images(),
+                        b=middle_images,
                         t=depth - self.growing_depth
                     )
                 )
             else:
-                images = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                images = cond(
+                    pred=self.growing_depth > depth,
                     true_fn=high_resolution_images,
                     false_fn=lambda: lerp(
                         a=low_resolution_images(),
@@ -151,14 +216,27 @@ class PGGAN(object):
                 )
             return images
 
+        def progressive_images(feature_maps):
+            # the color block outputs of every depth upscaled to the max resolution, each one computed
+            # from the conv blocks up to its depth only. the last one is the output of the fully grown generator,
+            # the others come from color blocks last trained while their depth was being grown
+            images = []
+            for depth in range(self.min_depth, self.max_depth + 1):
+                feature_maps = conv_block(feature_maps, depth)
+                images.append(upscale2d(
+                    inputs=color_block(feature_maps, depth),
+                    factors=resolution(self.max_depth) // resolution(depth),
+                    data_format=self.data_format
+                ))
+            return images
+
+        if not embedded_labels:
+            labels = self.embed_labels(labels, latents.shape[1], name=name, reuse=reuse)
+
         with tf.variable_scope(name, reuse=reuse):
-            labels = embedding(
-                inputs=labels,
-                units=latents.shape[1],
-                variance_scale=1,
-                scale_weight=True
-            )
-            return grow(tf.concat([latents, labels], axis=1), self.min_depth)
+            if intermediate_images:
+                return [to_nchw(images, self.data_format) for images in progressive_images(tf.concat([latents, labels], axis=1))]
+            return to_nchw(grow(tf.concat([latents, labels], axis=1), self.min_depth), self.data_format)
 
     def discriminator(self, images, labels, name="discriminator", reuse=tf.AUTO_REUSE):
 
@@ -168,10 +246,11 @@ class PGGAN(object):
         def channels(depth):
             return min(self.max_channels, self.min_channels << (self.max_depth - depth))
 
+        @self.recomputable
         def conv_block(inputs, depth, reuse=tf.AUTO_REUSE):
             with tf.variable_scope("conv_block_{}x{}".format(*resolution(depth)), reuse=reuse):
                 if depth == self.min_depth:
-                    inputs = tf.concat([inputs, batch_stddev(inputs)], axis=1)
+                    inputs = tf.concat([inputs, batch_stddev(inputs, data_format=self.data_format)], axis=channels_axis(self.data_format))
                     with tf.variable_scope("conv"):
                         inputs = conv2d(
                             inputs=inputs,
@@ -179,11 +258,13 @@ class PGGAN(object):
                             kernel_size=[3, 3],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
                     with tf.variable_scope("dense"):
-                        inputs = tf.layers.flatten(inputs)
+                        # flattened in NCHW order, as the dense weights are laid out
+                        inputs = tf.layers.flatten(to_nchw(inputs, self.data_format))
                         features = dense(
                             inputs=inputs,
                             units=channels(depth - 1),
@@ -216,7 +297,8 @@ class PGGAN(object):
                             kernel_size=[3, 3],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
                     with tf.variable_scope("conv_downscale"):
@@ -227,7 +309,8 @@ class PGGAN(object):
                             strides=[2, 2],
                             use_bias=True,
                             variance_scale=2,
-                            scale_weight=True
+                            scale_weight=True,
+                            data_format=self.data_format
                         )
                         inputs = tf.nn.leaky_relu(inputs)
                     return inputs
@@ -241,47 +324,59 @@ class PGGAN(object):
                         kernel_size=[1, 1],
                         use_bias=True,
                         variance_scale=2,
-                        scale_weight=True
+                        scale_weight=True,
+                        data_format=self.data_format
                     )
                     inputs = tf.nn.leaky_relu(inputs)
                 return inputs
 
         def grow(images, depth):
 
+            def high_resolution_color_maps():
+                return grow(images, depth + 1)
+
+            def middle_resolution_color_maps():
+                return color_block(downscale2d(
+                    inputs=images,
+                    factors=resolution(self.max_depth) // resolution(depth),
+                    data_format=self.data_format
+                ), depth)
+
             def high_resolution_feature_maps():
-                return conv_block(grow(images, depth + 1), depth)
+                return conv_block(high_resolution_color_maps(), depth)
 
             def middle_resolution_feature_maps():
-                return conv_block(color_block(downscale2d(
-                    inputs=images,
-                    factors=resolution(self.max_depth) // resolution(depth)
-                ), depth), depth)
+                return conv_block(middle_resolution_color_maps(), depth)
 
             def low_resolution_feature_maps():
                 return color_block(downscale2d(
                     inputs=images,
-                    factors=resolution(self.max_depth) // resolution(depth - 1)
+                    factors=resolution(self.max_depth) // resolution(depth - 1),
+                    data_format=self.data_format
                 ), depth - 1)
 
             if depth == self.min_depth:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
-                    true_fn=high_resolution_feature_maps,
-                    false_fn=middle_resolution_feature_maps
-                )
+                # both branches end in the conv block of this depth, which is built once after the cond
+                feature_maps = conv_block(cond(
+                    pred=self.growing_depth > depth,
+                    true_fn=high_resolution_color_maps,
+                    false_fn=middle_resolution_color_maps
+                ), depth)
             elif depth == self.max_depth:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
-                    true_fn=middle_resolution_feature_maps,
+                # shared by both branches
+                middle_feature_maps = middle_resolution_feature_maps()
+                feature_maps = cond(
+                    pred=self.growing_depth > depth,
+                    true_fn=lambda: middle_feature_maps,
                     false_fn=lambda: lerp(
                         a=low_resolution_feature_maps(),
-                        b=middle_resolution_feature_maps(),
+                        b=middle_feature_maps,
                         t=depth - self.growing_depth
                     )
                 )
             else:
-                feature_maps = tf.cond(
-                    pred=tf.greater(self.growing_depth, depth),
+                feature_maps = cond(
+                    pred=self.growing_depth > depth,
                     true_fn=high_resolution_feature_maps,
                     false_fn=lambda: lerp(
                         a=low_resolution_feature_maps(),
@@ -292,4 +387,4 @@ class PGGAN(object):
             return feature_maps
 
         with tf.variable_scope(name, reuse=reuse):
-            return grow(images, self.min_depth)
+            return grow(from_nchw(images, self.data_format), self.min_depth)
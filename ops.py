@@ -1,5 +1,19 @@
 import tensorflow as tf
 import numpy as np
+import contextlib
+
+
+def channels_axis(data_format):
+    return 1 if data_format == "NCHW" else -1
+
+
+def from_nchw(inputs, data_format):
+    # the networks take and return NCHW images and may run NHWC internally (stock CPU kernels support only NHWC)
+    return inputs if data_format == "NCHW" else tf.transpose(inputs, [0, 2, 3, 1])
+
+
+def to_nchw(inputs, data_format):
+    return inputs if data_format == "NCHW" else tf.transpose(inputs, [0, 3, 1, 2])
 
 
 def get_weight(shape, variance_scale=2, scale_weight=False):
@@ -42,71 +56,79 @@ def dense(inputs, units, use_bias=True, variance_scale=2, scale_weight=False):
 
 
 def conv2d(inputs, filters, kernel_size, strides=[1, 1], use_bias=True,
-           variance_scale=2, scale_weight=True):
+           variance_scale=2, scale_weight=True, data_format="NCHW"):
     weight = get_weight(
-        shape=[*kernel_size, inputs.shape[1].value, filters],
+        shape=[*kernel_size, inputs.shape[channels_axis(data_format)].value, filters],
         variance_scale=variance_scale,
         scale_weight=scale_weight
     )
     inputs = tf.nn.conv2d(
         input=inputs,
         filter=weight,
-        strides=[1, 1] + strides,
+        strides=[1, 1] + strides if data_format == "NCHW" else [1] + strides + [1],
         padding="SAME",
-        data_format="NCHW"
+        data_format=data_format
     )
     if use_bias:
-        bias = get_bias([inputs.shape[1].value])
-        inputs = tf.nn.bias_add(inputs, bias, data_format="NCHW")
+        bias = get_bias([inputs.shape[channels_axis(data_format)].value])
+        inputs = tf.nn.bias_add(inputs, bias, data_format=data_format)
     return inputs
 
 
 def conv2d_transpose(inputs, filters, kernel_size, strides=[1, 1], use_bias=True,
-                     variance_scale=2, scale_weight=True):
+                     variance_scale=2, scale_weight=True, data_format="NCHW"):
     weight = get_weight(
-        shape=[*kernel_size, inputs.shape[1].value, filters],
+        shape=[*kernel_size, inputs.shape[channels_axis(data_format)].value, filters],
         variance_scale=variance_scale,
         scale_weight=scale_weight
     )
     weight = tf.transpose(weight, [0, 1, 3, 2])
     input_shape = np.array(inputs.shape.as_list())
-    output_shape = [input_shape[0], filters, *input_shape[2:] * strides]
+    if data_format == "NCHW":
+        output_shape = [input_shape[0], filters, *input_shape[2:] * strides]
+    else:
+        output_shape = [input_shape[0], *input_shape[1:3] * strides, filters]
     inputs = tf.nn.conv2d_transpose(
         value=inputs,
         filter=weight,
         output_shape=output_shape,
-        strides=[1, 1] + strides,
+        strides=[1, 1] + strides if data_format == "NCHW" else [1] + strides + [1],
         padding="SAME",
-        data_format="NCHW"
+        data_format=data_format
     )
     if use_bias:
-        bias = get_bias([inputs.shape[1].value])
-        inputs = tf.nn.bias_add(inputs, bias, data_format="NCHW")
+        bias = get_bias([inputs.shape[channels_axis(data_format)].value])
+        inputs = tf.nn.bias_add(inputs, bias, data_format=data_format)
     return inputs
 
 
-def upscale2d(inputs, factors=[2, 2]):
+def upscale2d(inputs, factors=[2, 2], data_format="NCHW"):
     factors = np.asanyarray(factors)
     if (factors == 1).all():
         return inputs
     shape = inputs.shape.as_list()
-    inputs = tf.reshape(inputs, [-1, shape[1], shape[2], 1, shape[3], 1])
-    inputs = tf.tile(inputs, [1, 1, 1, factors[0], 1, factors[1]])
-    inputs = tf.reshape(inputs, [-1, shape[1], shape[2] * factors[0], shape[3] * factors[1]])
+    if data_format == "NCHW":
+        inputs = tf.reshape(inputs, [-1, shape[1], shape[2], 1, shape[3], 1])
+        inputs = tf.tile(inputs, [1, 1, 1, factors[0], 1, factors[1]])
+        inputs = tf.reshape(inputs, [-1, shape[1], shape[2] * factors[0], shape[3] * factors[1]])
+    else:
+        inputs = tf.reshape(inputs, [-1, shape[1], 1, shape[2], 1, shape[3]])
+        inputs = tf.tile(inputs, [1, 1, factors[0], 1, factors[1], 1])
+        inputs = tf.reshape(inputs, [-1, shape[1] * factors[0], shape[2] * factors[1], shape[3]])
     return inputs
 
 
-def downscale2d(inputs, factors=[2, 2]):
+def downscale2d(inputs, factors=[2, 2], data_format="NCHW"):
     # NOTE: requires tf_config["graph_options.place_pruned_graph"] = True
     factors = np.asanyarray(factors)
     if (factors == 1).all():
         return inputs
     inputs = tf.nn.avg_pool(
         value=inputs,
-        ksize=[1, 1, *factors],
-        strides=[1, 1, *factors],
+        ksize=[1, 1, *factors] if data_format == "NCHW" else [1, *factors, 1],
+        strides=[1, 1, *factors] if data_format == "NCHW" else [1, *factors, 1],
         padding="SAME",
-        data_format="NCHW"
+        data_format=data_format
     )
     return inputs
 
@@ -121,12 +143,12 @@ def embedding(inputs, units, variance_scale=2, scale_weight=False):
     return inputs
 
 
-def pixel_norm(inputs, epsilon=1e-8):
-    inputs *= tf.rsqrt(tf.reduce_mean(tf.square(inputs), axis=1, keepdims=True) + epsilon)
+def pixel_norm(inputs, epsilon=1e-8, data_format="NCHW"):
+    inputs *= tf.rsqrt(tf.reduce_mean(tf.square(inputs), axis=channels_axis(data_format), keepdims=True) + epsilon)
     return inputs
 
 
-def batch_stddev(inputs, group_size=4, epsilon=1e-8):
+def batch_stddev(inputs, group_size=4, epsilon=1e-8, data_format="NCHW"):
     shape = inputs.shape.as_list()
     inputs = tf.reshape(inputs, [group_size, -1, *shape[1:]])
     inputs -= tf.reduce_mean(inputs, axis=0, keepdims=True)
@@ -134,5 +156,18 @@ def batch_stddev(inputs, group_size=4, epsilon=1e-8):
     inputs = tf.reduce_mean(inputs, axis=0)
     inputs = tf.sqrt(inputs + epsilon)
     inputs = tf.reduce_mean(inputs, axis=[1, 2, 3], keepdims=True)
-    inputs = tf.tile(inputs, [group_size, 1, *shape[2:]])
+    if data_format == "NCHW":
+        inputs = tf.tile(inputs, [group_size, 1, *shape[2:]])
+    else:
+        inputs = tf.tile(inputs, [group_size, *shape[1:3], 1])
     return inputs
+
+
+def jit_scope(compile_ops=True):
+    # XLA JIT compilation of the ops built within the scope, a no-op when disabled
+    if not compile_ops:
+        return contextlib.suppress()
+    return tf.contrib.compiler.jit.experimental_jit_scope(
+        compile_ops=True,
+        separate_compiled_gradients=True
+    )
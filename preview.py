@@ -0,0 +1,219 @@
+#=================================================================================================#
+# Adaptive real-time preview synthesis with GANSynth
+#
+# the generator is built progressively (see `PGGAN.generator` with `intermediate_images`),
+# so that a note can be rendered from the color block of any depth, upscaled to the full resolution
+# and converted with convert_to_waveforms, running only the conv blocks up to that depth.
+# the latency of every depth is measured on each preview run, a preview is rendered at the deepest depth
+# expected to meet the deadline, and the full resolution note follows asynchronously.
+# the generator runs NHWC by default, as stock CPU builds of tensorflow have no NCHW conv kernels
+#
+# usage:
+# python preview.py --model_dir gan_synth_model --output_dir preview --deadlines 0.05 0.2 1.0
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import concurrent.futures
+import collections
+import argparse
+import time
+import os
+import spectral_ops
+from interpolation import write_wav
+from network import PGGAN
+from utils import Struct
+
+
+class PreviewSynthesizer(object):
+
+    def __init__(self, pggan, model_dir, batch_size, latent_size, num_labels, spectral_params,
+                 preview_depths=None, num_threads=None, smoothing=0.2):
+
+        self.batch_size = batch_size
+        self.latent_size = latent_size
+        self.num_labels = num_labels
+        self.max_depth = pggan.max_depth
+        # the full resolution is always available as the last stage
+        self.depths = sorted(set(range(pggan.min_depth, pggan.max_depth) if preview_depths is None else preview_depths) | {pggan.max_depth})
+        if self.depths[0] < pggan.min_depth or self.depths[-1] > pggan.max_depth:
+            raise ValueError("Preview depths must be between {} and {}".format(pggan.min_depth, pggan.max_depth))
+        # weight of the latest measurement in the running latency estimates
+        self.smoothing = smoothing
+
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+
+            self.latents = tf.placeholder(tf.float32, [batch_size, latent_size])
+            self.labels = tf.placeholder(tf.float32, [batch_size, num_labels])
+            images = pggan.generator(self.latents, self.labels, intermediate_images=True)
+
+            self.images = {}
+            self.waveforms = {}
+            for depth in self.depths:
+                self.images[depth] = images[depth - pggan.min_depth]
+                magnitude_spectrograms, instantaneous_frequencies = tf.unstack(self.images[depth], axis=1)
+                with tf.name_scope("convert_to_waveforms_{}".format(depth)):
+                    self.waveforms[depth] = spectral_ops.convert_to_waveforms(magnitude_spectrograms, instantaneous_frequencies, **spectral_params)
+
+            saver = tf.train.Saver(var_list=tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope="generator"))
+
+        self.session = tf.Session(
+            graph=self.graph,
+            config=tf.ConfigProto(
+                intra_op_parallelism_threads=num_threads or 0,
+                inter_op_parallelism_threads=num_threads or 0
+            )
+        )
+        saver.restore(self.session, tf.train.latest_checkpoint(model_dir))
+
+        # seconds per batch of each depth, measured on every preview run
+        self.latencies = {}
+        # seconds per batch of the most recent full resolution notes rendered in the background, kept apart
+        # since they contend with the previews and do not reflect the latency of a preview
+        self.background_latencies = collections.deque(maxlen=100)
+        # the full resolution notes are rendered one request at a time behind the previews
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def run(self, fetches, latents, labels):
+        # runs fixed-size batches, padding the last one
+        latents = np.asanyarray(latents, dtype=np.float32)
+        labels = np.eye(self.num_labels, dtype=np.float32)[np.asanyarray(labels)]
+        outputs = []
+        for begin in range(0, len(latents), self.batch_size):
+            end = min(begin + self.batch_size, len(latents))
+            padding = [[0, self.batch_size - (end - begin)], [0, 0]]
+            output = self.session.run(fetches, feed_dict={
+                self.latents: np.pad(latents[begin:end], padding, mode="constant"),
+                self.labels: np.pad(labels[begin:end], padding, mode="constant")
+            })
+            outputs.append(output[:end - begin])
+        return np.concatenate(outputs)
+
+    def num_batches(self, num_notes):
+        return -(-num_notes // self.batch_size)
+
+    def synthesize(self, latents, labels, depth, background=False):
+        begin = time.time()
+        waveforms = self.run(self.waveforms[depth], latents, labels)
+        latency = (time.time() - begin) / self.num_batches(len(latents))
+        if background:
+            self.background_latencies.append(latency)
+            return waveforms
+        if depth in self.latencies:
+            latency = self.smoothing * latency + (1 - self.smoothing) * self.latencies[depth]
+        self.latencies[depth] = latency
+        return waveforms
+
+    def calibrate(self, num_runs=3):
+        # initial latency estimates from random notes, the first run of each depth is discarded as warmup
+        random = np.random.RandomState(0)
+        latents = random.normal(size=[self.batch_size, self.latent_size])
+        labels = random.randint(0, self.num_labels, size=[self.batch_size])
+        for depth in self.depths:
+            self.run(self.waveforms[depth], latents, labels)
+            generator_times, total_times = [], []
+            for _ in range(num_runs):
+                begin = time.time()
+                self.run(self.images[depth], latents, labels)
+                generator_times.append(time.time() - begin)
+                begin = time.time()
+                self.run(self.waveforms[depth], latents, labels)
+                total_times.append(time.time() - begin)
+            self.latencies[depth] = float(np.median(total_times))
+            tf.logging.info("depth {}: {:.3f}s per batch of {} ({:.3f}s generator, {:.3f}s convert_to_waveforms)".format(
+                depth, self.latencies[depth], self.batch_size, np.median(generator_times), self.latencies[depth] - np.median(generator_times)
+            ))
+
+    def select_depth(self, num_notes, deadline):
+        # the deepest depth expected to meet the deadline, or the shallowest one if none does
+        num_batches = self.num_batches(num_notes)
+        depths = [depth for depth in self.depths if self.latencies.get(depth, np.inf) * num_batches <= deadline]
+        return max(depths) if depths else self.depths[0]
+
+    def preview(self, latents, labels, deadline):
+        # a preview within `deadline` seconds if possible, and a future of the full resolution notes
+        # (None if the preview already is at the full resolution)
+        begin = time.time()
+        depth = self.select_depth(len(latents), deadline)
+        waveforms = self.synthesize(latents, labels, depth)
+        latency = time.time() - begin
+        if latency > deadline:
+            tf.logging.warning("preview at depth {} missed the deadline of {:.3f}s by {:.3f}s".format(depth, deadline, latency - deadline))
+        full_waveforms = self.executor.submit(self.synthesize, latents, labels, self.max_depth, background=True) if depth < self.max_depth else None
+        return Struct(
+            depth=depth,
+            waveforms=waveforms,
+            latency=latency,
+            full_waveforms=full_waveforms
+        )
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", type=str, default="gan_synth_model")
+    parser.add_argument("--output_dir", type=str, default="preview")
+    parser.add_argument("--deadlines", type=float, nargs="+", default=[0.05, 0.2, 1.0])
+    parser.add_argument("--preview_depths", type=int, nargs="*", default=None)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_notes", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--data_format", type=str, default="NHWC", choices=["NHWC", "NCHW"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    pitches = range(24, 85)
+
+    spectral_params = Struct(
+        waveform_length=64000,
+        sample_rate=16000,
+        spectrogram_shape=[128, 1024],
+        overlap=0.75
+    )
+
+    synthesizer = PreviewSynthesizer(
+        pggan=PGGAN(
+            min_resolution=[2, 16],
+            max_resolution=[128, 1024],
+            min_channels=32,
+            max_channels=256,
+            growing_level=1.0,
+            data_format=args.data_format
+        ),
+        model_dir=args.model_dir,
+        batch_size=args.batch_size,
+        latent_size=256,
+        num_labels=len(pitches),
+        spectral_params=spectral_params,
+        preview_depths=args.preview_depths,
+        num_threads=args.num_threads
+    )
+    synthesizer.calibrate()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    random = np.random.RandomState(args.seed)
+    latents = random.normal(size=[args.num_notes, 256])
+    labels = random.randint(0, len(pitches), size=[args.num_notes])
+
+    for deadline in args.deadlines:
+        begin = time.time()
+        result = synthesizer.preview(latents, labels, deadline)
+        tf.logging.info("deadline {:.3f}s: preview at depth {} in {:.3f}s".format(deadline, result.depth, result.latency))
+        for index, waveform in enumerate(result.waveforms):
+            write_wav(os.path.join(args.output_dir, "deadline_{}_note_{}_depth_{}.wav".format(deadline, index, result.depth)), waveform, spectral_params.sample_rate)
+        if result.full_waveforms:
+            for index, waveform in enumerate(result.full_waveforms.result()):
+                write_wav(os.path.join(args.output_dir, "deadline_{}_note_{}_full.wav".format(deadline, index)), waveform, spectral_params.sample_rate)
+            tf.logging.info("deadline {:.3f}s: full resolution after {:.3f}s".format(deadline, time.time() - begin))
+
+    synthesizer.close()
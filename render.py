@@ -0,0 +1,184 @@
+#=================================================================================================#
+# Streaming long-form rendering of note sequences with GANSynth
+#
+# note sequences are text files with one note per line:
+# pitch onset duration velocity latent_id
+# (onset and duration in seconds, lines starting with # are ignored)
+# sorted by onset, so that the notes can be read as they are rendered
+#
+# every unique (pitch, latent_id) note is synthesized once by the frozen generator (see inference.py),
+# kept in an LRU note cache and mixed into the output by overlap-add,
+# writing the output block by block so that memory does not grow with the length of the piece
+#
+# usage:
+# python render.py --filename generator.pb --notes notes.txt --output output.wav
+#=================================================================================================#
+
+import tensorflow as tf
+import numpy as np
+import collections
+import argparse
+import wave
+from inference import Synthesizer
+from inference import load_graph_def
+from utils import Struct
+
+
+def read_notes(filename):
+    # yields the notes one by one, an out of order onset is an error rather than being sorted in memory
+    with open(filename) as file:
+        last_onset = float("-inf")
+        for line_number, line in enumerate(file, 1):
+            if not line.strip() or line.startswith("#"):
+                continue
+            pitch, onset, duration, velocity, latent_id = line.split()
+            note = Struct(
+                pitch=int(pitch),
+                onset=float(onset),
+                duration=float(duration),
+                velocity=int(velocity),
+                latent_id=int(latent_id)
+            )
+            if note.onset < last_onset:
+                raise ValueError("{}:{}: notes must be sorted by onset, {} follows {}".format(filename, line_number, note.onset, last_onset))
+            last_onset = note.onset
+            yield note
+
+
+class NoteCache(object):
+    # LRU cache of synthesized notes, keyed by (pitch, latent_id)
+
+    def __init__(self, synthesizer, pitches, capacity):
+        self.synthesizer = synthesizer
+        self.pitches = sorted(pitches)
+        self.capacity = capacity
+        self.waveforms = collections.OrderedDict()
+        self.num_synthesized_notes = 0
+
+    def latent(self, latent_id):
+        return np.random.RandomState(latent_id).normal(size=[self.synthesizer.latent_size])
+
+    def prefetch(self, keys):
+        # synthesizes all the missing notes in as few generator runs as possible
+        keys = [key for key in collections.OrderedDict.fromkeys(keys) if key not in self.waveforms]
+        if not keys:
+            return
+        if len(keys) > self.capacity:
+            tf.logging.warning("{} notes requested at once, but the note cache holds only {}".format(len(keys), self.capacity))
+        waveforms = self.synthesizer.synthesize(
+            latents=[self.latent(latent_id) for pitch, latent_id in keys],
+            labels=[self.pitches.index(pitch) for pitch, latent_id in keys]
+        )
+        self.num_synthesized_notes += len(keys)
+        for key, waveform in zip(keys, waveforms):
+            self.waveforms[key] = waveform
+            if len(self.waveforms) > self.capacity:
+                self.waveforms.popitem(last=False)
+
+    def __getitem__(self, key):
+        if key not in self.waveforms:
+            self.prefetch([key])
+        self.waveforms.move_to_end(key)
+        return self.waveforms[key]
+
+
+def render(synthesizer, notes, filename, sample_rate, pitches, cache_size=256, block_size=16000,
+           lookahead=10.0, release=0.05, gain=0.5):
+
+    # `notes` may be any iterable sorted by onset, it is consumed as the output is written
+    notes = (note for note in notes if note.pitch in pitches and note.onset >= 0)
+    cache = NoteCache(synthesizer, pitches, cache_size)
+
+    note_length = synthesizer.waveforms.shape[1].value
+    release_length = int(release * sample_rate)
+    # holds everything from the current block up to the end of a note starting in it
+    buffer = np.zeros(block_size + note_length, dtype=np.float32)
+    position = 0
+    # notes read but not yet mixed, the first `num_prefetched` of them already synthesized in a batch
+    pending = collections.deque()
+    num_prefetched = 0
+    num_notes = 0
+    end = 0
+
+    def read_ahead(limit):
+        # reads up to the first note starting at or after `limit` samples
+        while not pending or pending[-1].onset * sample_rate < limit:
+            note = next(notes, None)
+            if note is None:
+                return
+            pending.append(note)
+
+    with wave.open(filename, "wb") as file:
+
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(sample_rate)
+
+        while True:
+            # batch all the notes starting within the lookahead window
+            if not num_prefetched:
+                read_ahead(position + lookahead * sample_rate)
+                window = [note for note in pending if note.onset * sample_rate < position + lookahead * sample_rate]
+                cache.prefetch([(note.pitch, note.latent_id) for note in window])
+                num_prefetched = len(window)
+            read_ahead(position + block_size)
+            if not pending and position >= end:
+                break
+            # overlap-add the notes starting within the current block
+            while pending and int(pending[0].onset * sample_rate) < position + block_size:
+                note = pending.popleft()
+                num_prefetched = max(num_prefetched - 1, 0)
+                waveform = cache[note.pitch, note.latent_id]
+                length = min(int(note.duration * sample_rate) + release_length, note_length)
+                waveform = waveform[:length] * (note.velocity / 127)
+                if release_length:
+                    waveform[-release_length:] *= np.linspace(1, 0, len(waveform[-release_length:]))
+                offset = int(note.onset * sample_rate) - position
+                buffer[offset:offset + length] += waveform
+                end = max(end, int(note.onset * sample_rate) + note_length)
+                num_notes += 1
+            # write out the completed block, the last one up to the end of the last note
+            length = block_size if pending else min(block_size, end - position)
+            file.writeframes((np.clip(buffer[:length] * gain, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+            buffer = np.roll(buffer, -block_size)
+            buffer[-block_size:] = 0
+            position += block_size
+
+    tf.logging.info("rendered {} notes with {} generator notes".format(num_notes, cache.num_synthesized_notes))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filename", type=str, default="generator.pb")
+    parser.add_argument("--notes", type=str, default="notes.txt")
+    parser.add_argument("--output", type=str, default="output.wav")
+    parser.add_argument("--cache_size", type=int, default=256)
+    parser.add_argument("--lookahead", type=float, default=10.0)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    synthesizer = Synthesizer(
+        graph_def=load_graph_def(args.filename),
+        spectral_params=Struct(
+            waveform_length=64000,
+            sample_rate=16000,
+            spectrogram_shape=[128, 1024],
+            overlap=0.75
+        ),
+        num_threads=args.num_threads
+    )
+
+    render(
+        synthesizer=synthesizer,
+        notes=read_notes(args.notes),
+        filename=args.output,
+        sample_rate=16000,
+        pitches=range(24, 85),
+        cache_size=args.cache_size,
+        lookahead=args.lookahead
+    )
+
+    synthesizer.close()
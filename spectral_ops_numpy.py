@@ -0,0 +1,284 @@
+#=================================================================================================#
+# NumPy implementation of spectral_ops for offline pre- and post-processing
+#
+# batched and vectorized, mirrors tf.signal (periodic hann window, power-of-2 fft length,
+# HTK mel weight matrix without the DC bin, pseudo-inverse cutoff of tfp.math.pinv)
+# in float32 so that the outputs agree with the TensorFlow graph up to rounding.
+# windows and mel matrices are computed once per process and cached (read-only),
+# there is no other state, so the functions are safe to run across a process pool.
+#
+# usage (agreement check against spectral_ops, asserts explicit tolerances, skipped without TensorFlow):
+# python spectral_ops_numpy.py --batch_size 4
+#=================================================================================================#
+
+import numpy as np
+import functools
+import argparse
+import sys
+
+
+def diff(inputs, axis=-1):
+    return np.diff(inputs, axis=axis)
+
+
+def unwrap(phases, discont=np.pi, axis=-1):
+
+    diffs = diff(phases, axis=axis)
+    mods = np.mod(diffs + np.pi, 2 * np.pi) - np.pi
+    indices = np.logical_and(np.equal(mods, -np.pi), np.greater(diffs, 0))
+    mods = np.where(indices, np.pi, mods).astype(phases.dtype)
+    corrects = mods - diffs
+    cumsums = np.cumsum(corrects, axis=axis)
+
+    shape = list(phases.shape)
+    shape[axis] = 1
+
+    cumsums = np.concatenate([np.zeros(shape, dtype=cumsums.dtype), cumsums], axis=axis)
+
+    return phases + cumsums
+
+
+def instantaneous_frequency(phases, axis=-2):
+
+    unwrapped = unwrap(phases, axis=axis)
+    diffs = diff(unwrapped, axis=axis)
+
+    unwrapped = np.take(unwrapped, [0], axis=axis)
+    diffs = np.concatenate([unwrapped, diffs], axis=axis) / np.float32(np.pi)
+
+    return diffs
+
+
+@functools.lru_cache(maxsize=None)
+def hann_window(frame_length):
+    # periodic hann window as tf.signal.hann_window(periodic=True)
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)).astype(np.float32)
+    window.setflags(write=False)
+    return window
+
+
+@functools.lru_cache(maxsize=None)
+def inverse_stft_window(frame_length, frame_step):
+    # as tf.signal.inverse_stft_window_fn
+    forward_window = hann_window(frame_length)
+    overlaps = -(-frame_length // frame_step)
+    denominator = np.pad(np.square(forward_window), [0, overlaps * frame_step - frame_length], mode="constant")
+    denominator = np.tile(np.sum(denominator.reshape([overlaps, frame_step]), axis=0), overlaps)
+    window = (forward_window / denominator[:frame_length]).astype(np.float32)
+    window.setflags(write=False)
+    return window
+
+
+@functools.lru_cache(maxsize=None)
+def linear_to_mel_weight_matrix(num_mel_bins, num_spectrogram_bins, sample_rate, lower_edge_hertz, upper_edge_hertz):
+    # as tf.signal.linear_to_mel_weight_matrix, HTK mel scale excluding the DC bin
+
+    def hertz_to_mel(frequencies_hertz):
+        return 1127.0 * np.log(1.0 + frequencies_hertz / 700.0)
+
+    bands_to_zero = 1
+    nyquist_hertz = sample_rate / 2.0
+    linear_frequencies = np.linspace(0.0, nyquist_hertz, num_spectrogram_bins, dtype=np.float32)[bands_to_zero:]
+    spectrogram_bins_mel = hertz_to_mel(linear_frequencies)[:, np.newaxis]
+    band_edges_mel = np.linspace(
+        hertz_to_mel(np.float32(lower_edge_hertz)),
+        hertz_to_mel(np.float32(upper_edge_hertz)),
+        num_mel_bins + 2,
+        dtype=np.float32
+    )
+    lower_edge_mel = band_edges_mel[np.newaxis, :-2]
+    center_mel = band_edges_mel[np.newaxis, 1:-1]
+    upper_edge_mel = band_edges_mel[np.newaxis, 2:]
+    lower_slopes = (spectrogram_bins_mel - lower_edge_mel) / (center_mel - lower_edge_mel)
+    upper_slopes = (upper_edge_mel - spectrogram_bins_mel) / (upper_edge_mel - center_mel)
+    matrix = np.maximum(0.0, np.minimum(lower_slopes, upper_slopes)).astype(np.float32)
+    matrix = np.pad(matrix, [[bands_to_zero, 0], [0, 0]], mode="constant")
+    matrix.setflags(write=False)
+    return matrix
+
+
+@functools.lru_cache(maxsize=None)
+def mel_to_linear_weight_matrix(num_mel_bins, num_spectrogram_bins, sample_rate, lower_edge_hertz, upper_edge_hertz):
+    # pseudo-inverse with the default cutoff of tfp.math.pinv
+    matrix = linear_to_mel_weight_matrix(num_mel_bins, num_spectrogram_bins, sample_rate, lower_edge_hertz, upper_edge_hertz)
+    rcond = 10 * max(matrix.shape) * np.finfo(np.float32).eps
+    matrix = np.linalg.pinv(matrix, rcond=rcond).astype(np.float32)
+    matrix.setflags(write=False)
+    return matrix
+
+
+def stft(signals, frame_length, frame_step):
+    # as tf.signal.stft with a periodic hann window and the smallest power-of-2 fft length
+    fft_length = 1 << int(np.ceil(np.log2(frame_length)))
+    num_frames = 1 + (signals.shape[-1] - frame_length) // frame_step
+    indices = np.arange(frame_length)[np.newaxis, :] + frame_step * np.arange(num_frames)[:, np.newaxis]
+    frames = signals[..., indices] * hann_window(frame_length)
+    return np.fft.rfft(frames, n=fft_length).astype(np.complex64)
+
+
+def inverse_stft(stfts, frame_length, frame_step):
+    # as tf.signal.inverse_stft with tf.signal.inverse_stft_window_fn
+    fft_length = 1 << int(np.ceil(np.log2(frame_length)))
+    frames = np.fft.irfft(stfts, n=fft_length)[..., :frame_length].astype(np.float32)
+    frames *= inverse_stft_window(frame_length, frame_step)
+    # overlap-add of the frames split into `frame_step` segments, as tf.signal.overlap_and_add
+    *batch_shape, num_frames, _ = frames.shape
+    overlaps = -(-frame_length // frame_step)
+    frames = np.pad(frames, [[0, 0]] * len(batch_shape) + [[0, 0], [0, overlaps * frame_step - frame_length]], mode="constant")
+    segments = frames.reshape([*batch_shape, num_frames, overlaps, frame_step])
+    signals = np.zeros([*batch_shape, num_frames + overlaps - 1, frame_step], dtype=np.float32)
+    for overlap in range(overlaps):
+        signals[..., overlap:overlap + num_frames, :] += segments[..., overlap, :]
+    signals = signals.reshape([*batch_shape, -1])
+    return signals[..., :frame_step * (num_frames - 1) + frame_length]
+
+
+def convert_to_spectrograms(waveforms, waveform_length, sample_rate, spectrogram_shape, overlap):
+
+    def normalize(inputs, mean, std):
+        return (inputs - mean) / std
+    # =========================================================================================
+    time_steps, num_freq_bins = spectrogram_shape
+    frame_length = num_freq_bins * 2
+    frame_step = int((1 - overlap) * frame_length)
+    num_samples = frame_step * (time_steps - 1) + frame_length
+    # =========================================================================================
+    # For Nsynth dataset, we are putting all padding in the front
+    # This causes edge effects in the tail
+    waveforms = np.asanyarray(waveforms, dtype=np.float32)
+    waveforms = np.pad(waveforms, [[0, 0], [num_samples - waveform_length, 0]], mode="constant")
+    # =========================================================================================
+    stfts = stft(waveforms, frame_length, frame_step)
+    # =========================================================================================
+    # discard_dc
+    stfts = stfts[..., 1:]
+    # =========================================================================================
+    magnitude_spectrograms = np.abs(stfts)
+    phase_spectrograms = np.angle(stfts).astype(np.float32)
+    # =========================================================================================
+    weight_matrix = linear_to_mel_weight_matrix(num_freq_bins, num_freq_bins, sample_rate, 0, sample_rate / 2)
+    mel_magnitude_spectrograms = np.matmul(magnitude_spectrograms, weight_matrix)
+    mel_phase_spectrograms = np.matmul(phase_spectrograms, weight_matrix)
+    # =========================================================================================
+    log_mel_magnitude_spectrograms = np.log(mel_magnitude_spectrograms + np.float32(1e-6))
+    mel_instantaneous_frequencies = instantaneous_frequency(mel_phase_spectrograms)
+    # =========================================================================================
+    log_mel_magnitude_spectrograms = normalize(log_mel_magnitude_spectrograms, -4, 10).astype(np.float32)
+    mel_instantaneous_frequencies = normalize(mel_instantaneous_frequencies, 0, 1).astype(np.float32)
+    # =========================================================================================
+    return log_mel_magnitude_spectrograms, mel_instantaneous_frequencies
+
+
+def convert_to_waveforms(log_mel_magnitude_spectrograms, mel_instantaneous_frequencies, waveform_length, sample_rate, spectrogram_shape, overlap):
+
+    def unnormalize(inputs, mean, std):
+        return inputs * std + mean
+    # =========================================================================================
+    time_steps, num_freq_bins = spectrogram_shape
+    frame_length = num_freq_bins * 2
+    frame_step = int((1 - overlap) * frame_length)
+    num_samples = frame_step * (time_steps - 1) + frame_length
+    # =========================================================================================
+    log_mel_magnitude_spectrograms = unnormalize(np.asanyarray(log_mel_magnitude_spectrograms, dtype=np.float32), -4, 10)
+    mel_instantaneous_frequencies = unnormalize(np.asanyarray(mel_instantaneous_frequencies, dtype=np.float32), 0, 1)
+    # =========================================================================================
+    mel_magnitude_spectrograms = np.exp(log_mel_magnitude_spectrograms)
+    mel_phase_spectrograms = np.cumsum(mel_instantaneous_frequencies * np.float32(np.pi), axis=-2)
+    # =========================================================================================
+    weight_matrix = mel_to_linear_weight_matrix(num_freq_bins, num_freq_bins, sample_rate, 0, sample_rate / 2)
+    magnitudes = np.matmul(mel_magnitude_spectrograms, weight_matrix)
+    phase_spectrograms = np.matmul(mel_phase_spectrograms, weight_matrix)
+    # =========================================================================================
+    stfts = (magnitudes * np.exp(1j * phase_spectrograms)).astype(np.complex64)
+    # =========================================================================================
+    # discard_dc
+    stfts = np.pad(stfts, [[0, 0], [0, 0], [1, 0]], mode="constant")
+    # =========================================================================================
+    waveforms = inverse_stft(stfts, frame_length, frame_step)
+    # =========================================================================================
+    # For Nsynth dataset, we are putting all padding in the front
+    # This causes edge effects in the tail
+    waveforms = waveforms[:, num_samples - waveform_length:]
+    # =========================================================================================
+    return waveforms
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        import tensorflow as tf
+        import tensorflow_probability as tfp
+        import spectral_ops
+    except ImportError as error:
+        # nothing to compare against
+        print("skipping the agreement check: {}".format(error))
+        sys.exit(0)
+
+    spectral_params = dict(
+        waveform_length=64000,
+        sample_rate=16000,
+        spectrogram_shape=[128, 1024],
+        overlap=0.75
+    )
+
+    time_steps, num_freq_bins = spectral_params["spectrogram_shape"]
+    frame_length = num_freq_bins * 2
+    frame_step = int((1 - spectral_params["overlap"]) * frame_length)
+
+    mel_params = dict(
+        num_mel_bins=num_freq_bins,
+        num_spectrogram_bins=num_freq_bins,
+        sample_rate=spectral_params["sample_rate"],
+        lower_edge_hertz=0,
+        upper_edge_hertz=spectral_params["sample_rate"] / 2
+    )
+
+    # decaying harmonic tones with noise, like nsynth notes
+    random = np.random.RandomState(args.seed)
+    times = np.arange(64000) / 16000
+    frequencies = 440 * 2 ** random.uniform(-2, 2, size=[args.batch_size, 1, 1])
+    waveforms = np.sum(np.sin(2 * np.pi * frequencies * np.arange(1, 5)[:, np.newaxis] * times) / np.arange(1, 5)[:, np.newaxis], axis=1)
+    waveforms = (0.5 * waveforms * np.exp(-2 * times) + 0.01 * random.normal(size=[args.batch_size, 64000])).astype(np.float32)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        window_fn = functools.partial(tf.signal.hann_window, periodic=True)
+        stfts = tf.signal.stft(waveforms, frame_length, frame_step, window_fn=window_fn)
+        tf_outputs = session.run(dict(
+            stfts=stfts,
+            inverse_stfts=tf.signal.inverse_stft(
+                stfts=stfts,
+                frame_length=frame_length,
+                frame_step=frame_step,
+                window_fn=tf.signal.inverse_stft_window_fn(frame_step, forward_window_fn=window_fn)
+            ),
+            linear_to_mel_weight_matrix=tf.signal.linear_to_mel_weight_matrix(**mel_params),
+            mel_to_linear_weight_matrix=tfp.math.pinv(tf.signal.linear_to_mel_weight_matrix(**mel_params)),
+            spectrograms=spectral_ops.convert_to_spectrograms(tf.constant(waveforms), **spectral_params)
+        ))
+        # both versions convert the same spectrograms back so that the errors do not compound
+        tf_outputs["waveforms"] = session.run(spectral_ops.convert_to_waveforms(*map(tf.constant, tf_outputs["spectrograms"]), **spectral_params))
+
+    numpy_spectrograms = convert_to_spectrograms(waveforms, **spectral_params)
+
+    # (name, tensorflow output, numpy output, rtol, atol)
+    for name, tf_output, numpy_output, rtol, atol in [
+        ("stft", tf_outputs["stfts"], stft(waveforms, frame_length, frame_step), 1e-4, 1e-3),
+        ("inverse_stft", tf_outputs["inverse_stfts"], inverse_stft(tf_outputs["stfts"], frame_length, frame_step), 1e-4, 1e-5),
+        ("linear_to_mel_weight_matrix", tf_outputs["linear_to_mel_weight_matrix"], linear_to_mel_weight_matrix(**mel_params), 1e-5, 1e-6),
+        ("mel_to_linear_weight_matrix", tf_outputs["mel_to_linear_weight_matrix"], mel_to_linear_weight_matrix(**mel_params), 1e-4, 1e-5),
+        ("log_mel_magnitude_spectrograms", tf_outputs["spectrograms"][0], numpy_spectrograms[0], 1e-4, 1e-3),
+        ("waveforms", tf_outputs["waveforms"], convert_to_waveforms(*tf_outputs["spectrograms"], **spectral_params), 1e-3, 1e-3),
+    ]:
+        np.testing.assert_allclose(numpy_output, tf_output, rtol=rtol, atol=atol, err_msg=name)
+        print("{}: max_error={:.3g}".format(name, np.max(np.abs(numpy_output - tf_output))))
+
+    # isolated phases on the +-pi branch cut may unwrap differently, so only a small fraction may disagree
+    outliers = ~np.isclose(numpy_spectrograms[1], tf_outputs["spectrograms"][1], rtol=1e-3, atol=1e-3)
+    if np.mean(outliers) > 1e-3:
+        raise AssertionError("mel_instantaneous_frequencies: {} of {} values disagree".format(np.sum(outliers), outliers.size))
+    print("mel_instantaneous_frequencies: outliers={:.3g}".format(np.mean(outliers)))